@@ -0,0 +1,115 @@
+"""Runs one benchmark scenario inside a prepared sandbox.
+
+Started by bench/run.py as a separate process so peak RSS and log output
+belong to this scenario alone. Prints one JSON object with the results.
+"""
+
+import io
+import json
+import os
+import resource
+import sys
+import time
+import urllib.request
+import zipfile
+from pathlib import Path
+
+
+class FakeResponse(io.BytesIO):
+    """Just enough of an HTTP response for utils.cache."""
+
+    def __init__(self, body):
+        super().__init__(body)
+        self.headers = {"ETag": '"bench"'}
+
+
+def fake_payload(url):
+    """A tiny font zip for .zip URLs, a no-op script/RPM for anything else."""
+    if url.endswith(".zip"):
+        buffer = io.BytesIO()
+        family = url.rsplit("/", 1)[-1].rsplit(".", 1)[0]
+        with zipfile.ZipFile(buffer, "w") as fontzip:
+            for weight in ("Regular", "Bold"):
+                for variant in ("", "Mono", "Propo"):
+                    fontzip.writestr(
+                        f"{family}NerdFont{variant}-{weight}.ttf", b"\0" * 4096
+                    )
+            fontzip.writestr("LICENSE", "synthetic")
+        return buffer.getvalue()
+    return b"#!/bin/sh\nexit 0\n"
+
+
+def patch_downloads(latency):
+    """Stand-in for the network: downloads are served from memory."""
+
+    def urlopen(request, *args, **kwargs):
+        url = request.full_url if hasattr(request, "full_url") else request
+        time.sleep(latency)
+        return FakeResponse(fake_payload(url))
+
+    urllib.request.urlopen = urlopen
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                # lstat: <kind>.log is a symlink to the run's log
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def run_scenario(scenario):
+    match scenario:
+        case "main":
+            import main
+
+            main.main()
+        case "packages":
+            from scripts import packages
+
+            packages.install_new_packages()
+        case "verify":
+            from scripts import verify
+
+            verify.main()
+        case _:
+            raise ValueError(f"Unknown scenario {scenario}")
+
+
+def main():
+    scenario = sys.argv[1]
+    with open(os.environ["PYBOOTSTRAP_BENCH_CONFIG"]) as file:
+        config = json.load(file)
+    patch_downloads(config.get("download_latency", 0))
+
+    # Benchmark output would drown the results; the log still gets it all
+    real_stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    start = time.perf_counter()
+    try:
+        run_scenario(scenario)
+    finally:
+        wall = time.perf_counter() - start
+        from utils import logger
+
+        logger.flush_all()
+        sys.stdout = real_stdout
+
+    log_dir = Path.home() / ".local" / "var" / "log" / "pybootstrap"
+    print(
+        json.dumps(
+            {
+                "wall_s": round(wall, 3),
+                "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "log_bytes": directory_bytes(log_dir),
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
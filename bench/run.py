@@ -0,0 +1,213 @@
+"""Benchmark pybootstrap's own overhead against simulated package managers.
+
+Usage (from the repo root):
+
+    python3 -m bench.run                      # all scenarios, 50/500/5000
+    python3 -m bench.run --sizes 50 --scenarios verify
+    python3 -m bench.run --save               # store results as the baseline
+    python3 -m bench.run --lock-errors        # dnf installs hit exit 200
+
+Each scenario runs in a throwaway HOME with fake dnf/rpm/flatpak/curl/
+systemctl/ufw/sudo first on PATH (see bench/stub.py), so nothing on the
+host is touched. Reported per scenario: wall time spent in pybootstrap,
+number of processes spawned, peak RSS and bytes of log written. Results
+are compared with bench/baselines.json; wall time and RSS depend on the
+machine, so re-record it with --save before comparing on a new one.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+STUB = Path(__file__).resolve().parent / "stub.py"
+BASELINES = Path(__file__).resolve().parent / "baselines.json"
+
+SCENARIOS = ["main", "packages", "verify"]
+SIZES = [50, 500, 5000]
+
+# Allowed slowdown before a metric counts as a regression
+TOLERANCE = {"wall_s": 0.25, "spawns": 0.0, "peak_rss_kb": 0.25, "log_bytes": 0.25}
+
+DEFAULT_COMMANDS = {
+    "dnf": {
+        "latency": 0.02,
+        "lines": 20,
+        "rules": [{"match": "upgrade", "exit": 100, "lines": 2000}],
+    },
+    "rpm": {"latency": 0.005},
+    "flatpak": {"latency": 0.02, "lines": 10},
+    "curl": {"latency": 0.02},
+    "systemctl": {"latency": 0.005},
+    "ufw": {"latency": 0.005, "lines": 2},
+    "sudo": {"latency": 0.0},
+}
+
+# --lock-errors: every other dnf install hits "another package manager is
+# running" (exit 200) first
+LOCK_ERROR_RULE = {"match": "install", "exits": [200, 0]}
+
+
+def synthetic_packages(size):
+    """size dnf packages over three segments plus size/5 flatpaks."""
+    names = [f"benchpkg-{number:05d}" for number in range(size)]
+    third = max(1, size // 3)
+    return {
+        "dnf": {
+            "dev": names[:third],
+            "utilities": names[third : 2 * third],
+            "security": names[2 * third :],
+        },
+        "flatpak": [f"org.bench.App{number:04d}" for number in range(size // 5)],
+    }
+
+
+def prepare_sandbox(root, size, commands):
+    """Lay out HOME, fake PATH, package state and a working copy of config."""
+    home = root / "home"
+    fakebin = root / "bin"
+    state = root / "state"
+    work = root / "work"
+    for path in (home, fakebin, state, work / "config", work / "utils"):
+        path.mkdir(parents=True)
+
+    sys.path.insert(0, str(STUB.parent))
+    from stub import FAKES
+
+    for name in FAKES:
+        (fakebin / name).symlink_to(STUB)
+
+    package_list = synthetic_packages(size)
+    (work / "config" / "packages.json").write_text(json.dumps(package_list))
+    shutil.copy(REPO / "config" / "fonts.json", work / "config" / "fonts.json")
+    shutil.copy(REPO / "utils" / "1password.txt", work / "utils" / "1password.txt")
+
+    # Half of everything is already installed
+    dnf_names = [pkg for pkgs in package_list["dnf"].values() for pkg in pkgs]
+    (state / "rpms").write_text("\n".join(dnf_names[::2]) + "\n")
+    (state / "flatpaks").write_text("\n".join(package_list["flatpak"][::2]) + "\n")
+
+    config = {
+        "state_dir": str(state),
+        "spawn_log": str(root / "spawns.log"),
+        "commands": commands,
+        "download_latency": 0.02,
+    }
+    config_path = root / "bench.json"
+    config_path.write_text(json.dumps(config))
+    (root / "spawns.log").touch()
+
+    env = dict(os.environ)
+    env.update(
+        {
+            "HOME": str(home),
+            "PATH": f"{fakebin}:{env.get('PATH', '')}",
+            "PYTHONPATH": str(REPO),
+            "PYBOOTSTRAP_BENCH_CONFIG": str(config_path),
+        }
+    )
+    env.pop("DISPLAY", None)
+    env.pop("WAYLAND_DISPLAY", None)
+    env.pop("PYBOOTSTRAP_CACHE_DIR", None)
+    return work, env
+
+
+def run_one(scenario, size, commands):
+    with tempfile.TemporaryDirectory(prefix="pybootstrap-bench-") as temp:
+        root = Path(temp)
+        work, env = prepare_sandbox(root, size, commands)
+        result = subprocess.run(
+            [sys.executable, "-m", "bench.driver", scenario],
+            cwd=work,
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"{scenario}/{size} exited with {result.returncode}")
+        metrics = json.loads(result.stdout.strip().splitlines()[-1])
+        with open(root / "spawns.log") as file:
+            metrics["spawns"] = sum(1 for _ in file)
+        return metrics
+
+
+def compare(results, baselines):
+    """Return the metrics that got worse than baseline beyond tolerance."""
+    regressions = []
+    for key, metrics in results.items():
+        baseline = baselines.get(key)
+        if not baseline:
+            continue
+        for metric, tolerance in TOLERANCE.items():
+            old = baseline.get(metric)
+            new = metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > 0.01:
+                regressions.append(f"{key} {metric}: {old} -> {new}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--save", action="store_true", help="write baselines")
+    parser.add_argument(
+        "--lock-errors",
+        action="store_true",
+        help="make dnf install fail with exit 200 on alternate calls",
+    )
+    args = parser.parse_args(argv)
+
+    commands = json.loads(json.dumps(DEFAULT_COMMANDS))
+    if args.lock_errors:
+        commands["dnf"]["rules"].append(LOCK_ERROR_RULE)
+
+    results = {}
+    print(f"{'scenario':<28}{'wall s':>9}{'spawns':>9}{'rss KiB':>10}{'log B':>11}")
+    for scenario in args.scenarios:
+        for size in args.sizes:
+            key = f"{scenario}/{size}"
+            if args.lock_errors:
+                key += "/lock-errors"
+            metrics = run_one(scenario, size, commands)
+            results[key] = metrics
+            print(
+                f"{key:<28}{metrics['wall_s']:>9.2f}{metrics['spawns']:>9}"
+                f"{metrics['peak_rss_kb']:>10}{metrics['log_bytes']:>11}"
+            )
+
+    if args.save:
+        baselines = {}
+        if BASELINES.exists():
+            baselines = json.loads(BASELINES.read_text())
+        baselines.update(results)
+        BASELINES.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Baselines saved to {BASELINES}")
+        return 0
+
+    if not BASELINES.exists():
+        print(f"No baseline at {BASELINES}, nothing compared. Record one with --save.")
+        return 0
+    baselines = json.loads(BASELINES.read_text())
+    missing = [key for key in results if key not in baselines]
+    if missing:
+        print(f"No baseline for {', '.join(missing)}, not compared.")
+    regressions = compare(results, baselines)
+    if regressions:
+        print("Regressions against baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("No regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
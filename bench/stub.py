@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Stand-in for dnf, rpm, flatpak, curl, systemctl, ufw, sudo and friends.
+
+Every fake executable on the benchmark PATH is a symlink to this file; the
+name it was called by picks the behaviour. Settings come from the JSON file
+named by PYBOOTSTRAP_BENCH_CONFIG:
+
+    {
+      "state_dir": "...",            # installed rpms / flatpaks live here
+      "spawn_log": "...",            # one line appended per invocation
+      "commands": {
+        "dnf": {"latency": 0.05, "lines": 20, "exit": 0,
+                "rules": [{"match": "upgrade", "exit": 100, "lines": 5000},
+                          {"match": "install", "exits": [200, 0]}]}
+      }
+    }
+
+A rule applies when its "match" word is among the arguments. "exits" is
+cycled through on successive matching calls (e.g. a lock error, then
+success).
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+FAKES = [
+    "dnf",
+    "rpm",
+    "flatpak",
+    "curl",
+    "systemctl",
+    "ufw",
+    "sudo",
+    "fc-cache",
+    "xdg-user-dirs-update",
+    "setfont",
+    "sysctl",
+]
+
+
+def load_config():
+    with open(os.environ["PYBOOTSTRAP_BENCH_CONFIG"]) as file:
+        return json.load(file)
+
+
+def log_spawn(config, name, args):
+    """Append one line per invocation; O_APPEND keeps concurrent writers sane."""
+    line = json.dumps([name, *args]) + "\n"
+    fd = os.open(config["spawn_log"], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def previous_calls(config, name, match):
+    """How many earlier invocations of name included the match word."""
+    count = 0
+    with open(config["spawn_log"]) as file:
+        for line in file:
+            call = json.loads(line)
+            if call[0] == name and match in call[1:]:
+                count += 1
+    # The current call is already logged
+    return count - 1
+
+
+def pick_behaviour(config, name, args):
+    settings = dict(config["commands"].get(name, {}))
+    for rule in settings.pop("rules", []):
+        if rule["match"] in args:
+            settings.update(rule)
+            if "exits" in rule:
+                exits = rule["exits"]
+                settings["exit"] = exits[
+                    previous_calls(config, name, rule["match"]) % len(exits)
+                ]
+            break
+    return settings
+
+
+def read_state(config, kind):
+    path = Path(config["state_dir"]) / kind
+    try:
+        return path.read_text().split()
+    except FileNotFoundError:
+        return []
+
+
+def add_state(config, kind, names):
+    path = Path(config["state_dir"]) / kind
+    with path.open("a") as file:
+        for name in names:
+            file.write(name + "\n")
+
+
+def emit(lines, prefix):
+    out = sys.stdout
+    for number in range(lines):
+        out.write(f"{prefix} progress line {number} " + "." * 40 + "\n")
+    out.flush()
+
+
+def positional(args):
+    return [arg for arg in args if not arg.startswith("-")]
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    config = load_config()
+    log_spawn(config, name, args)
+    behaviour = pick_behaviour(config, name, args)
+    time.sleep(behaviour.get("latency", 0))
+    exit_code = behaviour.get("exit", 0)
+
+    if name == "sudo":
+        while args and args[0].startswith("-"):
+            args = args[1:]
+        if args and os.path.basename(args[0]) in FAKES:
+            target = Path(sys.argv[0]).parent / os.path.basename(args[0])
+            os.execv(str(target), [str(target), *args[1:]])
+        # Anything else is only pretended, the benchmark never touches the host
+        return exit_code
+
+    if name == "rpm":
+        if "-qa" in args:
+            for pkg in read_state(config, "rpms"):
+                print(f"{pkg}\t1.0-1")
+            return 0
+        if "-E" in args:
+            print("42")
+            return 0
+        if "-q" in args:
+            installed = set(read_state(config, "rpms"))
+            missing = [p for p in positional(args[1:]) if p not in installed]
+            return 1 if missing else 0
+
+    if name == "dnf" and "install" in args and exit_code in (0, 10):
+        add_state(config, "rpms", positional(args[args.index("install") + 1 :]))
+
+    if name == "flatpak":
+        if "list" in args:
+            print("\n".join(read_state(config, "flatpaks")))
+            return 0
+        if "install" in args and exit_code == 0:
+            refs = positional(args[args.index("install") + 1 :])
+            add_state(config, "flatpaks", [r for r in refs if r != "flathub"])
+
+    if name == "systemctl" and "is-active" in args:
+        for _ in positional(args[args.index("is-active") + 1 :]):
+            print("active")
+        return 0
+
+    if name == "curl" and "-o" in args:
+        Path(args[args.index("-o") + 1]).write_bytes(b"\0" * 1024)
+
+    emit(behaviour.get("lines", 0), name)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
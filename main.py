@@ -1,43 +1,267 @@
+import argparse
 import time
 import subprocess
 import os
 import sys
-from pathlib import Path
-from scripts import packages, security, repos, system, home, fonts
+from scripts import packages, security, repos, system, home, fonts, plan, bundle
+from utils import aio
 from utils import common as util
+from utils import history
+from utils import journal
+from utils import logger
+from utils import privileged
+from utils import progress
+from utils import target
+from utils import scheduler
+from utils import trace
+from utils.aliases import ESCALATE
+from utils.scheduler import stage
 
+# Stages that only make sense on the running host, skipped with --root
+HOST_ONLY_STAGES = {"optimize-dnf", "font-cache", "rustup", "ufw"}
 
-def main():
-    util.print_and_log_header("PyBootstrap... Good luck...")
 
-    # Set up home directory first
-    home.setup_home_directories()
+def bootstrap_stages():
+    """Every bootstrap step with what it must wait for and what it holds.
+    Stages that don't touch the dnf lock run alongside the ones that do."""
+    return [
+        # Set up home directory first
+        stage("home", home.setup_home_directories, resources=["home"]),
+        # Update DNF settings
+        stage("optimize-dnf", system.optimize_dnf),
+        # Perform Initial full system update
+        stage(
+            "update",
+            system.full_system_update,
+            deps=["optimize-dnf"],
+            resources=["dnf-lock", "flatpak", "network"],
+        ),
+        # Add needed repos
+        stage(
+            "repos",
+            repos.add_needed_repos,
+            deps=["update"],
+            resources=["dnf-lock", "network"],
+            inputs=["utils/1password.txt"],
+        ),
+        # Add chosen fonts
+        stage("nerd-fonts", fonts.install_nerd_fonts, resources=["network"]),
+        stage(
+            "console-font",
+            fonts.install_terminus_console_font,
+            deps=["update"],
+            resources=["dnf-lock"],
+        ),
+        stage(
+            "font-cache",
+            fonts.refresh_font_cache,
+            deps=["nerd-fonts", "console-font"],
+        ),
+        # Add required packages
+        stage(
+            "packages",
+            packages.install_new_packages,
+            deps=["repos"],
+            resources=["dnf-lock", "flatpak", "network"],
+            inputs=["config/packages.json"],
+        ),
+        stage(
+            "mullvad",
+            packages.install_mullvad,
+            deps=["update"],
+            resources=["dnf-lock", "network"],
+        ),
+        stage("rustup", packages.install_rustup, resources=["network"]),
+        stage(
+            "proton-pass",
+            packages.install_proton_pass,
+            deps=["update"],
+            resources=["dnf-lock", "network"],
+        ),
+        # Configure security
+        stage(
+            "portmaster",
+            security.install_portmaster,
+            deps=["update"],
+            resources=["dnf-lock", "network"],
+        ),
+        stage("sysctl", security.sysctl_system_hardening),
+        stage(
+            "ufw",
+            security.enable_and_configure_ufw,
+            deps=["packages"],
+            resources=["dnf-lock"],
+        ),
+        stage("fail2ban", security.enable_fail2ban, deps=["packages"]),
+        # Perform another full system update
+        stage(
+            "final-update",
+            system.full_system_update,
+            deps=[
+                "home",
+                "font-cache",
+                "packages",
+                "mullvad",
+                "rustup",
+                "proton-pass",
+                "portmaster",
+                "sysctl",
+                "ufw",
+                "fail2ban",
+            ],
+            resources=["dnf-lock", "flatpak", "network"],
+        ),
+        # Perform a system clean
+        stage(
+            "cleanup",
+            system.system_clean,
+            deps=["final-update"],
+            resources=["dnf-lock", "flatpak"],
+        ),
+    ]
 
-    # Update DNF settings
-    system.optimize_dnf()
 
-    # Perform Initial full system update
-    system.full_system_update()
+def target_stages(stages):
+    """Drop the host-only stages when building an install root."""
+    if target.is_host():
+        return stages
+    kept = [s for s in stages if s.name not in HOST_ONLY_STAGES]
+    for s in kept:
+        s.deps = tuple(dep for dep in s.deps if dep not in HOST_ONLY_STAGES)
+    return kept
 
-    # Add needed repos
-    repos.add_needed_repos()
 
-    # Add chosen fonts
-    fonts.install_fonts()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="pybootstrap", description="Bootstrap a fresh Fedora laptop."
+    )
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="ignore an unfinished previous run and start over",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="show all command output instead of one status line per stage",
+    )
+    parser.add_argument(
+        "--root",
+        dest="roots",
+        action="append",
+        metavar="DIR",
+        help="build an install root in DIR instead of setting up this machine; "
+        "repeat to build several roots at once",
+    )
+    parser.add_argument(
+        "--releasever",
+        help="Fedora release to install into --root (default: the host's)",
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("run", help="full bootstrap (the default)")
+    commands.add_parser("plan", help="show what still needs doing, change nothing")
+    commands.add_parser("apply", help="do only what plan says is missing")
+    bundle_parser = commands.add_parser(
+        "bundle", help="export an offline bundle, or bootstrap from one"
+    )
+    bundle_parser.add_argument("action", choices=["export", "import"])
+    bundle_parser.add_argument("directory", help="bundle directory")
+    history_parser = commands.add_parser(
+        "history", help="show recorded runs and flag slower stages"
+    )
+    history_parser.add_argument(
+        "--limit", type=int, default=10, help="number of runs to list"
+    )
+    history_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=history.DEFAULT_THRESHOLD,
+        help="flag stages slower than this multiple of their median",
+    )
+    args = parser.parse_args(argv)
+    args.command = args.command or "run"
+    exporting = args.command == "bundle" and args.action == "export"
+    if args.roots and (args.command not in ("run", "bundle") or exporting):
+        parser.error("--root only works with the run and bundle import commands")
+    return args
 
-    # Add required packages
-    packages.install_packages()
 
-    # Configure security
-    security.security_setup()
+def write_trace():
+    """Save the run's trace next to the log and print the slowest spans."""
+    # Named after the run's log so it's rotated along with it
+    trace_path = util.get_logfile_path().with_suffix(".trace.json")
+    trace.write_trace(trace_path)
+    for line in trace.summary():
+        util.print_and_log(line)
+    util.print_and_log(f"Trace written to {trace_path} (open in ui.perfetto.dev)")
 
-    # Perform another full system update
-    system.full_system_update()
 
-    # Perform a system clean
-    system.system_clean()
+def main(fresh=False):
+    """Run the bootstrap. Returns False if any stage didn't finish."""
+    started = time.time()
+    util.print_and_log_header("PyBootstrap... Good luck...")
+    journal.start_run(fresh=fresh)
 
+    # Ask for the sudo password once up front so parallel stages don't
+    # race each other to prompt for it. Not needed with the helper running.
+    if not privileged.active():
+        util.run_cmd([ESCALATE, "-v"])
+
+    stages = scheduler.run_stages(target_stages(bootstrap_stages()))
+    scheduler.report(stages)
+    write_trace()
+
+    unfinished = [s.name for s in stages if s.status not in ("done", "resumed")]
+    history.record_run(
+        "bootstrap",
+        started,
+        "unfinished" if unfinished else "complete",
+        {s.name: s.status for s in stages},
+    )
+    if unfinished:
+        util.print_and_log(
+            f"Unfinished stages: {', '.join(unfinished)}. "
+            "Re-run to resume from where this run stopped."
+        )
+        return False
+
+    journal.finish_run()
     print("\nBootstrap complete!")
+    return True
+
+
+def build_roots(args):
+    """Build several install roots at once, one child process per root.
+    They share the dnf package cache and the download cache. Returns False
+    if any of them failed."""
+    util.print_and_log_header(f"Building {len(args.roots)} install roots")
+    # Prompt once here; the children reuse the cached credentials
+    util.run_cmd([ESCALATE, "-v"])
+
+    children = {}
+    for root in args.roots:
+        cmd = [sys.executable, os.path.abspath(__file__), "--root", root]
+        if args.releasever:
+            cmd += ["--releasever", args.releasever]
+        if args.fresh:
+            cmd.append("--fresh")
+        if args.command == "bundle":
+            cmd += ["bundle", "import", os.path.abspath(args.directory)]
+        else:
+            cmd.append("run")
+        # Each child logs to its own file; keep the terminal readable
+        children[root] = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        util.print_and_log(f"Building {root} (pid {children[root].pid})")
+
+    failed = []
+    for root, child in children.items():
+        exit_code = child.wait()
+        if exit_code == 0:
+            util.print_and_log(f"{root}: finished.")
+        else:
+            util.print_and_log(f"{root}: exited with {exit_code}. Check its log.")
+            failed.append(root)
+    return not failed
 
 
 if __name__ == "__main__":
@@ -49,8 +273,70 @@ if __name__ == "__main__":
         print("💡 Just run: python3 main.py")
         sys.exit(1)
 
+    logger.install_signal_handlers()
+    args = parse_args()
+    progress.configure(verbose=args.verbose)
+    if args.command == "history":
+        history.show(args.limit, args.threshold)
+        sys.exit(0)
     start_time = time.time()
-    main()
+    if args.roots and len(args.roots) > 1:
+        sys.exit(0 if build_roots(args) else 1)
+    if args.roots:
+        target.set_root(args.roots[0], args.releasever)
+        util.set_logfile_name(target.per_target(util.LOGFILE_NAME))
+        if not target.prepare():
+            print(f"Could not create {target.home()}.")
+            sys.exit(1)
+
+    exporting = args.command == "bundle" and args.action == "export"
+    if args.command != "plan" and not exporting:
+        # One sudo for the whole run; privileged work goes through the helper
+        write_roots = [target.root()] if args.roots else []
+        if privileged.start(write_roots):
+            util.print_and_log("Privileged helper started.")
+        else:
+            util.print_and_log("Privileged helper unavailable, falling back to sudo.")
+    succeeded = True
+    try:
+        match args.command:
+            case "plan":
+                plan.show(plan.plan())
+                sys.exit(0)
+            case "apply":
+                statuses = {}
+                status = "interrupted"
+                try:
+                    plan.apply(statuses=statuses)
+                    status = "complete"
+                except Exception as e:
+                    util.print_and_log(f"Apply failed: {e}")
+                    status = "failed"
+                    succeeded = False
+                finally:
+                    history.record_run("apply", start_time, status, statuses)
+            case "bundle" if exporting:
+                try:
+                    bundle.export(args.directory)
+                except RuntimeError as e:
+                    util.print_and_log(f"Export failed: {e}")
+                    sys.exit(1)
+                sys.exit(0)
+            case "bundle":
+                try:
+                    bundle.activate(args.directory)
+                except RuntimeError as e:
+                    util.print_and_log(f"Could not use the bundle: {e}")
+                    sys.exit(1)
+                succeeded = main(fresh=args.fresh)
+            case _:
+                succeeded = main(fresh=args.fresh)
+    except KeyboardInterrupt:
+        # Commands run in their own process groups, which Ctrl-C doesn't
+        # reach; stop them so the stage threads can finish
+        aio.kill_all()
+        privileged.stop()
+        raise
     end_time = time.time()
 
     duration = end_time - start_time
@@ -59,6 +345,11 @@ if __name__ == "__main__":
         f"Bootstrap completed in {int(minutes)} minutes and {int(seconds)} seconds."
     )
 
+    util.get_log_writer().flush()
+    log_path = util.get_logfile_path()
+    if not target.is_host():
+        print(f"Log written to {log_path}")
+        sys.exit(0 if succeeded else 1)
     print("Opening log file for review...")
-    log_path = Path.home() / ".local" / "var" / "log" / "pybootstrap" / "bootstrap.log"
     subprocess.run(["xdg-open", str(log_path)])
+    sys.exit(0 if succeeded else 1)
@@ -0,0 +1,296 @@
+import json
+import platform
+import shutil
+import time
+from pathlib import Path
+from scripts import fonts, packages, repos, security
+from utils import cache
+from utils import common as util
+from utils import target
+from utils.aliases import ESCALATE, PKG
+
+# Offline bundles. `main.py bundle export DIR` collects everything a
+# bootstrap downloads into DIR:
+#
+#   rpms/        the full dependency closure of config/packages.json plus
+#                the repo release and vendor RPMs, as a local dnf repo
+#   flatpak/     the flatpak apps, as a sideload repo (flatpak create-usb)
+#   downloads/   font archives, vendor installers, repo files and GPG keys
+#   manifest.json
+#
+# `main.py bundle import DIR` then runs the bootstrap from DIR: dnf only
+# sees a file:// repo for rpms/, flatpak installs from the sideload repo
+# and the download cache serves every URL from downloads/. The bundled
+# repo is GPG-checked against the keys of the repos the RPMs came from,
+# which the export copies into downloads/keys/.
+
+MANIFEST = "manifest.json"
+BUNDLE_REPO_ID = "pybootstrap-bundle"
+HOST_REPOS_DIR = Path("/etc/yum.repos.d")
+
+# Installed by stages rather than from config/packages.json
+EXTRA_DNF_PACKAGES = ["terminus-fonts-console", "ufw"]
+
+
+def load_package_list():
+    with open(Path("config/packages.json")) as file:
+        return json.load(file)
+
+
+def bundle_urls(fedora_version):
+    """{url: cache filename or None} for everything a bootstrap downloads."""
+    urls = {url: None for url in fonts.FONT_URLS}
+    urls[packages.MULLVAD_URL] = packages.MULLVAD_FILENAME
+    urls[packages.PROTON_PASS_URL] = None
+    urls[packages.RUSTUP_URL] = packages.RUSTUP_FILENAME
+    urls[packages.FLATHUB_REPO_URL] = None
+    urls[security.PORTMASTER_URL] = None
+    for url in repos.rpmfusion_urls(fedora_version):
+        urls[url] = None
+    urls[repos.protonvpn_url(fedora_version)] = None
+    for copr in repos.COPRS:
+        urls[repos.copr_repo_url(copr, fedora_version)] = None
+    urls[repos.ONEPASSWORD_KEY] = None
+    return urls
+
+
+def export_downloads(bundle_dir, fedora_version):
+    """Copy every download into bundle_dir/downloads. Returns the
+    manifest's {url: relative path} map and the URLs that failed."""
+    downloads = {}
+    failed = []
+    pending = bundle_urls(fedora_version)
+    while pending:
+        url, filename = pending.popitem()
+        try:
+            path = cache.fetch(url, filename)
+        except Exception as e:
+            util.print_and_log(f"Failed to download {url}: {e}")
+            failed.append(url)
+            continue
+        # Cache blobs live in a directory named after their hash; keep that
+        relative = Path("downloads") / path.parent.name / path.name
+        if not (bundle_dir / relative).exists():
+            (bundle_dir / relative).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(path, bundle_dir / relative)
+        downloads[url] = str(relative)
+
+        # Repo files point at GPG keys that need to come along too
+        if path.suffix == ".repo":
+            keys = repos.collect_gpg_keys([path.read_text()], fedora_version)
+            for key in keys:
+                if key.startswith(("https://", "http://")) and key not in downloads:
+                    pending[key] = None
+    return downloads, failed
+
+
+def export_keys(bundle_dir, fedora_version, downloads):
+    """Copy the GPG keys of every repo the closure is downloaded from into
+    bundle_dir/downloads/keys. Returns their relative paths and the keys
+    that could not be copied."""
+    repo_texts = []
+    for repo_file in sorted(HOST_REPOS_DIR.glob("*.repo")):
+        try:
+            repo_texts.append(repo_file.read_text())
+        except OSError:
+            pass
+    keys_dir = bundle_dir / "downloads" / "keys"
+    keys_dir.mkdir(parents=True, exist_ok=True)
+
+    relatives = []
+    failed = []
+    for key in repos.collect_gpg_keys(repo_texts, fedora_version):
+        if key in downloads:
+            relatives.append(downloads[key])
+            continue
+        source = Path(key)
+        relative = Path("downloads") / "keys" / source.name
+        if key.startswith(("https://", "http://")):
+            try:
+                source = cache.fetch(key)
+            except Exception as e:
+                util.print_and_log(f"Failed to download GPG key {key}: {e}")
+                failed.append(key)
+                continue
+            # Remote keys are often all called pubkey.gpg; keep the hash dir
+            relative = Path("downloads") / source.parent.name / source.name
+            (bundle_dir / relative).parent.mkdir(parents=True, exist_ok=True)
+        elif not source.is_file():
+            # Referenced by a repo file, but never installed: nothing can
+            # have been downloaded from a repo that needs it
+            continue
+        shutil.copy2(source, bundle_dir / relative)
+        relatives.append(str(relative))
+    return list(dict.fromkeys(relatives)), failed
+
+
+def rpm_requirements(rpm_paths):
+    """What the given RPM files require, as specs dnf download accepts."""
+    requirements = set()
+    for rpm_path in rpm_paths:
+        _, output = util.query_cmd([PKG.r, "-qpR", str(rpm_path)])
+        for line in output.splitlines():
+            requirement = line.split()[0] if line.strip() else ""
+            if requirement and not requirement.startswith(("rpmlib(", "config(")):
+                requirements.add(requirement)
+    return sorted(requirements)
+
+
+def export_rpms(bundle_dir, downloads):
+    """Download the dependency closure into bundle_dir/rpms and index it.
+    Raises RuntimeError if the closure or its index is incomplete."""
+    rpms_dir = bundle_dir / "rpms"
+    rpms_dir.mkdir(parents=True, exist_ok=True)
+
+    # Vendor and release RPMs go in as they are, their dependencies are
+    # resolved along with everything else
+    local_rpms = []
+    for relative in downloads.values():
+        if relative.endswith(".rpm"):
+            source = bundle_dir / relative
+            shutil.copy2(source, rpms_dir / source.name)
+            local_rpms.append(source)
+
+    names = []
+    for pkg_list in load_package_list().get("dnf", {}).values():
+        names.extend(str(pkg) for pkg in pkg_list)
+    for clients in repos.CLIENT_PACKAGES.values():
+        names.extend(clients)
+    names.extend(EXTRA_DNF_PACKAGES)
+    names.extend(rpm_requirements(local_rpms))
+    names = list(dict.fromkeys(names))
+
+    util.print_and_log(f"Downloading the closure of {len(names)} packages...")
+    exit_code, _ = util.run_cmd(
+        [
+            PKG.d,
+            "download",
+            "--resolve",
+            "--alldeps",
+            f"--destdir={rpms_dir}",
+            *names,
+        ],
+        capture=util.CAPTURE_NONE,
+    )
+    if exit_code != 0:
+        raise RuntimeError("some packages could not be downloaded, check the log")
+
+    util.print_and_log("Writing repo metadata...")
+    exit_code, _ = util.run_cmd(
+        ["createrepo_c", "--update", str(rpms_dir)], capture=util.CAPTURE_NONE
+    )
+    if exit_code != 0:
+        raise RuntimeError("createrepo_c failed, the bundle's repo is unusable")
+    return sum(1 for _ in rpms_dir.glob("*.rpm"))
+
+
+def export_flatpaks(bundle_dir):
+    """Copy the installed flatpak apps into a sideload repo. Raises
+    RuntimeError if that failed."""
+    apps = [str(app) for app in load_package_list().get("flatpak", [])]
+    if not apps:
+        return []
+    util.print_and_log(f"Exporting {len(apps)} flatpaks...")
+    flatpak_dir = bundle_dir / "flatpak"
+    flatpak_dir.mkdir(parents=True, exist_ok=True)
+    exit_code, _ = util.run_cmd(
+        [PKG.f, "create-usb", str(flatpak_dir), *apps], capture=util.CAPTURE_NONE
+    )
+    if exit_code != 0:
+        raise RuntimeError("flatpak create-usb failed, are all the apps installed?")
+    return apps
+
+
+def export(bundle_dir):
+    """Collect everything a bootstrap downloads into bundle_dir. Raises
+    RuntimeError, without writing a manifest, if anything is missing."""
+    util.print_and_log_header(f"Exporting offline bundle to {bundle_dir}")
+    bundle_dir = Path(bundle_dir).resolve()
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    fedora_version = int(target.releasever())
+
+    downloads, failed = export_downloads(bundle_dir, fedora_version)
+    gpg_keys, failed_keys = export_keys(bundle_dir, fedora_version, downloads)
+    failed += failed_keys
+    if failed:
+        raise RuntimeError(f"{len(failed)} downloads failed: {', '.join(failed)}")
+    rpm_count = export_rpms(bundle_dir, downloads)
+    flatpaks = export_flatpaks(bundle_dir)
+
+    manifest = {
+        "created": time.time(),
+        "releasever": fedora_version,
+        "arch": platform.machine(),
+        "downloads": downloads,
+        "gpg_keys": gpg_keys,
+        "rpms": rpm_count,
+        "flatpaks": flatpaks,
+    }
+    with (bundle_dir / MANIFEST).open("w") as file:
+        json.dump(manifest, file, indent=2)
+    util.print_and_log(
+        f"Bundle ready: {rpm_count} RPMs, {len(flatpaks)} flatpaks, "
+        f"{len(downloads)} other downloads."
+    )
+
+
+def get_reposdir():
+    """Gets or makes the directory holding the bundle's repo file"""
+    reposdir = (
+        Path.home()
+        / ".local"
+        / "state"
+        / "pybootstrap"
+        / target.per_target("bundle-repos.d")
+    )
+    reposdir.mkdir(parents=True, exist_ok=True)
+    return reposdir
+
+
+def activate(bundle_dir):
+    """Make this run take everything from bundle_dir instead of the network.
+    Raises RuntimeError if the bundle's GPG keys can't be imported."""
+    bundle_dir = Path(bundle_dir).resolve()
+    with (bundle_dir / MANIFEST).open("r") as file:
+        manifest = json.load(file)
+
+    if str(manifest["releasever"]) != str(target.releasever()):
+        util.print_and_log(
+            f"Warning: bundle is for Fedora {manifest['releasever']}, "
+            f"installing Fedora {target.releasever()}."
+        )
+
+    cache.use_bundle(
+        {url: bundle_dir / relative for url, relative in manifest["downloads"].items()}
+    )
+
+    # Import the keys of the repos the closure came from before anything
+    # is installed, so every bundled RPM is checked like it was online
+    gpg_keys = [bundle_dir / relative for relative in manifest.get("gpg_keys", [])]
+    if not gpg_keys:
+        raise RuntimeError("the bundle has no GPG keys, export it again")
+    util.print_and_log(f"Importing the bundle's GPG keys ({len(gpg_keys)})...")
+    exit_code, _ = util.run_cmd(
+        [ESCALATE, PKG.r, *target.rpm_options(), "--import"]
+        + [str(key) for key in gpg_keys]
+    )
+    if exit_code != 0:
+        raise RuntimeError("could not import the bundle's GPG keys")
+
+    reposdir = get_reposdir()
+    gpgkey = " ".join(f"file://{key}" for key in gpg_keys)
+    (reposdir / f"{BUNDLE_REPO_ID}.repo").write_text(
+        f"[{BUNDLE_REPO_ID}]\n"
+        "name=pybootstrap offline bundle\n"
+        f"baseurl=file://{bundle_dir / 'rpms'}\n"
+        "enabled=1\n"
+        "gpgcheck=1\n"
+        f"gpgkey={gpgkey}\n"
+        "metadata_expire=never\n"
+    )
+    target.use_offline_sources(reposdir, bundle_dir / "flatpak" / ".ostree" / "repo")
+    util.print_and_log(
+        f"Using offline bundle {bundle_dir}: {manifest['rpms']} RPMs, "
+        f"{len(manifest['flatpaks'])} flatpaks, {len(manifest['downloads'])} "
+        "other downloads."
+    )
@@ -1,44 +1,218 @@
+import json
 import os
+import re
+import shutil
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from types import SimpleNamespace
+from utils import cache
 from utils import common as util
+from utils import journal
+from utils import installed
+from utils import privileged
+from utils import target
 from utils.aliases import PKG, ESCALATE
 
+FONT_URLS = [
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/0xProto.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/CascadiaMono.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/CascadiaCode.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/FiraCode.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/FiraMono.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/GeistMono.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/JetBrainsMono.zip",
+    "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/Meslo.zip",
+]
 
-def install_nerd_fonts():
-    """Install Nerd Fonts from github repos"""
+CONSOLE_FONT = "ter-v32b"
+CONSOLE_FONT_PATH = Path(f"/usr/lib/kbd/consolefonts/{CONSOLE_FONT}.psf.gz")
 
+# Variants and weights to install per family. Nerd Font archives carry
+# every variant (Standard, Mono, Propo) in every weight; only the ones listed
+# here are unpacked and the rest are pruned. Without the file every font in
+# every archive is installed.
+FONT_MANIFEST = Path("config/fonts.json")
+
+# e.g. FiraCodeNerdFontMono-BoldItalic.ttf: variant Mono, weight BoldItalic
+FONT_FILE_PATTERN = re.compile(
+    r"NerdFont(?P<variant>Mono|Propo)?-(?P<weight>\w+)\.(?:ttf|otf)$"
+)
+
+# Parallel downloads; keep it modest so GitHub doesn't throttle us
+FONT_WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+
+# Font directories changed by this run, for refresh_font_cache. Only
+# complete if install_nerd_fonts ran here without resuming any family from
+# an earlier, interrupted run.
+_changed_dirs = set()
+_changed_lock = threading.Lock()
+_changes_known = False
+
+
+def _same_file(path, info):
+    """True if path already holds this zip member (same size and CRC32)."""
+    try:
+        if path.stat().st_size != info.file_size:
+            return False
+    except FileNotFoundError:
+        return False
+
+    crc = 0
+    with path.open("rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc == info.CRC
+
+
+def load_font_manifest():
+    """The font manifest, or None to install everything."""
+    try:
+        with FONT_MANIFEST.open("r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def family_selection(manifest, family):
+    """(variants, weights) wanted for a family, or None for everything."""
+    if manifest is None:
+        return None
+    selection = manifest.get("families", {}).get(family, manifest.get("default"))
+    if selection is None:
+        return None
+    return set(selection["variants"]), set(selection["weights"])
+
+
+def is_wanted(filename, selection):
+    """True if the archive member belongs on disk. Files that aren't Nerd
+    Font faces (LICENSE, README) are always kept."""
+    match = FONT_FILE_PATTERN.search(Path(filename).name)
+    if selection is None or match is None:
+        return True
+    variants, weights = selection
+    variant = match["variant"] or "Standard"
+    return variant in variants and match["weight"] in weights
+
+
+def install_nerd_font(url, fonts_dir, selection=None):
+    """Fetch one Nerd Font archive through the download cache and unpack the
+    selected faces straight into fonts_dir/<Family>, removing faces from the
+    archive that are no longer selected. Returns a SimpleNamespace with the
+    family, written/skipped/pruned/excluded file counts and bytes_saved."""
+    zipname = util.get_filename_from_url(url)
+    family = util.get_filename_from_zip(zipname)
+    family_dir = fonts_dir / family
+    created = not family_dir.exists()
+    family_dir.mkdir(parents=True, exist_ok=True)
+
+    result = SimpleNamespace(
+        family=family, written=0, skipped=0, pruned=0, excluded=0, bytes_saved=0
+    )
+    archive = cache.fetch(url)
+    with zipfile.ZipFile(archive) as fontzip:
+        for info in fontzip.infolist():
+            if info.is_dir():
+                continue
+            dest = (family_dir / info.filename).resolve()
+            if not dest.is_relative_to(family_dir.resolve()):
+                util.log_line(f"Skipping suspicious path {info.filename}")
+                continue
+            if not is_wanted(info.filename, selection):
+                result.excluded += 1
+                result.bytes_saved += info.file_size
+                if dest.exists():
+                    dest.unlink()
+                    result.pruned += 1
+                continue
+            if _same_file(dest, info):
+                result.skipped += 1
+                continue
+
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            partial = dest.with_name(dest.name + ".part")
+            with fontzip.open(info) as src, partial.open("wb") as out:
+                shutil.copyfileobj(src, out, CHUNK_SIZE)
+            os.replace(partial, dest)
+            result.written += 1
+
+    if result.written or result.pruned:
+        with _changed_lock:
+            _changed_dirs.add(family_dir)
+            # A new family also changes the parent's list of subdirectories
+            if created:
+                _changed_dirs.add(fonts_dir)
+    return result
+
+
+def get_fonts_dir():
+    return target.home() / ".local" / "share" / "fonts"
+
+
+def install_nerd_fonts(urls=None):
+    """Install Nerd Fonts from github repos. urls defaults to FONT_URLS.
+    Raises RuntimeError naming the archives that failed once the rest are
+    installed."""
+
+    global _changes_known
     util.print_and_log_header("Installing Nerd Fonts")
 
-    fonts_dir = Path.home() / ".local" / "share" / "fonts"
+    urls = urls or FONT_URLS
+    fonts_dir = get_fonts_dir()
     fonts_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_font_manifest()
+
+    # Families finished by an interrupted earlier run are not fetched again
+    pending = {}
+    for url in urls:
+        step_fingerprint = journal.fingerprint(install_nerd_font, url, FONT_MANIFEST)
+        if journal.is_done(f"nerd-fonts/{url}", step_fingerprint):
+            util.print_and_log(f"{util.get_filename_from_url(url)} already done.")
+        else:
+            pending[url] = step_fingerprint
+
+    installed_files = 0
+    excluded_files = 0
+    bytes_saved = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=FONT_WORKERS) as pool:
+        futures = {}
+        for url in pending:
+            family = util.get_filename_from_zip(util.get_filename_from_url(url))
+            selection = family_selection(manifest, family)
+            futures[pool.submit(install_nerd_font, url, fonts_dir, selection)] = url
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                zipname = util.get_filename_from_url(url)
+                util.print_and_log(f"Failed to install {zipname}: {e}")
+                failed.append(zipname)
+                continue
+            journal.mark_done(f"nerd-fonts/{url}", pending[url])
+            util.print_and_log(
+                f"{result.family}: {result.written} files installed, "
+                f"{result.skipped} already present, {result.excluded} left out "
+                f"({result.pruned} removed)."
+            )
+            installed_files += result.written + result.skipped
+            excluded_files += result.excluded
+            bytes_saved += result.bytes_saved
 
-    font_urls = [
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/0xProto.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/CascadiaMono.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/CascadiaCode.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/FiraCode.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/FiraMono.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/GeistMono.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/JetBrainsMono.zip",
-        "https://github.com/ryanoasis/nerd-fonts/releases/latest/download/Meslo.zip",
-    ]
-
-    for url in font_urls:
-        zipname = util.get_filename_from_url(url)
-        zip_path = Path.home() / "tmp" / zipname
-        unzip_name = util.get_filename_from_zip(zipname)
-        unzip_path = Path.home() / "tmp" / unzip_name
-        util.run_cmd(["curl", "-L", "-o", str(zip_path), url])
-
-        util.print_and_log(f"unzipping {zipname}...")
-        util.run_cmd(["unzip", str(zip_path), "-d", str(unzip_path)])
-
-        util.print_and_log("Now moving font to fonts directory")
-        util.run_cmd(["mv", str(unzip_path), str(fonts_dir)])
-
-        util.print_and_log(f"Cleaning {zipname} from tmp directory")
-        util.run_cmd(["rm", "-rf", str(zip_path)])
+    with _changed_lock:
+        _changes_known = len(pending) == len(urls)
 
+    if excluded_files:
+        util.print_and_log(
+            f"Installed {installed_files} files, left out {excluded_files} "
+            f"({bytes_saved / (1024 * 1024):.1f} MiB saved)."
+        )
+    if failed:
+        raise RuntimeError(f"Nerd Fonts failed to install: {', '.join(failed)}")
     util.print_and_log("Nerd Fonts are now installed.")
 
 
@@ -48,51 +222,79 @@ def install_terminus_console_font():
     util.print_and_log_header("Installing Terminus Console Font")
 
     # Check if Terminus font already installed
-    font_path = Path("/usr/lib/kbd/consolefonts/ter-v32b.psf.gz")
-    if font_path.exists():
+    if target.path(CONSOLE_FONT_PATH).exists():
         util.print_and_log("Terminus console font already installed.")
     else:
         util.print_and_log("Terminus console font not found. Installing...")
-        exit_code = util.run_cmd(
-            [ESCALATE, PKG.d, "install", "-y", "terminus-fonts-console"]
+        exit_code, _ = util.run_cmd(
+            [ESCALATE, PKG.d, "install", "-y", *target.dnf_options()]
+            + ["terminus-fonts-console"]
         )
-        if exit_code == 0:
-            util.print_and_log("Terminus console font installed successfully.")
-        else:
-            util.print_and_log("Failed to install Terminus console font.")
+        installed.invalidate()
+        if exit_code != 0:
+            raise RuntimeError(
+                f"Failed to install Terminus console font (dnf exited {exit_code})"
+            )
+        util.print_and_log("Terminus console font installed successfully.")
 
     # Check if FONT is already set correctly
+    vconsole_conf = target.path("/etc/vconsole.conf")
     try:
-        with open("/etc/vconsole.conf", "r") as file:
+        with open(vconsole_conf, "r") as file:
             vconsole_contents = file.read()
     except FileNotFoundError:
         vconsole_contents = ""
 
-    if "FONT=ter-v32b" in vconsole_contents:
-        util.print_and_log("Console font already set to ter-v32b.")
+    if f"FONT={CONSOLE_FONT}" in vconsole_contents:
+        util.print_and_log(f"Console font already set to {CONSOLE_FONT}.")
     else:
         util.print_and_log("Setting Terminus font in /etc/vconsole.conf...")
-        # Remove any existing FONT= line
-        util.run_cmd([ESCALATE, "sed", "-i", "/^FONT=/d", "/etc/vconsole.conf"])
-        # Then append cleanly
-        util.run_cmd(
-            [
-                ESCALATE,
-                "sh",
-                "-c",
-                'echo "FONT=ter-v32b" | tee -a /etc/vconsole.conf',
-            ]
-        )
-        util.print_and_log("Console font set to ter-v32b.")
+        # Drop any existing FONT= line, then append ours
+        lines = [
+            line
+            for line in vconsole_contents.splitlines()
+            if not line.startswith("FONT=")
+        ]
+        lines.append(f"FONT={CONSOLE_FONT}")
+        errors = privileged.write_file(vconsole_conf, "\n".join(lines) + "\n")
+        if errors:
+            raise RuntimeError(f"Failed to set console font: {'; '.join(errors)}")
+        util.print_and_log(f"Console font set to {CONSOLE_FONT}.")
 
-    # Only try setting font if not graphical
-    if not os.environ.get("DISPLAY") and not os.environ.get("WAYLAND_DISPLAY"):
+    # Only try setting font on a live, non-graphical host
+    if not target.is_host():
+        util.print_and_log("Skipping TTY font setup (building an install root).")
+    elif not os.environ.get("DISPLAY") and not os.environ.get("WAYLAND_DISPLAY"):
         util.print_and_log("Applying Terminus font to TTY...")
-        util.run_cmd([ESCALATE, "setfont", "-C", "/dev/tty1", "ter-v32b"])
+        util.run_cmd([ESCALATE, "setfont", "-C", "/dev/tty1", CONSOLE_FONT])
     else:
         util.print_and_log("Skipping TTY font setup (graphical session detected).")
 
 
+def refresh_font_cache():
+    """Update the fontconfig cache for the font directories this run
+    changed. Without -f fc-cache only rescans directories whose contents
+    changed instead of every font directory on the system. Fonts installed
+    by an earlier, interrupted run weren't recorded here, so then the
+    whole fonts directory is handed to fc-cache."""
+    with _changed_lock:
+        changed = sorted(_changed_dirs)
+        _changed_dirs.clear()
+        known = _changes_known
+    if not known:
+        changed = [get_fonts_dir()]
+    if not changed:
+        util.print_and_log("No font directories changed, font cache is current.")
+        return
+    util.print_and_log(f"Refreshing font cache for {len(changed)} directories")
+    exit_code, _ = util.run_cmd(
+        ["fc-cache", *map(str, changed)], capture=util.CAPTURE_NONE
+    )
+    if exit_code != 0:
+        raise RuntimeError(f"fc-cache exited with {exit_code}")
+    util.print_and_log("Fonts installation complete.")
+
+
 def install_fonts():
     """High-level runner: Install all fonts needed."""
     util.print_and_log_header("Installing Fonts")
@@ -101,6 +303,4 @@ def install_fonts():
     install_terminus_console_font()
 
     # Refresh font cache
-    util.print_and_log("Refreshing font cache")
-    util.run_cmd(["fc-cache", "-fv"])
-    util.print_and_log("Fonts installation complete.")
+    refresh_font_cache()
@@ -1,41 +1,53 @@
-from pathlib import Path
 from utils import common as util
+from utils import migrate
+from utils import target
 
+# Base folders created directly under ~
+NEW_DIRS = ["archive", "bin", "dev", "docs", "media", "tmp", "logarchive"]
+
+# XDG user-dirs.dirs mappings
+FOLDERS_MAP = {
+    "XDG_DESKTOP_DIR": "$HOME/archive/desktop",
+    "XDG_DOWNLOAD_DIR": "$HOME/tmp/downloads",
+    "XDG_TEMPLATES_DIR": "$HOME/archive/templates",
+    "XDG_PUBLICSHARE_DIR": "$HOME/tmp/public",
+    "XDG_DOCUMENTS_DIR": "$HOME/docs",
+    "XDG_MUSIC_DIR": "$HOME/media/music",
+    "XDG_PICTURES_DIR": "$HOME/media/pictures",
+    "XDG_VIDEOS_DIR": "$HOME/media/videos",
+}
+
+# Default XDG folder -> parent folder it moves into (lowercased)
+MOVE_MAPPING = {
+    "Documents": "docs",
+    "Downloads": "tmp",
+    "Pictures": "media",
+    "Music": "media",
+    "Videos": "media",
+    "Public": "tmp",
+    "Templates": "archive",
+    "Desktop": "archive",
+}
 
-def setup_home_directories():
-    """This will organize the home directory cleanly and update XDG defaults"""
-    util.print_and_log_header("Setting up Home Directory Structure")
 
-    home = Path.home()
-
-    # Step 1: Create base folders
-    new_dirs = [
-        home / "archive",
-        home / "bin",
-        home / "dev",
-        home / "docs",
-        home / "media",
-        home / "tmp",
-        home / "logarchive",
-    ]
+def get_user_dirs_path():
+    return target.home() / ".config" / "user-dirs.dirs"
+
+
+def create_base_dirs():
+    """Step 1: Create base folders"""
+    home = target.home()
+    new_dirs = [home / name for name in NEW_DIRS]
     for dir in new_dirs:
         if not dir.exists():
             dir.mkdir(parents=True, exist_ok=True)
             util.print_and_log(f"Created {dir}")
 
-    # Step 2: Update user-dirs.dirs mappings
+
+def update_user_dirs():
+    """Step 2: Update user-dirs.dirs mappings"""
     util.print_and_log("Updating user-dirs.dirs default directories")
-    user_dirs = Path.home() / ".config" / "user-dirs.dirs"
-    folders_map = {
-        "XDG_DESKTOP_DIR": "$HOME/archive/desktop",
-        "XDG_DOWNLOAD_DIR": "$HOME/tmp/downloads",
-        "XDG_TEMPLATES_DIR": "$HOME/archive/templates",
-        "XDG_PUBLICSHARE_DIR": "$HOME/tmp/public",
-        "XDG_DOCUMENTS_DIR": "$HOME/docs",
-        "XDG_MUSIC_DIR": "$HOME/media/music",
-        "XDG_PICTURES_DIR": "$HOME/media/pictures",
-        "XDG_VIDEOS_DIR": "$HOME/media/videos",
-    }
+    user_dirs = get_user_dirs_path()
     if user_dirs.exists():
         with user_dirs.open("r") as file:
             lines = file.readlines()
@@ -43,40 +55,45 @@ def setup_home_directories():
 
         new_lines = []
         for line in lines:
-            for key, path in folders_map.items():
+            for key, path in FOLDERS_MAP.items():
                 if line.strip().startswith(key):
                     line = f'{key}="{path}"\n'
             new_lines.append(line)
 
-        with user_dirs.open("w") as file:
-            file.writelines(new_lines)
-
-    # Step 3: Move XDG folders into new structure
-    move_mapping = {
-        "Documents": "docs",
-        "Downloads": "tmp",
-        "Pictures": "media",
-        "Music": "media",
-        "Videos": "media",
-        "Public": "tmp",
-        "Templates": "archive",
-        "Desktop": "archive",
-    }
+        migrate.write_text_atomic(user_dirs, "".join(new_lines))
+
 
+def move_xdg_folders():
+    """Step 3: Move XDG folders into new structure. A rename on the same
+    filesystem, a verified copy across filesystems. Returns the folders
+    that could not be moved."""
+    home = target.home()
     moved_count = 0
     skipped_count = 0
+    failed = []
 
-    for old, new in move_mapping.items():
+    for old, new in MOVE_MAPPING.items():
         old_path = home / old
         new_name = old.lower()
         new_path = home / new / new_name
 
         if old_path.exists():
-            # Create parent if missing (just extra safe)
-            new_path.parent.mkdir(parents=True, exist_ok=True)
-
-            util.run_cmd(["mv", str(old_path), str(new_path)])
-            util.print_and_log(f"Moved {old} -> {new_name}")
+            result = migrate.move_tree(old_path, new_path)
+            if result.errors:
+                util.print_and_log(
+                    f"Moving {old} -> {new_name} failed, {old} was kept: "
+                    + "; ".join(result.errors[:3])
+                )
+                skipped_count += 1
+                failed.append(old)
+                continue
+            if result.method == "copy":
+                util.print_and_log(
+                    f"Copied {old} -> {new_name} across filesystems: "
+                    + migrate.throughput(result)
+                )
+            else:
+                util.print_and_log(f"Moved {old} -> {new_name}")
             moved_count += 1
         else:
             util.print_and_log(f"Skipping {old}: directory not found.")
@@ -85,8 +102,27 @@ def setup_home_directories():
     util.print_and_log(
         f"Finished moving directories: {moved_count} moved, {skipped_count} skipped."
     )
+    return failed
+
 
-    # Step 4: refresh user-dirs settings
+def refresh_user_dirs():
+    """Step 4: refresh user-dirs settings"""
+    if not target.is_host():
+        # Runs on the user's first login in the image
+        util.print_and_log("Skipping xdg-user-dirs-update for an install root.")
+        return
     util.run_cmd(["xdg-user-dirs-update"])
 
+
+def setup_home_directories():
+    """This will organize the home directory cleanly and update XDG defaults"""
+    util.print_and_log_header("Setting up Home Directory Structure")
+
+    create_base_dirs()
+    update_user_dirs()
+    failed = move_xdg_folders()
+    refresh_user_dirs()
+    if failed:
+        raise RuntimeError(f"Could not move {', '.join(failed)}")
+
     util.print_and_log("✅ User's Home Directory setup complete.")
@@ -1,13 +1,269 @@
 from pathlib import Path
+from types import SimpleNamespace
+from utils import cache
 from utils import common as util
+from utils import installed
+from utils import journal
+from utils import target
+from scripts import repos
 from utils.aliases import ESCALATE, PKG
 import json
-import urllib.request
-
-
-def install_new_packages():
+import shutil
+import time
+
+# Vendor downloads outside the package repos
+MULLVAD_URL = "https://mullvad.net/en/download/app/rpm/latest"
+MULLVAD_FILENAME = "mullvad-latest.rpm"
+PROTON_PASS_URL = "https://proton.me/download/PassDesktop/linux/x64/ProtonPass.rpm"
+RUSTUP_URL = "https://sh.rustup.rs"
+RUSTUP_FILENAME = "rustup-init.sh"
+FLATHUB_REPO_URL = "https://flathub.org/repo/flathub.flatpakrepo"
+
+# dnf output meaning the transaction can't be resolved, i.e. some package
+# in it is to blame. Anything else (lock held, mirror or download errors)
+# fails the batch as a whole.
+NO_MATCH = "No match for argument: "
+RESOLVE_ERRORS = (
+    NO_MATCH,
+    "Unable to find a match",
+    "Failed to resolve the transaction",
+    "Problem: ",
+    "nothing provides",
+    "conflicting requests",
+)
+# Wait before retrying a batch that failed for reasons of its own
+BATCH_RETRY_DELAY = 5
+
+
+def find_missing_dnf_packages(pkgs):
+    """Return the packages from pkgs that are not installed, using the
+    shared installed-package snapshot."""
+    missing = []
+    for pkg in pkgs:
+        if installed.is_installed(pkg):
+            continue
+        # A command on the host's PATH says nothing about an install root
+        if target.is_host() and shutil.which(pkg):
+            continue
+        missing.append(pkg)
+    return missing
+
+
+def _dnf_install(pkgs):
+    """One dnf install transaction. Returns its exit code, whether dnf
+    reported a resolution problem and the names it found no match for."""
+    report = SimpleNamespace(unresolved=False, no_match=set())
+
+    def on_line(line):
+        if any(error in line for error in RESOLVE_ERRORS):
+            report.unresolved = True
+        if NO_MATCH in line:
+            report.no_match.add(line.split(NO_MATCH, 1)[1].strip())
+
+    install_code, _ = util.run_cmd(
+        [ESCALATE, PKG.d, "install", "-y", *target.dnf_options(), *pkgs],
+        capture=util.CAPTURE_NONE,
+        on_line=on_line,
+    )
+    installed.invalidate()
+    return install_code, report.unresolved, report.no_match
+
+
+def install_dnf_batch(pkgs, retried=False):
+    """Install every package in pkgs in one dnf transaction. If dnf can't
+    resolve it, names it found no match for are dropped, or else the list
+    is bisected, so a single bad name only fails itself. Any other failure
+    retries the whole batch once. Returns (installed, failed) sets."""
+    if not pkgs:
+        return set(), set()
+
+    install_code, unresolved, no_match = _dnf_install(pkgs)
+    if install_code in (0, 10):
+        return set(pkgs), set()
+
+    if not unresolved:
+        if retried:
+            util.print_and_log(
+                f"dnf exited with {install_code} again; giving up on the batch."
+            )
+            return set(), set(pkgs)
+        util.print_and_log(
+            f"dnf exited with {install_code} without a package to blame. "
+            f"Retrying the batch in {BATCH_RETRY_DELAY}s..."
+        )
+        time.sleep(BATCH_RETRY_DELAY)
+        return install_dnf_batch(pkgs, retried=True)
+
+    unknown = no_match & set(pkgs)
+    if unknown:
+        util.print_and_log(f"No such packages: {' '.join(sorted(unknown))}")
+        rest = [pkg for pkg in pkgs if pkg not in unknown]
+        ok, failed = install_dnf_batch(rest, retried)
+        return ok, failed | unknown
+
+    if len(pkgs) == 1:
+        return set(), set(pkgs)
+
+    util.print_and_log(
+        f"Batch of {len(pkgs)} packages failed. Splitting to find the culprit..."
+    )
+    middle = len(pkgs) // 2
+    left_ok, left_failed = install_dnf_batch(pkgs[:middle], retried)
+    right_ok, right_failed = install_dnf_batch(pkgs[middle:], retried)
+    return left_ok | right_ok, left_failed | right_failed
+
+
+def install_dnf_segments(segments):
+    """Install all missing dnf packages across every segment in a single
+    transaction, then report per package and per segment. Raises
+    RuntimeError if any package failed."""
+    util.print_and_log("Processing dnf list...")
+
+    all_pkgs = []
+    for pkg_list in segments.values():
+        for pkg in pkg_list:
+            if pkg not in all_pkgs:
+                all_pkgs.append(str(pkg))
+
+    util.print_and_log(f"Checking for {len(all_pkgs)} packages...")
+    missing = find_missing_dnf_packages(all_pkgs)
+
+    if missing:
+        util.print_and_log(
+            f"{len(missing)} packages not found. Installing now: {' '.join(missing)}"
+        )
+    succeeded, failed = install_dnf_batch(missing)
+
+    for segment_name, pkg_list in segments.items():
+        util.print_and_log(f"Adding {segment_name} packages")
+        for pkg in pkg_list:
+            if pkg in succeeded:
+                util.print_and_log(f"{pkg} install successful")
+            elif pkg in failed:
+                util.print_and_log(f"{pkg} install failed. Install manually.")
+            else:
+                util.print_and_log(f"{pkg} already installed, skipping...")
+        segment_failed = [pkg for pkg in pkg_list if pkg in failed]
+        if segment_failed:
+            util.print_and_log(
+                f"{segment_name} packages completed with {len(segment_failed)} "
+                f"failures: {' '.join(segment_failed)}"
+            )
+        else:
+            util.print_and_log(f"{segment_name} packages have been completed")
+    if failed:
+        failed_list = " ".join(sorted(failed))
+        raise RuntimeError(f"dnf packages failed to install: {failed_list}")
+
+
+def install_dnf_packages_one_by_one(segments):
+    """Original per-package install loop, kept for debugging odd packages."""
+    util.print_and_log("Processing dnf list...")
+    failed = []
+    for segment_name, pkg_list in segments.items():
+        util.print_and_log(f"Adding {segment_name} packages")
+        for pkg in pkg_list:
+            util.print_and_log(f"Checking for {pkg}...")
+            if not installed.is_installed(pkg):
+                if shutil.which(str(pkg)) is None:
+                    util.print_and_log(f"{pkg} not found. Installing now.")
+                    install_code, _ = util.run_cmd(
+                        [ESCALATE, PKG.d, "install", "-y", *target.dnf_options()]
+                        + [str(pkg)],
+                        capture=util.CAPTURE_NONE,
+                    )
+                    installed.invalidate()
+                    if install_code in (0, 10):
+                        util.print_and_log(f"{pkg} install successful")
+                    else:
+                        util.print_and_log(f"{pkg} install failed. Install manually.")
+                        failed.append(str(pkg))
+                else:
+                    util.print_and_log(f"{pkg} already installed, skipping...")
+            else:
+                util.print_and_log(f"{pkg} already installed, skipping...")
+        util.print_and_log(f"{segment_name} packages have been completed")
+    if failed:
+        raise RuntimeError(f"dnf packages failed to install: {' '.join(failed)}")
+
+
+def parse_flatpak_errors(output, refs):
+    """Map each ref to the error flatpak reported for it, if any."""
+    errors = {}
+    for line in output.splitlines():
+        lowered = line.lower()
+        if "error" not in lowered and "nothing matches" not in lowered:
+            continue
+        for ref in refs:
+            if ref in line:
+                errors[ref] = line.strip()
+    return errors
+
+
+def install_flatpak_batch(refs):
+    """Install every ref in one flatpak transaction so shared runtimes are
+    resolved and fetched once. Refs flatpak rejects by name are dropped and
+    the rest retried once. Returns (installed, failed) as {ref: reason}."""
+    failed = {}
+    pending = list(refs)
+
+    while pending:
+        exit_code, output = util.run_cmd(
+            target.flatpak_cmd("install", "flathub", "-y", "--noninteractive", *pending)
+        )
+        installed.invalidate_flatpaks()
+        still_missing = [
+            ref for ref in pending if not installed.is_flatpak_installed(ref)
+        ]
+        if not still_missing:
+            break
+
+        errors = parse_flatpak_errors(output, still_missing)
+        if not errors:
+            for ref in still_missing:
+                failed[ref] = f"flatpak exited with {exit_code}"
+            break
+
+        # Drop the refs flatpak complained about and retry the rest together
+        failed.update(errors)
+        pending = [ref for ref in still_missing if ref not in errors]
+
+    succeeded = [ref for ref in refs if ref not in failed]
+    return succeeded, failed
+
+
+def install_flatpak_apps(apps):
+    """Install all missing Flatpak apps with one listing and one transaction.
+    Raises RuntimeError if any app failed."""
+    util.print_and_log("Processing flatpak list...")
+    util.print_and_log(f"Checking for {len(apps)} flatpaks...")
+    missing = [app for app in apps if not installed.is_flatpak_installed(app)]
+
+    succeeded, failed = [], {}
+    if missing:
+        util.print_and_log(
+            f"{len(missing)} flatpaks not found. Adding: {' '.join(missing)}"
+        )
+        succeeded, failed = install_flatpak_batch(missing)
+
+    for app in apps:
+        if app in succeeded:
+            util.print_and_log(f"{app} successfully installed.")
+        elif app in failed:
+            util.print_and_log(
+                f"{app} install failed ({failed[app]}). Install manually."
+            )
+        else:
+            util.print_and_log(f"{app} exists. Skipping...")
+    if failed:
+        raise RuntimeError(f"flatpaks failed to install: {' '.join(failed)}")
+
+
+def install_new_packages(batch=True):
     """This functions loops through a json list of required packages and
-    installs"""
+    installs. With batch=True every missing dnf package goes into a single
+    transaction instead of one dnf call per package. A manager with failed
+    packages isn't journaled as done; the failures are raised at the end."""
 
     packages = Path("config/packages.json")
 
@@ -17,67 +273,51 @@ def install_new_packages():
     with open(packages) as file:
         package_list = json.load(file)
 
+    failures = []
     for manager, segments in package_list.items():
-        match manager:
-            case "dnf":
-                util.print_and_log("Processing dnf list...")
-                for segment_name, pkg_list in segments.items():
-                    util.print_and_log(f"Adding {segment_name} packages")
-                    for pkg in pkg_list:
-                        util.print_and_log(f"Checking for {pkg}...")
-                        exit_code, _ = util.run_cmd(["rpm", "-q", str(pkg)])
-                        if exit_code != 0:
-                            fail_exit, _ = util.run_cmd(["which", str(pkg)])
-                            if fail_exit != 0:
-                                util.print_and_log(f"{pkg} not found. Installing now.")
-                                install_code, _ = util.run_cmd(
-                                    [ESCALATE, PKG.d, "install", "-y", str(pkg)]
-                                )
-                                if install_code in (0, 10):
-                                    util.print_and_log(f"{pkg} install successful")
-                                else:
-                                    util.print_and_log(
-                                        f"{pkg} install failed. Install manually."
-                                    )
-                            else:
-                                util.print_and_log(
-                                    f"{pkg} already installed, skipping..."
-                                )
-                        else:
-                            util.print_and_log(f"{pkg} already installed, skipping...")
-                    util.print_and_log(f"{segment_name} packages have been completed")
-                util.print_and_log(f"{manager} package installation step complete.")
-
-            case "flatpak":
-                util.print_and_log("Making sure Flathub repo is added...")
-                util.run_cmd(
-                    [
-                        "flatpak",
-                        "remote-add",
-                        "--if-not-exists",
-                        "flathub",
-                        "https://flathub.org/repo/flathub.flatpakrepo",
-                    ]
-                )
-
-                util.print_and_log("Processing flatpak list...")
-                for pkg in segments:
-                    util.print_and_log(f"Checking for {pkg}...")
-                    exit_code, _ = util.run_cmd([PKG.f, "info", str(pkg)])
-                    if exit_code == 0:
-                        util.print_and_log(f"{pkg} exists. Skipping...")
+        # Managers finished by an interrupted earlier run are skipped
+        step = f"packages/{manager}"
+        step_fingerprint = journal.fingerprint(install_new_packages, segments, batch)
+        if journal.is_done(step, step_fingerprint):
+            util.print_and_log(f"{manager} packages already done in this run.")
+            continue
+
+        try:
+            match manager:
+                case "dnf":
+                    # Clients from repos added by repos.add_needed_repos ride
+                    # along in the same transaction
+                    segments = dict(segments)
+                    for name, clients in repos.client_packages().items():
+                        segments[name] = [*segments.get(name, []), *clients]
+                    if batch:
+                        install_dnf_segments(segments)
                     else:
-                        util.print_and_log(f"{pkg} not found. Adding flatpak...")
-                        install_code, _ = util.run_cmd(
-                            [PKG.f, "install", "flathub", "-y", str(pkg)]
+                        install_dnf_packages_one_by_one(segments)
+
+                case "flatpak":
+                    util.print_and_log("Making sure Flathub repo is added...")
+                    # Through the cache so an offline bundle can serve it
+                    try:
+                        flathub_repo = str(cache.fetch(FLATHUB_REPO_URL))
+                    except Exception:
+                        flathub_repo = FLATHUB_REPO_URL
+                    util.run_cmd(
+                        target.flatpak_cmd(
+                            "remote-add", "--if-not-exists", "flathub", flathub_repo
                         )
-                        if install_code == 0:
-                            util.print_and_log(f"{pkg} successfully installed.")
-                        else:
-                            util.print_and_log(
-                                f"{pkg} install failed. Install manually."
-                            )
-                util.print_and_log(f"{manager} package installation step complete.")
+                    )
+
+                    install_flatpak_apps(segments)
+        except RuntimeError as e:
+            # Carry on with the other managers, fail the step at the end
+            failures.append(str(e))
+            continue
+        util.print_and_log(f"{manager} package installation step complete.")
+        journal.mark_done(step, step_fingerprint)
+
+    if failures:
+        raise RuntimeError("; ".join(failures))
     util.print_and_log("Package Installation is complete.")
 
 
@@ -86,17 +326,20 @@ def install_mullvad():
 
     util.print_and_log("Starting manual Mullvad VPN install...")
 
-    url = "https://mullvad.net/en/download/app/rpm/latest"
-    temp_path = Path("/tmp/mullvad-latest.rpm")
-
     util.print_and_log("Downloading Mullvad VPN...")
-    util.run_cmd(["curl", "-L", "-o", str(temp_path), url])
+    try:
+        rpm_path = cache.fetch(MULLVAD_URL, MULLVAD_FILENAME)
+    except Exception as e:
+        raise RuntimeError(f"Failed to download Mullvad VPN: {e}") from e
 
     util.print_and_log("Installing Mullvad VPN...")
-    util.run_cmd([ESCALATE, PKG.d, "install", "-y", str(temp_path)])
-
-    util.print_and_log("Cleaning up temporary RPM...")
-    util.run_cmd(["rm", "-f", str(temp_path)])
+    install_code, _ = util.run_cmd(
+        [ESCALATE, PKG.d, "install", "-y", *target.dnf_options(), str(rpm_path)],
+        capture=util.CAPTURE_NONE,
+    )
+    installed.invalidate()
+    if install_code != 0:
+        raise RuntimeError(f"Mullvad VPN install failed (dnf exited {install_code})")
 
     util.print_and_log("Mullvad VPN install complete!")
 
@@ -112,23 +355,19 @@ def install_rustup():
 
     util.print_and_log("Rust not found. Installing Rustup...")
 
-    rustup_script_path = Path("/tmp/rustup-init.sh")
-
     try:
-        urllib.request.urlretrieve("https://sh.rustup.rs", str(rustup_script_path))
+        rustup_script_path = cache.fetch(RUSTUP_URL, RUSTUP_FILENAME)
     except Exception as e:
-        util.print_and_log(f"Failed to download Rustup installer: {e}")
-        return
-
-    util.run_cmd(["chmod", "+x", str(rustup_script_path)])
-    install_code, _ = util.run_cmd([str(rustup_script_path), "-y"])
+        raise RuntimeError(f"Failed to download Rustup installer: {e}") from e
 
-    if install_code == 0:
-        util.print_and_log("Rustup installed successfully.")
-    else:
-        util.print_and_log("Rustup installation failed. Please check manually.")
+    # Run through sh so the cached copy never needs to be made executable
+    install_code, _ = util.run_cmd(
+        ["sh", str(rustup_script_path), "-y"], capture=util.CAPTURE_NONE
+    )
+    if install_code != 0:
+        raise RuntimeError(f"Rustup installation failed (exited {install_code})")
 
-    util.run_cmd(["rm", "-f", str(rustup_script_path)])
+    util.print_and_log("Rustup installed successfully.")
     util.print_and_log("Rust installed. You may need to restart your terminal.")
 
 
@@ -137,21 +376,21 @@ def install_proton_pass():
     now"""
 
     util.print_and_log("Installing Proton Pass...")
-    url = "https://proton.me/download/PassDesktop/linux/x64/ProtonPass.rpm"
-    temp_path = Path("/tmp/protonpass.rpm")
-
     util.print_and_log("Downloading ProtonPass.rpm")
-    util.run_cmd(["curl", "-L", "-o", temp_path, url])
+    try:
+        rpm_path = cache.fetch(PROTON_PASS_URL)
+    except Exception as e:
+        raise RuntimeError(f"Failed to download Proton Pass: {e}") from e
 
     util.print_and_log("Installing package...")
-    install_code, _ = util.run_cmd([ESCALATE, PKG.d, "install", "-y", str(temp_path)])
-    if install_code == 0:
-        util.print_and_log("Proton Pass installed successfully")
-    else:
-        util.print_and_log("Proton Pass installation failed.")
-
-    util.print_and_log("Cleaning up temporary files.")
-    util.run_cmd(["rm", "-f", str(temp_path)])
+    install_code, _ = util.run_cmd(
+        [ESCALATE, PKG.d, "install", "-y", *target.dnf_options(), str(rpm_path)],
+        capture=util.CAPTURE_NONE,
+    )
+    installed.invalidate()
+    if install_code != 0:
+        raise RuntimeError(f"Proton Pass install failed (dnf exited {install_code})")
+    util.print_and_log("Proton Pass installed successfully")
 
 
 def install_packages():
@@ -0,0 +1,311 @@
+import json
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+from scripts import fonts, home, packages, repos, security
+from utils import common as util
+from utils import installed
+from utils import trace
+from utils.aliases import ESCALATE
+
+# Plan/apply mode. plan() reads the current machine state in bulk, diffs it
+# against the desired state (config/packages.json plus the constants in
+# home.py, security.py and fonts.py) and returns the ordered list of actions
+# still needed. apply() runs only those actions. plan() on its own is a
+# fast dry-run.
+
+
+def action(name, description, func, *args):
+    """One step of the plan."""
+    return SimpleNamespace(name=name, description=description, func=func, args=args)
+
+
+def read_text(path):
+    try:
+        return Path(path).read_text()
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def read_user_dirs():
+    """Parse ~/.config/user-dirs.dirs into {key: value}."""
+    mappings = {}
+    contents = read_text(home.get_user_dirs_path()) or ""
+    for line in contents.splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep and not key.startswith("#"):
+            mappings[key] = value.strip('"')
+    return mappings
+
+
+def read_ufw_state():
+    """Whether ufw is enabled, its default policies and whether ssh is
+    limited. Reads ufw's config files and only asks ufw itself (via sudo)
+    when the rules file isn't readable. ssh_limited is None (unknown) when
+    sudo would need a password."""
+    enabled = "ENABLED=yes" in (read_text("/etc/ufw/ufw.conf") or "")
+
+    defaults = {}
+    for line in (read_text("/etc/default/ufw") or "").splitlines():
+        key, sep, value = line.strip().partition("=")
+        if sep:
+            defaults[key] = value.strip('"')
+
+    rules = read_text("/etc/ufw/user.rules")
+    if rules is not None:
+        ssh_limited = "--dport 22" in rules and "limit" in rules
+    elif enabled:
+        exit_code, status = util.query_cmd([ESCALATE, "-n", "ufw", "status"])
+        if exit_code != 0:
+            ssh_limited = None
+        else:
+            ssh_limited = any(
+                "LIMIT" in line and ("22" in line or "ssh" in line.lower())
+                for line in status.splitlines()
+            )
+    else:
+        ssh_limited = False
+
+    return SimpleNamespace(enabled=enabled, defaults=defaults, ssh_limited=ssh_limited)
+
+
+def gather_state():
+    """Everything plan() compares against, collected with as few processes
+    as possible."""
+    _, enabled_output = util.query_cmd(["systemctl", "is-enabled", "fail2ban"])
+
+    return SimpleNamespace(
+        rpms=installed.rpm_packages(),
+        flatpaks=installed.flatpak_apps(),
+        user_dirs=read_user_dirs(),
+        home_entries={p.name for p in Path.home().iterdir()},
+        vconsole=read_text("/etc/vconsole.conf") or "",
+        sysctl=read_text(security.SYSCTL_CONF),
+        ufw=read_ufw_state(),
+        fail2ban_enabled=enabled_output.strip() == "enabled",
+        font_families={p.name for p in fonts.get_fonts_dir().glob("*") if p.is_dir()},
+    )
+
+
+def desired_packages():
+    with open(Path("config/packages.json")) as file:
+        return json.load(file)
+
+
+def plan_home(state):
+    steps = []
+    missing_dirs = [d for d in home.NEW_DIRS if d not in state.home_entries]
+    if missing_dirs:
+        steps.append(
+            action(
+                "home-dirs",
+                f"Create {', '.join(missing_dirs)} in ~",
+                home.create_base_dirs,
+            )
+        )
+
+    wrong = [k for k, v in home.FOLDERS_MAP.items() if state.user_dirs.get(k) != v]
+    if wrong and home.get_user_dirs_path().exists():
+        steps.append(
+            action(
+                "user-dirs",
+                f"Remap {len(wrong)} XDG directories in user-dirs.dirs",
+                home.update_user_dirs,
+            )
+        )
+
+    to_move = [old for old in home.MOVE_MAPPING if old in state.home_entries]
+    if to_move:
+        steps.append(
+            action(
+                "move-xdg",
+                f"Move {', '.join(to_move)} into the new layout",
+                home.move_xdg_folders,
+            )
+        )
+    if steps:
+        steps.append(
+            action("xdg-refresh", "Refresh xdg user dirs", home.refresh_user_dirs)
+        )
+    return steps
+
+
+def plan_repos():
+    missing = repos.missing_repos()
+    if not missing:
+        return []
+    return [
+        action(
+            "repos",
+            f"Set up repos: {', '.join(missing)}",
+            repos.add_needed_repos,
+        )
+    ]
+
+
+def plan_fonts(state):
+    steps = []
+    missing_urls = [
+        url
+        for url in fonts.FONT_URLS
+        if util.get_filename_from_zip(util.get_filename_from_url(url))
+        not in state.font_families
+    ]
+    if missing_urls:
+        names = [util.get_filename_from_url(url) for url in missing_urls]
+        steps.append(
+            action(
+                "nerd-fonts",
+                f"Install Nerd Fonts: {', '.join(names)}",
+                fonts.install_nerd_fonts,
+                missing_urls,
+            )
+        )
+
+    console_ok = fonts.CONSOLE_FONT_PATH.exists() and (
+        f"FONT={fonts.CONSOLE_FONT}" in state.vconsole
+    )
+    if not console_ok:
+        steps.append(
+            action(
+                "console-font",
+                f"Install and set {fonts.CONSOLE_FONT} console font",
+                fonts.install_terminus_console_font,
+            )
+        )
+    if steps:
+        steps.append(
+            action("font-cache", "Refresh font cache", fonts.refresh_font_cache)
+        )
+    return steps
+
+
+def plan_packages(state, package_list):
+    steps = []
+    missing_segments = {}
+    # Clients of the repos set up by plan_repos go into the same transaction
+    clients = [pkg for pkgs in repos.CLIENT_PACKAGES.values() for pkg in pkgs]
+    dnf_segments = {**package_list.get("dnf", {}), "repo clients": clients}
+    for segment_name, pkg_list in dnf_segments.items():
+        missing = [
+            pkg for pkg in pkg_list if pkg not in state.rpms and not shutil.which(pkg)
+        ]
+        if missing:
+            missing_segments[segment_name] = missing
+    if missing_segments:
+        count = sum(len(pkgs) for pkgs in missing_segments.values())
+        steps.append(
+            action(
+                "dnf-packages",
+                f"Install {count} dnf packages",
+                packages.install_dnf_segments,
+                missing_segments,
+            )
+        )
+
+    missing_flatpaks = [
+        app for app in package_list.get("flatpak", []) if app not in state.flatpaks
+    ]
+    if missing_flatpaks:
+        steps.append(
+            action(
+                "flatpaks",
+                f"Install {len(missing_flatpaks)} flatpaks",
+                packages.install_flatpak_apps,
+                missing_flatpaks,
+            )
+        )
+
+    # Vendor RPMs installed outside config/packages.json
+    if "mullvad-vpn" not in state.rpms:
+        steps.append(action("mullvad", "Install Mullvad VPN", packages.install_mullvad))
+    if "proton-pass" not in state.rpms:
+        steps.append(
+            action("proton-pass", "Install Proton Pass", packages.install_proton_pass)
+        )
+
+    cargo_rustc = Path.home() / ".cargo" / "bin" / "rustc"
+    if not shutil.which("rustc") and not cargo_rustc.exists():
+        steps.append(action("rustup", "Install rustup", packages.install_rustup))
+    return steps
+
+
+def plan_security(state):
+    steps = []
+    if "portmaster" not in state.rpms:
+        steps.append(
+            action("portmaster", "Install Portmaster", security.install_portmaster)
+        )
+    if state.sysctl != "".join(security.SYSCTL_SETTINGS):
+        steps.append(
+            action(
+                "sysctl",
+                f"Write {security.SYSCTL_CONF}",
+                security.sysctl_system_hardening,
+            )
+        )
+
+    ufw = state.ufw
+    if ufw.ssh_limited is None:
+        util.print_and_log(
+            "ufw ssh limit: unknown (reading ufw's rules needs sudo), "
+            "not planning a change for it."
+        )
+    ufw_ok = (
+        ufw.enabled
+        and ufw.ssh_limited is not False
+        and all(ufw.defaults.get(k) == v for k, v in security.UFW_DEFAULTS.items())
+    )
+    if not ufw_ok:
+        steps.append(
+            action("ufw", "Configure and enable ufw", security.enable_and_configure_ufw)
+        )
+    if not state.fail2ban_enabled:
+        steps.append(action("fail2ban", "Enable fail2ban", security.enable_fail2ban))
+    return steps
+
+
+def plan():
+    """Return the ordered list of actions needed to reach the desired state."""
+    state = gather_state()
+    package_list = desired_packages()
+    return (
+        plan_home(state)
+        + plan_repos()
+        + plan_fonts(state)
+        + plan_packages(state, package_list)
+        + plan_security(state)
+    )
+
+
+def show(actions):
+    """Print the plan."""
+    util.print_and_log_header("Plan")
+    if not actions:
+        util.print_and_log("Nothing to do. The machine matches the desired state.")
+        return
+    for number, step in enumerate(actions, start=1):
+        util.print_and_log(f"{number:>3}. [{step.name}] {step.description}")
+    util.print_and_log(f"{len(actions)} actions planned.")
+
+
+def apply(actions=None, statuses=None):
+    """Run the planned actions in order. Plans first if none are given.
+    Stops at the first action that raises. statuses, if given, is filled
+    with {action name: "done" or "failed"}."""
+    if actions is None:
+        actions = plan()
+    if statuses is None:
+        statuses = {}
+    show(actions)
+    for number, step in enumerate(actions, start=1):
+        util.print_and_log(f"Applying {number}/{len(actions)}: {step.description}")
+        util.set_stage(step.name)
+        statuses[step.name] = "failed"
+        try:
+            with trace.span(step.name, "stage"):
+                step.func(*step.args)
+        finally:
+            util.set_stage(None)
+        statuses[step.name] = "done"
+    util.print_and_log("Apply complete.")
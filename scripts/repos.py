@@ -1,193 +1,287 @@
+import platform
 from pathlib import Path
+from utils import cache
 from utils import common as util
+from utils import freshness
+from utils import installed
+from utils import privileged
+from utils import target
 from utils.aliases import ESCALATE, PKG, ONE_PASSWORD
-from utils.aliases import exit_messages, RPM
-
-
-def install_rpm_fusion():
-    """Installs RPM Fusion if not present."""
-    util.print_and_log_header("Installing RPM Fusion")
-
-    # Dynamically get Fedora version
-    _, fedora_version = util.run_cmd(["rpm", "-E", "%fedora"])
-    fedora_version = fedora_version.strip()
-
-    rpm_urls = [
+from utils.aliases import exit_messages
+
+# Repos are set up in one batch: every release RPM goes into a single rpm
+# transaction, every repo file is written into /etc/yum.repos.d in one
+# batch, all GPG keys are imported in one rpm --import, and only then is
+# repo metadata fetched, once. Client packages that live in those repos are
+# handed to the main package transaction instead of being installed here.
+
+REPOS_DIR = Path("/etc/yum.repos.d")
+ONEPASSWORD_TEMPLATE = Path("utils/1password.txt")
+ONEPASSWORD_KEY = "https://downloads.1password.com/linux/keys/1password.asc"
+PROTON_RPM = "protonvpn-stable-release-1.0.3-1.noarch.rpm"
+OPENH264_REPO = REPOS_DIR / "fedora-cisco-openh264.repo"
+COPRS = ["lihaohong/yazi", "sneexy/zen-browser"]
+RPMFUSION_RELEASES = ["rpmfusion-free-release", "rpmfusion-nonfree-release"]
+
+# Packages to add to the main dnf transaction once their repo is installed,
+# keyed by the release RPM that provides the repo
+CLIENT_PACKAGES = {
+    "protonvpn-stable-release": ["proton-vpn-gnome-desktop"],
+}
+
+
+def rpmfusion_urls(fedora_version):
+    return [
         f"https://mirrors.rpmfusion.org/free/fedora/rpmfusion-free-release-{fedora_version}.noarch.rpm",
         f"https://mirrors.rpmfusion.org/nonfree/fedora/rpmfusion-nonfree-release-{fedora_version}.noarch.rpm",
     ]
 
-    if RPM["free"].exists() and RPM["nonfree"].exists():
-        message = "RPM Fusion is already installed."
-        util.print_and_log(message)
-    else:
-        for url in rpm_urls:
-            exit_code, _ = util.run_cmd([ESCALATE, PKG.d, "install", "-y", url])
-            message = exit_messages.get(exit_code, "Unexpected return code")
-            util.print_and_log(message)
-
-
-def enable_1password_repo():
-    """Enable the 1Password Repo for later installation."""
-    util.print_and_log_header("Enabling 1Password Repo")
-    onepassword_repo = ONE_PASSWORD
-    onepassword_template = Path("utils/1password.txt")
-
-    # Is 1Password repo already there?
-    if onepassword_repo.exists():
-        message = "1Password repo is already present."
-        util.print_and_log(message)
-    else:
-        util.print_and_log("1Password repo not found. Adding it manually")
-
-        # Import the GPG key for 1Password
-        util.print_and_log("Importing 1Password GPG key...")
-        key_exit_code, _ = util.run_cmd(
-            [
-                ESCALATE,
-                PKG.r,
-                "--import",
-                "https://downloads.1password.com/linux/keys/1password.asc",
-            ]
-        )
-        if key_exit_code == 0:
-            util.print_and_log("GPG key imported successfully.")
-        else:
-            util.print_and_log("Failed to import GPG key. Please check manually.")
 
-        # Handle repo creation
-        with onepassword_template.open("r") as file:
-            lines = file.readlines()
+def protonvpn_url(fedora_version):
+    return f"https://repo.protonvpn.com/fedora-{fedora_version}-stable/protonvpn-stable-release/{PROTON_RPM}"
 
-        temp_path = Path("/tmp/1password.repo")
-        with temp_path.open("w") as temp_file:
-            temp_file.writelines(lines)
 
-        onepass_exit_code, _ = util.run_cmd(
-            [ESCALATE, "mv", str(temp_path), str(onepassword_repo)]
-        )
-        if onepass_exit_code == 0:
-            util.print_and_log("1Password repo moved successfully")
-            util.run_cmd(
-                [
-                    ESCALATE,
-                    PKG.d,
-                    "config-manager",
-                    "--setopt=1password.gpgcheck=0",
-                    "--save",
-                ]
-            )
-            util.print_and_log(
-                "Configured 1Password repo to skip GPG check for initial setup."
-            )
-        else:
-            util.print_and_log("Failed to move 1Password repo. Please check manually")
+def copr_repo_path(copr):
+    owner, project = copr.split("/")
+    return REPOS_DIR / f"_copr:copr.fedorainfracloud.org:{owner}:{project}.repo"
 
 
-def enable_yazi_copr():
-    """Enables yazi copr repo for later installation with packages."""
-    util.print_and_log_header("Enabling lihaohong/yazi copr")
-    exit_code, _ = util.run_cmd(
-        [ESCALATE, PKG.d, "copr", "enable", "-y", "lihaohong/yazi"]
+def copr_repo_url(copr, fedora_version):
+    owner, project = copr.split("/")
+    return (
+        f"https://copr.fedorainfracloud.org/coprs/{owner}/{project}/repo/"
+        f"fedora-{fedora_version}/{owner}-{project}-fedora-{fedora_version}.repo"
     )
-    if exit_code == 0:
-        util.print_and_log("lihaohong/yazi successfully enabled.")
-    else:
-        util.print_and_log("Failed to enable lihaohong/yazi. Please check manually")
 
 
-def enable_zen_copr():
-    """Enables sneexy/zen-browser copr because ain't nobody got time fothat"""
-    util.print_and_log_header("Enabling sneexy/zen-browser copr")
-    exit_code, _ = util.run_cmd(
-        [ESCALATE, PKG.d, "copr", "enable", "-y", "sneexy/zen-browser"]
-    )
-    if exit_code == 0:
-        util.print_and_log("sneexy/zen-browser successfully enabled.")
-    else:
-        util.print_and_log("Failed to enable sneexy/zen-browser. Please check manually")
-
-
-def enable_protonvpn_repo():
-    """Enables ProtonVPN Repo and installs it"""
-    util.print_and_log_header("Enabling ProtonVPN Repo")
-    os_version = int(util.get_os_version())
-    proton_rpm = "protonvpn-stable-release-1.0.3-1.noarch.rpm"
-    proton_url = f"https://repo.protonvpn.com/fedora-{os_version}-stable/protonvpn-stable-release/{proton_rpm}"
-    proton_rpm_path = Path("/tmp") / proton_rpm
-
-    # Check if ProtonVPN repo is already installed
-    exit_code, _ = util.run_cmd([PKG.r, "-q", "protonvpn-stable-release"])
-    if exit_code == 0:
-        util.print_and_log("ProtonVPN repo already installed.")
-        return
-
-    util.print_and_log("Downloading ProtonVPN repo RPM...")
-
-    # Download the RPM
-    dl_exit_code, _ = util.run_cmd(["curl", "-fLo", str(proton_rpm_path), proton_url])
-    if dl_exit_code != 0:
-        util.print_and_log(
-            "Failed to download ProtonVPN repo RPM. Skipping ProtonVPN setup..."
-        )
-        return
-
-    # Install the downloaded RPM to enable the repo
-    install_exit_code, _ = util.run_cmd(
-        [ESCALATE, PKG.d, "install", "-y", str(proton_rpm_path)]
-    )
-    if install_exit_code != 0:
-        util.print_and_log(
-            "Failed to install ProtonVPN repo RPM. Skipping ProtonVPN client install..."
-        )
-        return
-
-    util.print_and_log("ProtonVPN repo installed successfully.")
-
-    # Install the ProtonVPN desktop client
-    client_exit_code, _ = util.run_cmd(
-        [ESCALATE, PKG.d, "install", "-y", "proton-vpn-gnome-desktop"]
-    )
-    if client_exit_code == 0:
-        util.print_and_log("ProtonVPN client installed successfully.")
-    else:
-        util.print_and_log("Failed to install ProtonVPN client.")
-
-
-def enable_openh264_repo():
-    """Enables non-FOSS media codec"""
-    util.print_and_log_header("Enable OpenH264 Codec Repo")
-
-    # Check if the repo is enabled
-    result, output = util.run_cmd([PKG.d, "repolist", "enabled"])
-    if "fedora-cisco-openh264" in output:
-        util.log_line("OpenH264 repo already enabled.")
-    else:
-        util.log_line("Enabling fedora-cisco-openh264 repo...")
-        result, output = util.run_cmd([PKG.d, "repolist", "enabled"])
-        if result == 0:
-            util.print_and_log("OpenH264 repo enabled successfully.")
-        else:
-            util.print_and_log("Failed to enable OpenH264 repo.")
+def openh264_enabled():
+    """True if the fedora-cisco-openh264 repo file has enabled=1."""
+    try:
+        contents = target.path(OPENH264_REPO).read_text()
+    except FileNotFoundError:
+        return False
+    return "enabled=1" in contents.replace(" ", "")
+
+
+def missing_repos():
+    """Names of the repos that still need setting up. Repos that come from
+    a release RPM are checked by package, not by repo file name."""
+    missing = []
+    if not all(installed.is_installed(release) for release in RPMFUSION_RELEASES):
+        missing.append("rpmfusion")
+    if not target.path(ONE_PASSWORD).exists():
+        missing.append("1password")
+    if not installed.is_installed("protonvpn-stable-release"):
+        missing.append("protonvpn")
+    for copr in COPRS:
+        if not target.path(copr_repo_path(copr)).exists():
+            missing.append(copr)
+    if target.path(OPENH264_REPO).exists() and not openh264_enabled():
+        missing.append("openh264")
+    return missing
+
+
+def client_packages():
+    """Client packages whose repo is now present, as a dnf segment."""
+    pkgs = []
+    for release_rpm, clients in CLIENT_PACKAGES.items():
+        if installed.is_installed(release_rpm):
+            pkgs.extend(clients)
+    return {"repo clients": pkgs} if pkgs else {}
+
+
+def fetch_release_rpms(missing, fedora_version):
+    """Download the release RPMs for missing repos through the cache.
+    Returns their paths and the URLs that failed."""
+    urls = []
+    if "rpmfusion" in missing:
+        urls.extend(rpmfusion_urls(fedora_version))
+    if "protonvpn" in missing:
+        urls.append(protonvpn_url(fedora_version))
+
+    rpm_paths = []
+    failed = []
+    for url in urls:
+        try:
+            rpm_paths.append(cache.fetch(url))
+        except Exception as e:
+            util.print_and_log(f"Failed to download {url}: {e}")
+            failed.append(url)
+    return rpm_paths, failed
+
+
+def repo_file_contents(missing, fedora_version):
+    """{final path: contents} for every repo file we write ourselves, and
+    the URLs of the ones that could not be fetched."""
+    files = {}
+    failed = []
+
+    if "1password" in missing:
+        # Skip the GPG check for the initial setup, like config-manager did
+        contents = ONEPASSWORD_TEMPLATE.read_text()
+        contents = contents.replace("gpgcheck=1", "gpgcheck=0", 1)
+        files[target.path(ONE_PASSWORD)] = contents
+
+    for copr in COPRS:
+        if copr not in missing:
+            continue
+        url = copr_repo_url(copr, fedora_version)
+        try:
+            repo_file = cache.fetch(url)
+        except Exception as e:
+            util.print_and_log(f"Failed to fetch {copr} repo file: {e}")
+            failed.append(url)
+            continue
+        files[target.path(copr_repo_path(copr))] = repo_file.read_text()
+
+    if "openh264" in missing:
+        lines = []
+        in_section = False
+        repo_file = target.path(OPENH264_REPO)
+        for line in repo_file.read_text().splitlines(keepends=True):
+            if line.startswith("["):
+                in_section = line.strip() == "[fedora-cisco-openh264]"
+            elif in_section and line.replace(" ", "").startswith("enabled="):
+                line = "enabled=1\n"
+            lines.append(line)
+        files[repo_file] = "".join(lines)
+
+    return files, failed
+
+
+def collect_gpg_keys(repo_texts, fedora_version):
+    """Every gpgkey= referenced by the given repo file contents, deduplicated."""
+    arch = platform.machine()
+    keys = []
+    for contents in repo_texts:
+        for line in contents.splitlines():
+            key, sep, value = line.partition("=")
+            if not sep or key.strip() != "gpgkey":
+                continue
+            for gpg_key in value.split():
+                gpg_key = gpg_key.replace("$releasever", str(fedora_version))
+                gpg_key = gpg_key.replace("$basearch", arch)
+                if gpg_key.startswith("file://"):
+                    gpg_key = str(target.path(gpg_key.removeprefix("file://")))
+                if gpg_key not in keys:
+                    keys.append(gpg_key)
+    return keys
+
+
+def fetch_keys(keys):
+    """Swap remote keys for local copies from the download cache, so they
+    are shared, work offline and can be bundled. Returns the local keys and
+    the URLs that failed, which are left out."""
+    local_keys = []
+    failed = []
+    for key in keys:
+        if key.startswith(("https://", "http://")):
+            try:
+                key = str(cache.fetch(key))
+            except Exception as e:
+                util.print_and_log(f"Failed to download GPG key {key}: {e}")
+                failed.append(key)
+                continue
+        local_keys.append(key)
+    return local_keys, failed
 
 
 def add_needed_repos():
+    """Set up every missing repo with one rpm transaction, one file install,
+    one key import and one metadata refresh. Raises RuntimeError if any of
+    those steps failed."""
     util.print_and_log_header("Adding Needed Repos")
 
-    # Start with RPM Fusion if not already installed.
-    install_rpm_fusion()
-
-    # Enable 1Password repo
-    enable_1password_repo()
-
-    # Enable ProtonVPN repo
-    enable_protonvpn_repo()
-
-    # Enable Yazi copr
-    enable_yazi_copr()
+    missing = missing_repos()
+    if not missing:
+        util.print_and_log("All repos are already set up.")
+        return
+    util.print_and_log(f"Setting up repos: {', '.join(missing)}")
+    fedora_version = int(target.releasever())
+    failures = []
+    fingerprints_before = freshness.repo_fingerprints()
+
+    # Step 1: all release RPMs in one rpm transaction (no repo metadata needed)
+    rpm_paths, failed = fetch_release_rpms(missing, fedora_version)
+    failures.extend(failed)
+    if rpm_paths:
+        util.print_and_log("Installing repo release RPMs...")
+        exit_code, _ = util.run_cmd(
+            [ESCALATE, PKG.r, *target.rpm_options(), "-U", "--replacepkgs"]
+            + [str(path) for path in rpm_paths]
+        )
+        installed.invalidate()
+        if exit_code == 0:
+            util.print_and_log("Release RPMs installed.")
+        else:
+            util.print_and_log("Failed to install release RPMs. Check manually.")
+            failures.append("release RPMs")
+
+    # Step 2: every repo file we write ourselves, in one go
+    files, failed = repo_file_contents(missing, fedora_version)
+    failures.extend(failed)
+    if files:
+        util.print_and_log(f"Adding {len(files)} repo files...")
+        errors = privileged.write_files(files)
+        if errors:
+            util.print_and_log(f"Failed to add repo files: {'; '.join(errors)}")
+            failures.append("repo files")
+
+    # Step 3: import every GPG key the new repos reference, in one go
+    repo_texts = list(files.values())
+    release_repo_files = []
+    if "rpmfusion" in missing:
+        release_repo_files += target.path(REPOS_DIR).glob("rpmfusion-*.repo")
+    if "protonvpn" in missing:
+        release_repo_files += target.path(REPOS_DIR).glob("protonvpn*.repo")
+    for repo_file in release_repo_files:
+        try:
+            repo_texts.append(repo_file.read_text())
+        except OSError:
+            pass
+    keys = collect_gpg_keys(repo_texts, fedora_version)
+    if "1password" in missing and ONEPASSWORD_KEY not in keys:
+        keys.append(ONEPASSWORD_KEY)
+    keys, failed = fetch_keys(keys)
+    failures.extend(failed)
+
+    if keys:
+        util.print_and_log(f"Importing GPG keys ({len(keys)})...")
+        key_exit_code, _ = util.run_cmd(
+            [ESCALATE, PKG.r, *target.rpm_options(), "--import", *keys]
+        )
+        if key_exit_code == 0:
+            util.print_and_log("GPG keys imported successfully.")
+        else:
+            util.print_and_log("Failed to import GPG keys. Please check manually.")
+            failures.append("GPG keys")
+
+    # Step 4: one metadata fetch for the repos that were added or enabled;
+    # the others are left to the update's own freshness check
+    fingerprints = freshness.repo_fingerprints()
+    new_repos = [
+        repo_id
+        for repo_id, digest in fingerprints.items()
+        if fingerprints_before.get(repo_id) != digest
+    ]
+    if new_repos:
+        util.print_and_log("Fetching metadata for the new repos...")
+        exit_code, _ = util.run_cmd(
+            [ESCALATE, PKG.d, "makecache", "--refresh", *target.dnf_options()]
+            + [f"--repo={repo_id}" for repo_id in new_repos],
+            capture=util.CAPTURE_NONE,
+        )
+        if exit_code == 0:
+            freshness.mark_repos_refreshed(new_repos, fingerprints)
+            util.print_and_log("Repo metadata is ready.")
+        else:
+            util.print_and_log(exit_messages.get(exit_code, "Unexpected return code"))
+            failures.append("metadata refresh")
 
-    # Enable zen copr
-    enable_zen_copr()
+    clients = client_packages()
+    if clients:
+        pkgs = " ".join(clients["repo clients"])
+        util.print_and_log(f"{pkgs} will be installed with the other packages.")
 
-    # Enable openH264 repo
-    enable_openh264_repo()
+    if failures:
+        raise RuntimeError(f"Repo setup failed: {', '.join(failures)}")
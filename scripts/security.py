@@ -1,19 +1,45 @@
 from pathlib import Path
+from utils import cache
 from utils import common as util
+from utils import installed
+from utils import privileged
+from utils import target
 from utils.aliases import ESCALATE, PKG
 
+SYSCTL_SETTINGS = [
+    "net.ipv4.icmp_echo_ignore_broadcasts = 1\n",
+    "net.ipv4.conf.all.accept_source_route = 0\n",
+    "net.ipv4.tcp_syncookies = 1\n",
+    "net.ipv4.conf.all.accept_redirects = 0\n",
+    "net.ipv4.conf.all.send_redirects = 0\n",
+    "net.ipv4.conf.all.rp_filter = 1\n",
+    "net.ipv4.conf.all.log_martians = 1\n",
+]
+SYSCTL_CONF = Path("/etc/sysctl.d/99-laptop-hardening.conf")
+PORTMASTER_URL = (
+    "https://updates.safing.io/latest/linux_amd64/packages/portmaster-installer.rpm"
+)
+
+# ufw default policies as they appear in /etc/default/ufw
+UFW_DEFAULTS = {
+    "DEFAULT_INPUT_POLICY": "DROP",
+    "DEFAULT_OUTPUT_POLICY": "ACCEPT",
+}
+
 
 def enable_and_configure_ufw():
     """A function to enable and configure UFW firewall settings"""
     util.print_and_log("Confirming presence of UFW...")
-    exit_code, _ = util.run_cmd([PKG.d, "list", "installed", "ufw"])
-    if exit_code != 0:
+    if not installed.is_installed("ufw"):
         util.print_and_log("UFW not found. Installing...")
-        install_code, _ = util.run_cmd([ESCALATE, PKG.d, "install", "ufw"])
-        if install_code == 0:
-            util.print_and_log("UFW has now been installed.")
-        else:
-            util.print_and_log("UFW failed install. please try manually.")
+        install_code, _ = util.run_cmd(
+            [ESCALATE, PKG.d, "install", "-y", *target.dnf_options(), "ufw"],
+            capture=util.CAPTURE_NONE,
+        )
+        installed.invalidate()
+        if install_code != 0:
+            raise RuntimeError(f"UFW failed to install (dnf exited {install_code})")
+        util.print_and_log("UFW has now been installed.")
     else:
         util.print_and_log("UFW is on your system. Let's configure it.")
 
@@ -39,7 +65,9 @@ def enable_and_configure_ufw():
     util.print_and_log("UFW is now enabled. Firewall status checked!")
 
     util.print_and_log("Enabling and starting UFW systemd service...")
-    util.run_cmd([ESCALATE, "systemctl", "enable", "--now", "ufw"])
+    exit_code, _ = util.run_cmd([ESCALATE, "systemctl", "enable", "--now", "ufw"])
+    if exit_code != 0:
+        raise RuntimeError(f"Enabling the ufw service failed (exited {exit_code})")
 
 
 def sysctl_system_hardening():
@@ -47,44 +75,37 @@ def sysctl_system_hardening():
 
     util.print_and_log("Updating sysctl settings...")
 
-    sysctl_settings = [
-        "net.ipv4.icmp_echo_ignore_broadcasts = 1\n",
-        "net.ipv4.conf.all.accept_source_route = 0\n",
-        "net.ipv4.tcp_syncookies = 1\n",
-        "net.ipv4.conf.all.accept_redirects = 0\n",
-        "net.ipv4.conf.all.send_redirects = 0\n",
-        "net.ipv4.conf.all.rp_filter = 1\n",
-        "net.ipv4.conf.all.log_martians = 1\n",
-    ]
-
-    temp_conf = Path("/tmp/99-laptop-hardening.conf")
-    sysctl_harden_conf = Path("/etc/sysctl.d/99-laptop-hardening.conf")
-
-    # Write to a temp file first
-    with temp_conf.open("w") as file:
-        file.writelines(sysctl_settings)
-
-    # Move it into place with sudo
-    move_exit_code, _ = util.run_cmd(
-        [ESCALATE, "mv", str(temp_conf), str(sysctl_harden_conf)]
-    )
-
-    if move_exit_code == 0:
-        util.print_and_log("Sysctl config moved successfully.")
-    else:
-        util.print_and_log("Sysctl config move failed. Please check manually.")
+    # Written atomically as root, no temp file in /tmp
+    errors = privileged.write_file(target.path(SYSCTL_CONF), "".join(SYSCTL_SETTINGS))
+    if errors:
+        raise RuntimeError(f"Sysctl config write failed: {'; '.join(errors)}")
+    util.print_and_log("Sysctl config written successfully.")
 
+    if not target.is_host():
+        util.print_and_log("sysctl settings will apply when the image boots.")
+        return
     util.run_cmd([ESCALATE, "sysctl", "--system"])
     util.print_and_log("sysctl settings have been updated.")
 
 
 def enable_fail2ban():
     """Simple command to enable fail2ban if installed"""
-    exit_code, _ = util.run_cmd([PKG.d, "list", "installed", "fail2ban"])
-    if exit_code == 0:
+    if installed.is_installed("fail2ban") and not target.is_host():
+        # Nothing is running in an install root; just enable it for boot
+        util.print_and_log("Enabling Fail2ban in the install root...")
+        exit_code, _ = util.run_cmd(
+            [ESCALATE, "systemctl", f"--root={target.root()}", "enable", "fail2ban"]
+        )
+        if exit_code != 0:
+            raise RuntimeError(f"Enabling fail2ban failed (exited {exit_code})")
+    elif installed.is_installed("fail2ban"):
         util.print_and_log("Enabling Fail2ban...")
         util.run_cmd([ESCALATE, "systemctl", "start", "fail2ban"])
-        util.run_cmd([ESCALATE, "systemctl", "enable", "--now", "fail2ban"])
+        exit_code, _ = util.run_cmd(
+            [ESCALATE, "systemctl", "enable", "--now", "fail2ban"]
+        )
+        if exit_code != 0:
+            raise RuntimeError(f"Enabling fail2ban failed (exited {exit_code})")
         _, status = util.run_cmd(
             [ESCALATE, "systemctl", "status", "fail2ban", "--no-pager"]
         )
@@ -96,12 +117,17 @@ def enable_fail2ban():
 
 def install_portmaster():
     util.print_and_log("Starting Portmaster install...")
-    url = (
-        "https://updates.safing.io/latest/linux_amd64/packages/portmaster-installer.rpm"
+    try:
+        rpm_path = cache.fetch(PORTMASTER_URL)
+    except Exception as e:
+        raise RuntimeError(f"Failed to download Portmaster: {e}") from e
+    install_code, _ = util.run_cmd(
+        [ESCALATE, PKG.d, "install", "-y", *target.dnf_options(), str(rpm_path)],
+        capture=util.CAPTURE_NONE,
     )
-    util.run_cmd(["curl", "-L", "-o", "/tmp/portmaster.rpm", url])
-    util.run_cmd([ESCALATE, PKG.d, "install", "-y", "/tmp/portmaster.rpm"])
-    util.run_cmd(["rm", "/tmp/portmaster.rpm"])
+    installed.invalidate()
+    if install_code != 0:
+        raise RuntimeError(f"Portmaster install failed (dnf exited {install_code})")
     util.print_and_log("Portmaster installed and ready")
 
 
@@ -1,37 +1,171 @@
+from utils import aio
 from utils import common as util
+from utils import freshness
+from utils import target
 from utils.aliases import exit_messages, ESCALATE, PKG
 
+# Upper bounds so a hung mirror can't stall the bootstrap forever
+UPDATE_TIMEOUT = 2 * 60 * 60
+CLEAN_TIMEOUT = 30 * 60
+
+
+async def _dnf_update(stale, full_refresh):
+    """Refresh the stale repos' metadata, then upgrade from cached metadata.
+    With full_refresh every repo is refreshed as part of the upgrade."""
+    if not full_refresh and stale:
+        refresh, _ = await aio.run(
+            [ESCALATE, PKG.d, "makecache", "--refresh", *target.dnf_options()]
+            + [f"--repo={repo_id}" for repo_id in stale],
+            resource="dnf",
+            timeout=UPDATE_TIMEOUT,
+            capture=util.CAPTURE_NONE,
+            label="dnf",
+        )
+        if refresh != 0:
+            util.print_and_log("Partial metadata refresh failed; refreshing all repos.")
+            full_refresh = True
+
+    cmd = [ESCALATE, PKG.d, "upgrade", "-y", *target.dnf_options()]
+    if full_refresh:
+        cmd.insert(3, "--refresh")
+    exit_code, _ = await aio.run(
+        cmd,
+        resource="dnf",
+        timeout=UPDATE_TIMEOUT,
+        capture=util.CAPTURE_NONE,
+        label="dnf",
+    )
+    return exit_code, full_refresh
+
+
+async def _skipped(exit_code=0):
+    return exit_code, None
+
 
 def full_system_update():
-    """Run a full system update."""
-    util.print_and_log_header("DNF Update")
-    cmd = [ESCALATE, PKG.d, "upgrade", "--refresh", "-y"]
-    exit_code, output = util.run_cmd(cmd)
+    """Run a full system update. dnf and flatpak update side by side.
+    Raises RuntimeError if either update fails.
+
+    Repo metadata is only refreshed for repos that are new, changed or
+    older than freshness.MAX_AGE, and flatpak update is skipped when no
+    remotes or apps changed since the last one."""
+    util.print_and_log_header("DNF and Flatpak Update")
+
+    fingerprints = freshness.repo_fingerprints()
+    stale = freshness.stale_repos(fingerprints)
+    fresh_count = len(fingerprints) - len(stale)
+    full_refresh = fresh_count == 0
+    if full_refresh:
+        util.print_and_log("Refreshing metadata for all repos.")
+    elif stale:
+        util.print_and_log(
+            f"Refreshing metadata for {len(stale)} new or changed repos "
+            f"({', '.join(stale)}); skipping {fresh_count} fresh repos."
+        )
+    else:
+        util.print_and_log(
+            f"Skipping metadata refresh: all {fresh_count} repos are unchanged "
+            "and were refreshed recently."
+        )
+
+    flatpak_fresh = freshness.flatpak_is_fresh()
+    if flatpak_fresh:
+        util.print_and_log(
+            "Skipping flatpak update: no remotes or apps changed since the last one."
+        )
+        flatpak_update = _skipped()
+    else:
+        flatpak_update = aio.run(
+            target.flatpak_cmd("update", "-y"),
+            resource="flatpak",
+            timeout=UPDATE_TIMEOUT,
+            capture=util.CAPTURE_NONE,
+            label="flatpak",
+        )
+
+    (exit_code, full_refresh), (flatpak_exit_code, _) = aio.run_all(
+        _dnf_update(stale, full_refresh), flatpak_update
+    )
+    # 100 means dnf processed updates; the metadata is fresh either way
+    if exit_code in (0, 100):
+        freshness.mark_repos_refreshed(
+            list(fingerprints) if full_refresh else stale, fingerprints
+        )
     message = exit_messages.get(exit_code, "Unexpected return code")
-    util.print_and_log(message)
+    util.print_and_log(f"DNF Update: {message}")
 
-    util.print_and_log_header("Flatpak Update")
-    flatpak_exit_code, output = util.run_cmd([PKG.f, "update", "-y"])
-    flatpak_code = exit_messages.get(flatpak_exit_code, "Unexpected return code")
-    util.print_and_log(flatpak_code)
+    failures = []
+    if exit_code not in (0, 100):
+        failures.append(f"dnf upgrade exited with {exit_code}")
+    if not flatpak_fresh:
+        if flatpak_exit_code == 0:
+            freshness.mark_flatpak_updated()
+        else:
+            failures.append(f"flatpak update exited with {flatpak_exit_code}")
+        flatpak_code = exit_messages.get(flatpak_exit_code, "Unexpected return code")
+        util.print_and_log(f"Flatpak Update: {flatpak_code}")
+    if failures:
+        raise RuntimeError("; ".join(failures))
+
+
+async def _dnf_clean():
+    """autoremove then clean; both need the dnf lock so they run in turn."""
+    remove, _ = await aio.run(
+        [ESCALATE, PKG.d, "autoremove", "-y", *target.dnf_options()],
+        resource="dnf",
+        timeout=CLEAN_TIMEOUT,
+        capture=util.CAPTURE_NONE,
+        label="dnf",
+    )
+    if not target.is_host():
+        # The dnf cache is shared by every root being built
+        util.print_and_log("Keeping the shared dnf cache; skipping dnf clean.")
+        return remove, 0
+    clean, _ = await aio.run(
+        [ESCALATE, PKG.d, "clean", "all", *target.dnf_options()],
+        resource="dnf",
+        timeout=CLEAN_TIMEOUT,
+        capture=util.CAPTURE_NONE,
+        label="dnf",
+    )
+    return remove, clean
 
 
 def system_clean():
-    """A function to run through DNF system clean of orphan packages."""
-    util.print_and_log_header("Remove Orphaned Packages")
-    remove, output = util.run_cmd([ESCALATE, PKG.d, "autoremove", "-y"])
+    """A function to run through DNF system clean of orphan packages.
+    Unused flatpaks are removed at the same time."""
+    util.print_and_log_header("Remove Orphans, Clean DNF Cache, Clean Flatpaks")
+    (remove, clean), (flatpak_clean, _) = aio.run_all(
+        _dnf_clean(),
+        aio.run(
+            target.flatpak_cmd("uninstall", "--unused", "-y"),
+            resource="flatpak",
+            timeout=CLEAN_TIMEOUT,
+            capture=util.CAPTURE_NONE,
+            label="flatpak",
+        ),
+    )
+
     message_remove = exit_messages.get(remove, "Unexpected return code")
-    util.print_and_log(message_remove)
+    util.print_and_log(f"Remove Orphaned Packages: {message_remove}")
 
-    util.print_and_log_header("Clean DNF Cache")
-    clean, output = util.run_cmd([ESCALATE, PKG.d, "clean", "all"])
     message_clean = exit_messages.get(clean, "Unexpected return code")
-    util.print_and_log(message_clean)
+    util.print_and_log(f"Clean DNF Cache: {message_clean}")
 
-    util.print_and_log_header("Cleaning Unused Flatpaks")
-    flatpak_clean, output = util.run_cmd([PKG.f, "uninstall", "--unused", "-y"])
     flatpak_code = exit_messages.get(flatpak_clean, "Unexpected return code")
-    util.print_and_log(flatpak_code)
+    util.print_and_log(f"Cleaning Unused Flatpaks: {flatpak_code}")
+
+    failed = [
+        name
+        for name, code in (
+            ("dnf autoremove", remove),
+            ("dnf clean", clean),
+            ("flatpak uninstall --unused", flatpak_clean),
+        )
+        if code != 0
+    ]
+    if failed:
+        raise RuntimeError(f"{', '.join(failed)} failed")
 
 
 def optimize_dnf():
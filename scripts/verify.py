@@ -1,7 +1,48 @@
+import argparse
 import subprocess
 import json
+import shutil
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from types import SimpleNamespace
+
+# Allow running as `python3 scripts/verify.py` from the repo root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scripts.security import SYSCTL_CONF, SYSCTL_SETTINGS  # noqa: E402
+from utils import common as util  # noqa: E402
+from utils import history  # noqa: E402
+from utils import inotify  # noqa: E402
+from utils import installed  # noqa: E402
+from utils import logger  # noqa: E402
+
+CHECK_WORKERS = 8
+
+HOME_DIRECTORIES = ["archive", "bin", "dev", "docs", "media", "tmp", "logarchive"]
+
+# What --watch watches, by the input tag checks declare. Files are watched
+# through their directory, see utils/inotify.py.
+WATCHED_INPUTS = {
+    "user-dirs": [Path.home() / ".config" / "user-dirs.dirs"],
+    "rpmdb": [Path("/usr/lib/sysimage/rpm"), Path("/var/lib/rpm")],
+    "flatpak": installed.FLATPAK_APP_DIRS + [Path("/var/lib/flatpak")],
+    "vconsole": [Path("/etc/vconsole.conf")],
+    "sysctl": [SYSCTL_CONF.parent],
+}
+# Inputs where only an entry appearing or disappearing matters. Home sees
+# constant writes (shell history, editor swap files) that checks don't read.
+WATCHED_ENTRIES = {
+    "home": [Path.home() / dir_name for dir_name in HOME_DIRECTORIES],
+}
+
+# systemd has no cheap change feed; poll it this often in --watch mode
+SYSTEMD_POLL_SECONDS = 60
+# Let a burst of changes (a dnf transaction) settle before re-checking,
+# but act on a never-ending one after this long anyway
+SETTLE_SECONDS = 1.0
+MAX_SETTLE_SECONDS = 10.0
 
 
 # Utility functions
@@ -25,21 +66,46 @@ def check_user_dirs(expected_mappings):
     return True
 
 
-def check_package_installed(package_name):
-    result = subprocess.run(["rpm", "-q", package_name], stdout=subprocess.DEVNULL)
-    if result.returncode == 0:
+def service_states(service_names):
+    """Ask systemd about every service in one call: {name: state}."""
+    if not service_names:
+        return {}
+    _, output = util.query_cmd(["systemctl", "is-active", *service_names])
+    states = output.splitlines()
+    states += ["unknown"] * (len(service_names) - len(states))
+    return dict(zip(service_names, states))
+
+
+def collect_facts(services):
+    """Gather the bulk facts every check reads from: one rpm listing, one
+    flatpak listing and one systemd query, run side by side."""
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        rpms = pool.submit(installed.rpm_packages)
+        flatpaks = pool.submit(installed.flatpak_apps)
+        states = pool.submit(service_states, services)
+        return SimpleNamespace(
+            rpms=rpms.result(),
+            flatpaks=flatpaks.result(),
+            services=states.result(),
+        )
+
+
+def check_package_installed(package_name, facts=None):
+    rpms = facts.rpms if facts else installed.rpm_packages()
+    if package_name in rpms:
         return True
     else:
-        doublecheck = subprocess.run(["which", package_name], stdout=subprocess.DEVNULL)
-        return doublecheck.returncode == 0
+        return shutil.which(package_name) is not None
 
 
-def check_flatpak_installed(app_id):
-    result = subprocess.run(["flatpak", "info", app_id], stdout=subprocess.DEVNULL)
-    return result.returncode == 0
+def check_flatpak_installed(app_id, facts=None):
+    flatpaks = facts.flatpaks if facts else installed.flatpak_apps()
+    return app_id in flatpaks
 
 
-def check_service_active(service_name):
+def check_service_active(service_name, facts=None):
+    if facts and service_name in facts.services:
+        return facts.services[service_name] == "active"
     result = subprocess.run(["systemctl", "is-active", "--quiet", service_name])
     return result.returncode == 0
 
@@ -53,52 +119,39 @@ def check_vconsole_font(expected_font):
         return False
 
 
-def log_message(message):
-    """Logs the verification check for future records"""
-    logpath = Path.home() / ".local" / "var" / "log" / "pybootstrap"
+def check_sysctl_conf(expected_settings):
     try:
-        logpath.mkdir(parents=True, exist_ok=True)
-    except Exception as e:
-        print(f"Failed to create log file location: {e}")
-
-    logfile = logpath / "bootstrap-verify.log"
-    with open(logfile, "a") as log:
-        log.write(message + "\n")
-
-
-def print_and_log(message):
-    """Prints and logs the message"""
-    print(message)
-    log_message(message)
+        with open(SYSCTL_CONF, "r") as file:
+            contents = file.read()
+    except FileNotFoundError:
+        return False
+    return all(setting in contents for setting in expected_settings)
 
 
-def print_and_log_header(label):
-    """Prints headers for sections and adds to the logfile"""
-    logpath = Path.home() / ".local" / "var" / "log" / "pybootstrap"
+def run_check(check):
+    """Run one check, returning (description, passed, seconds)."""
+    description, func, args, _ = check
+    start = time.perf_counter()
     try:
-        logpath.mkdir(parents=True, exist_ok=True)
+        passed = bool(func(*args))
     except Exception as e:
-        print(f"Failed to create log file location: {e}")
-
-    line = "#" + "=" * (len(label) + 4)
-    block = f"{line}\n#  {label}  #\n{line}\n"
-    print(block)
+        util.log_line(f"Check {description!r} raised {e}")
+        passed = False
+    return description, passed, time.perf_counter() - start
 
-    logfile = logpath / "bootstrap-verify.log"
-    with open(logfile, "a") as log:
-        log.write(block + "\n")
 
-
-# Main test functions
-def main():
+def build_checks(facts):
+    """Every check as (description, function, args, inputs), in report order.
+    inputs are the WATCHED_INPUTS tags (plus "systemd") the check reads."""
     checks = []
 
     # Directory checks
     home = Path.home()
-    directories = ["archive", "bin", "dev", "docs", "media", "tmp", "logarchive"]
-    for dir_name in directories:
+    for dir_name in HOME_DIRECTORIES:
         path = home / dir_name
-        checks.append((f"Directory exists: {path}", check_path_exists(path)))
+        checks.append(
+            (f"Directory exists: {path}", check_path_exists, (path,), {"home"})
+        )
 
     # After other checks
     expected_mappings = {
@@ -113,7 +166,12 @@ def main():
     }
 
     checks.append(
-        ("User directories remapped correctly", check_user_dirs(expected_mappings))
+        (
+            "User directories remapped correctly",
+            check_user_dirs,
+            (expected_mappings,),
+            {"user-dirs"},
+        )
     )
 
     # Package checks (add as needed)
@@ -129,54 +187,210 @@ def main():
                         checks.append(
                             (
                                 f"DNF Package installed: {pkg}",
-                                check_package_installed(pkg),
+                                check_package_installed,
+                                (pkg, facts),
+                                {"rpmdb"},
                             )
                         )
 
             case "flatpak":
                 for pkg in segment:
                     checks.append(
-                        (f"Flatpak App installed: {pkg}", check_flatpak_installed(pkg))
+                        (
+                            f"Flatpak App installed: {pkg}",
+                            check_flatpak_installed,
+                            (pkg, facts),
+                            {"flatpak"},
+                        )
                     )
 
     # Service checks
-    services = ["fail2ban", "ufw"]
-    for service in services:
-        checks.append((f"Service active: {service}", check_service_active(service)))
+    for service in SERVICES:
+        checks.append(
+            (
+                f"Service active: {service}",
+                check_service_active,
+                (service, facts),
+                {"systemd"},
+            )
+        )
 
     # Console font check
-    checks.append(("Console font set correctly", check_vconsole_font("ter-v32b")))
+    checks.append(
+        (
+            "Console font set correctly",
+            check_vconsole_font,
+            ("ter-v32b",),
+            {"vconsole"},
+        )
+    )
+
+    # Hardening sysctl check
+    checks.append(
+        (
+            "Hardening sysctl settings present",
+            check_sysctl_conf,
+            ([setting.strip() for setting in SYSCTL_SETTINGS],),
+            {"sysctl"},
+        )
+    )
+    return checks
+
+
+SERVICES = ["fail2ban", "ufw"]
+
+
+# Main test functions
+def main():
+    started = time.time()
+    facts_start = time.perf_counter()
+    facts = collect_facts(SERVICES)
+    facts_time = time.perf_counter() - facts_start
+    util.log_line(
+        f"Collected facts in {facts_time * 1000:.0f} ms: {len(facts.rpms)} rpms, "
+        f"{len(facts.flatpaks)} flatpaks, {len(facts.services)} services"
+    )
+
+    # pool.map keeps results in the same order as the checks
+    checks = build_checks(facts)
+    with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as pool:
+        results = list(pool.map(run_check, checks))
 
     # Results
     success = 0
     fail = 0
     print("\nPost-Bootstrap Verification Results:\n" + "=" * 40)
-    print_and_log_header("Post-Bootstrap Verification Results:")
-    for description, result in checks:
+    util.print_and_log_header("Post-Bootstrap Verification Results:")
+    for description, result, seconds in results:
+        timing = f"({seconds * 1000:.1f} ms)"
         if result:
-            print_and_log(f"✅ {description}")
+            util.print_and_log(f"✅ {description} {timing}")
             success += 1
         else:
-            print_and_log(f"❌ {description}")
+            util.print_and_log(f"❌ {description} {timing}")
             fail += 1
 
-    print_and_log("=" * 40)
-    print_and_log(f"Summary: {success} passed, {fail} failed.")
+    util.print_and_log("=" * 40)
+    util.print_and_log(f"Summary: {success} passed, {fail} failed.")
+    history.record_run(
+        "verify", started, "failed" if fail else "passed", checks=results
+    )
+    return results
+
+
+def emit(event, **fields):
+    """Write one drift event as a JSON line to stdout and the log."""
+    line = json.dumps({"event": event, "time": time.time(), **fields})
+    print(line, flush=True)
+    util.log_line(line)
+
+
+def refresh_facts(facts, changed):
+    """Re-read the facts behind the changed inputs, in place so the checks
+    (which hold facts) see them."""
+    if "rpmdb" in changed:
+        installed.invalidate()
+        facts.rpms = installed.rpm_packages()
+    if "flatpak" in changed:
+        installed.invalidate_flatpaks()
+        facts.flatpaks = installed.flatpak_apps()
+
+
+def watch():
+    """Check once, then keep the facts in memory and re-run only the checks
+    whose inputs changed, emitting an event whenever a result flips."""
+    facts = collect_facts(SERVICES)
+    checks = build_checks(facts)
+    with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as pool:
+        results = list(pool.map(run_check, checks))
+    state = {description: passed for description, passed, _ in results}
+    emit(
+        "baseline",
+        passed=sum(state.values()),
+        failed=[description for description, passed in state.items() if not passed],
+    )
+
+    watcher = inotify.Watcher()
+    for tag, paths in WATCHED_INPUTS.items():
+        watched = [path for path in paths if watcher.add(path, tag)]
+        util.log_line(f"Watching {tag}: {', '.join(map(str, watched)) or 'nothing'}")
+    for tag, paths in WATCHED_ENTRIES.items():
+        watched = [
+            path
+            for path in paths
+            if watcher.add(path, tag, mask=inotify.ENTRY_MASK, entry=True)
+        ]
+        util.log_line(f"Watching {tag}: {', '.join(map(str, watched)) or 'nothing'}")
+
+    next_poll = time.monotonic() + SYSTEMD_POLL_SECONDS
+    try:
+        while True:
+            changed = watcher.poll(max(0.0, next_poll - time.monotonic()))
+            if changed:
+                # Collect the rest of a burst before acting on it
+                deadline = min(next_poll, time.monotonic() + MAX_SETTLE_SECONDS)
+                while (remaining := deadline - time.monotonic()) > 0:
+                    more = watcher.poll(min(SETTLE_SECONDS, remaining))
+                    if not more:
+                        break
+                    changed |= more
+            if time.monotonic() >= next_poll:
+                next_poll = time.monotonic() + SYSTEMD_POLL_SECONDS
+                services = service_states(SERVICES)
+                if services != facts.services:
+                    facts.services = services
+                    changed.add("systemd")
+            if not changed:
+                continue
+
+            refresh_facts(facts, changed)
+            affected = [check for check in checks if check[3] & changed]
+            with ThreadPoolExecutor(max_workers=CHECK_WORKERS) as pool:
+                results = list(pool.map(run_check, affected))
+            for (description, passed, _), check in zip(results, affected):
+                if passed != state[description]:
+                    emit(
+                        "drift" if not passed else "restored",
+                        check=description,
+                        passed=passed,
+                        inputs=sorted(check[3] & changed),
+                    )
+                state[description] = passed
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="verify", description="Check a bootstrapped machine."
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="keep running and print JSON events when checks change",
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    logger.install_signal_handlers()
+    util.set_logfile_name("bootstrap-verify.log")
+    if parse_args().watch:
+        watch()
+        sys.exit(0)
     start_time = time.time()
     main()
     end_time = time.time()
 
     duration = end_time - start_time
     minutes, seconds = divmod(duration, 60)
-    print_and_log(
+    util.print_and_log(
         f"Verification completed in {int(minutes)} minutes and {int(seconds)} seconds."
     )
 
     print("Opening report card for review...")
-    log_path = (
-        Path.home() / ".local" / "var" / "log" / "pybootstrap" / "bootstrap-verify.log"
-    )
+    util.get_log_writer().flush()
+    log_path = util.get_logfile_path()
     subprocess.run(["xdg-open", str(log_path)])
@@ -0,0 +1,295 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import weakref
+from contextlib import nullcontext
+from types import SimpleNamespace
+from utils import common as util
+from utils import privileged
+from utils import progress
+from utils import trace
+from utils.aliases import ESCALATE
+
+# asyncio command engine, alongside the synchronous util.run_cmd. Commands
+# can run concurrently, each with an optional timeout, and are limited per
+# resource (at most one dnf at a time, a few downloads, ...). Every child
+# gets its own process group so a timeout or cancellation kills the whole
+# tree, not just the sudo in front of it. It stays in our session: sudo
+# ties cached credentials to the controlling terminal, and a new session
+# would have none. From a background group sudo can't prompt for a
+# password, so it runs with -n and fails fast once the cached credentials
+# expire. Ctrl-C doesn't reach these groups either; the entry point calls
+# kill_all() on KeyboardInterrupt. Output from concurrent children is
+# written to the terminal and log one complete line at a time so lines
+# never interleave mid-way.
+#
+# Stage functions move onto it one at a time; see system.full_system_update.
+
+RESOURCE_LIMITS = {
+    "dnf": 1,
+    "flatpak": 1,
+    "download": 4,
+}
+
+# Exit code reported for a command killed by its timeout, as timeout(1) does
+TIMEOUT_EXIT = 124
+KILL_GRACE_SECONDS = 5
+
+_semaphores = weakref.WeakKeyDictionary()
+# Process groups of running local children -> whether they run as root
+_groups = {}
+
+
+def _semaphore(resource):
+    """Per-event-loop semaphore for a resource."""
+    loop = asyncio.get_running_loop()
+    per_loop = _semaphores.setdefault(loop, {})
+    if resource not in per_loop:
+        per_loop[resource] = asyncio.Semaphore(RESOURCE_LIMITS.get(resource, 1))
+    return per_loop[resource]
+
+
+def _sudo_kill_argv(pgid, sig):
+    """kill for a root-owned process group, through sudo without prompting."""
+    return [
+        ESCALATE,
+        "-n",
+        "kill",
+        "-s",
+        sig.name.removeprefix("SIG"),
+        "--",
+        f"-{pgid}",
+    ]
+
+
+async def _signal_group(pgid, sig, escalate):
+    """Send sig to a process group. Root-owned groups (escalate, or ones we
+    aren't allowed to signal) are signalled through sudo without prompting.
+    Returns False once the group is gone."""
+    if not escalate:
+        try:
+            os.killpg(pgid, sig)
+            return True
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    killer = await asyncio.create_subprocess_exec(
+        *_sudo_kill_argv(pgid, sig),
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    return await killer.wait() == 0
+
+
+def kill_all(sig=signal.SIGTERM):
+    """Signal every running child's process group, from any thread. The
+    event loops running them are busy elsewhere, so this doesn't wait."""
+    for pgid, escalate in list(_groups.items()):
+        if not escalate:
+            try:
+                os.killpg(pgid, sig)
+                continue
+            except ProcessLookupError:
+                continue
+            except PermissionError:
+                pass
+        subprocess.run(
+            _sudo_kill_argv(pgid, sig),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+
+async def _kill_group(process, escalate=False):
+    """SIGTERM the child's process group, SIGKILL it if it lingers."""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if not await _signal_group(process.pid, sig, escalate):
+            return
+        try:
+            await asyncio.wait_for(process.wait(), KILL_GRACE_SECONDS)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+
+def _command_name(cmd):
+    """Short label for a command, looking past sudo."""
+    parts = [str(part) for part in cmd]
+    if parts[0] == ESCALATE and len(parts) > 1:
+        parts = parts[1:]
+    return os.path.basename(parts[0])
+
+
+def _emit(label, lines):
+    """Write whole lines to the terminal and log in one go."""
+    prefix = f"[{label}] " if label else ""
+    # In progress mode the status line already showed them
+    if not progress.enabled():
+        sys.stdout.write("".join(f"{prefix}{line}\n" for line in lines))
+        sys.stdout.flush()
+    # log_lines already tags lines with the current stage
+    if label == util.current_stage():
+        prefix = ""
+    util.log_lines([f"{prefix}{line}" for line in lines])
+
+
+def _loop_queue(loop, messages):
+    """Something with put() that the helper's reader thread can feed an
+    asyncio queue through."""
+
+    def put(message):
+        try:
+            loop.call_soon_threadsafe(messages.put_nowait, message)
+        except RuntimeError:
+            # Loop already closed; nobody is waiting any more
+            pass
+
+    return SimpleNamespace(put=put)
+
+
+async def _pump(read, label, capture, on_line):
+    """Read output chunks, emit complete lines, keep what capture asks for."""
+    kept = bytearray()
+    pending = b""
+    output_bytes = 0
+    while chunk := await read():
+        output_bytes += len(chunk)
+        progress.output(label, chunk)
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        if len(pending) > util.READ_SIZE:
+            lines.append(pending)
+            pending = b""
+        if lines:
+            decoded = [line.decode(errors="replace").rstrip("\r") for line in lines]
+            _emit(label, decoded)
+            if on_line:
+                for line in decoded:
+                    on_line(line)
+
+        if capture in (util.CAPTURE_FULL, util.CAPTURE_TAIL):
+            kept += chunk
+            too_long = len(kept) > 2 * util.CAPTURE_TAIL_BYTES
+            if capture == util.CAPTURE_TAIL and too_long:
+                del kept[: -util.CAPTURE_TAIL_BYTES]
+
+    if pending:
+        line = pending.decode(errors="replace").rstrip("\r")
+        _emit(label, [line])
+        if on_line:
+            on_line(line)
+
+    if capture == util.CAPTURE_TAIL:
+        del kept[: -util.CAPTURE_TAIL_BYTES]
+    return output_bytes, kept.decode(errors="replace")
+
+
+async def _run_local(cmd, label, timeout, capture, on_line, result):
+    argv = [str(part) for part in cmd]
+    escalate = argv[0] == ESCALATE
+    if escalate and argv[1:2] != ["-n"]:
+        argv.insert(1, "-n")
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        process_group=0,
+    )
+    _groups[process.pid] = escalate
+
+    async def read():
+        return await process.stdout.read(util.READ_SIZE)
+
+    try:
+        result.output_bytes, result.output = await asyncio.wait_for(
+            _pump(read, label, capture, on_line), timeout
+        )
+        result.exit_code = await process.wait()
+    except asyncio.TimeoutError:
+        util.print_and_log(f"{label}: timed out after {timeout}s, killing it")
+        await _kill_group(process, escalate)
+        result.exit_code = TIMEOUT_EXIT
+    except asyncio.CancelledError:
+        await _kill_group(process, escalate)
+        raise
+    finally:
+        _groups.pop(process.pid, None)
+
+
+async def _run_helper(argv, label, timeout, capture, on_line, result):
+    """Same as _run_local, but the command runs in the privileged helper."""
+    messages = asyncio.Queue()
+    request_id, _ = privileged.submit(
+        "run", responses=_loop_queue(asyncio.get_running_loop(), messages), argv=argv
+    )
+
+    async def read():
+        message = await messages.get()
+        if message["type"] == "output":
+            return privileged.output_chunk(message)
+        if message["error"]:
+            _emit(label, [message["error"]])
+        result.exit_code = message["exit"]
+        return b""
+
+    try:
+        result.output_bytes, result.output = await asyncio.wait_for(
+            _pump(read, label, capture, on_line), timeout
+        )
+    except asyncio.TimeoutError:
+        util.print_and_log(f"{label}: timed out after {timeout}s, killing it")
+        privileged.kill(request_id)
+        result.exit_code = TIMEOUT_EXIT
+    except asyncio.CancelledError:
+        privileged.kill(request_id)
+        raise
+    finally:
+        privileged.finish(request_id)
+
+
+async def run(
+    cmd,
+    resource=None,
+    timeout=None,
+    capture=util.CAPTURE_TAIL,
+    on_line=None,
+    label=None,
+):
+    """Run cmd asynchronously. Returns (exit_code, output) like run_cmd.
+    A timeout kills the command's process group and yields TIMEOUT_EXIT.
+    sudo commands go through the privileged helper when it is running."""
+    label = label or util.current_stage() or _command_name(cmd)
+    result = SimpleNamespace(exit_code=-1, output_bytes=0, output="")
+
+    async with _semaphore(resource) if resource else nullcontext():
+        start = trace.start_command()
+        helper_argv = privileged.privileged_argv(cmd)
+        try:
+            if helper_argv:
+                await _run_helper(helper_argv, label, timeout, capture, on_line, result)
+            else:
+                await _run_local(cmd, label, timeout, capture, on_line, result)
+        finally:
+            progress.done(label)
+            trace.record_command(
+                cmd,
+                start,
+                result.exit_code,
+                result.output_bytes,
+                stage=util.current_stage(),
+            )
+    return result.exit_code, result.output
+
+
+async def _gather(commands):
+    return await asyncio.gather(*commands)
+
+
+def run_all(*commands):
+    """Run several run() coroutines concurrently from synchronous code and
+    return their results in order."""
+    return asyncio.run(_gather(commands))
@@ -6,12 +6,6 @@ from types import SimpleNamespace
 PROJECT_NAME = "pybootstrap"
 
 
-RPM = {
-    "free": Path("/etc/yum.repos.d/rpmfusion_free.repo"),
-    "nonfree": Path("/etc/yum.repos.d/rpmfusion-nonfree.repo"),
-}
-
-
 ESCALATE = "sudo"
 PKG = SimpleNamespace(
     d="dnf",
@@ -0,0 +1,219 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from pathlib import Path
+from utils import common as util
+from utils import trace
+
+# Persistent download cache shared by every stage. Entries are keyed by URL
+# and stored by content hash, so two URLs serving the same bytes share one
+# blob. Cached entries are revalidated with ETag / Last-Modified and a 304
+# is served straight from disk. The directory can be synced between
+# machines; PYBOOTSTRAP_CACHE_DIR points at an alternative location.
+# With an offline bundle in use (scripts/bundle.py), URLs it contains are
+# served from the bundle and never touch the network.
+
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+# Seconds to wait for a connection or the next chunk before giving up
+DOWNLOAD_TIMEOUT = 60
+
+_lock = threading.Lock()
+_bundle = {}
+
+
+def get_cache_dir():
+    """Gets or makes the download cache directory"""
+    override = os.environ.get("PYBOOTSTRAP_CACHE_DIR")
+    if override:
+        cache_dir = Path(override)
+    else:
+        cache_dir = Path.home() / ".cache" / "pybootstrap"
+    (cache_dir / "objects").mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_max_bytes():
+    """Size bound for the cache; PYBOOTSTRAP_CACHE_MAX_MB overrides it."""
+    override = os.environ.get("PYBOOTSTRAP_CACHE_MAX_MB")
+    if override:
+        return int(override) * 1024 * 1024
+    return DEFAULT_MAX_BYTES
+
+
+@contextmanager
+def _locked_index(cache_dir):
+    """Load the index under a thread and process lock, save it on exit."""
+    index_path = cache_dir / "index.json"
+    with _lock, open(cache_dir / "index.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with index_path.open("r") as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        yield index
+        temp_path = index_path.with_suffix(".tmp")
+        with temp_path.open("w") as file:
+            json.dump(index, file, indent=2)
+        os.replace(temp_path, index_path)
+
+
+def _blob_path(cache_dir, digest, filename):
+    return cache_dir / "objects" / digest / filename
+
+
+def _entry_path(cache_dir, entry):
+    path = _blob_path(cache_dir, entry["sha256"], entry["filename"])
+    return path if path.exists() else None
+
+
+def _download(url, headers, cache_dir, filename):
+    """Fetch url into the cache. Returns (entry, path), or (None, None) on 304."""
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, None
+        raise
+
+    digest = hashlib.sha256()
+    size = 0
+    with (
+        response,
+        tempfile.NamedTemporaryFile(
+            dir=cache_dir, prefix=".download-", delete=False
+        ) as temp_file,
+    ):
+        try:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                temp_file.write(chunk)
+                size += len(chunk)
+            expected = response.headers.get("Content-Length")
+            if expected is not None and size < int(expected):
+                raise urllib.error.ContentTooShortError(
+                    f"{url}: got {size} of {expected} bytes", None
+                )
+        except BaseException:
+            # Don't leave a partial download behind in the cache directory
+            os.unlink(temp_file.name)
+            raise
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+
+    sha256 = digest.hexdigest()
+    path = _blob_path(cache_dir, sha256, filename)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(temp_file.name, path)
+    except OSError:
+        os.unlink(temp_file.name)
+        raise
+
+    entry = {
+        "sha256": sha256,
+        "filename": filename,
+        "size": size,
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched": time.time(),
+    }
+    return entry, path
+
+
+def _evict(cache_dir, index, max_bytes, keep):
+    """Drop least recently used blobs until the cache fits in max_bytes."""
+    blobs = {}
+    for url, entry in index.items():
+        blob = blobs.setdefault(
+            entry["sha256"], {"size": entry["size"], "used": 0, "urls": []}
+        )
+        blob["used"] = max(blob["used"], entry.get("used", 0))
+        blob["urls"].append(url)
+
+    total = sum(blob["size"] for blob in blobs.values())
+    for sha256, blob in sorted(blobs.items(), key=lambda item: item[1]["used"]):
+        if total <= max_bytes:
+            break
+        if sha256 == keep:
+            continue
+        shutil.rmtree(cache_dir / "objects" / sha256, ignore_errors=True)
+        for url in blob["urls"]:
+            del index[url]
+        total -= blob["size"]
+        util.log_line(f"Evicted {sha256[:12]} from download cache")
+
+
+def use_bundle(files):
+    """Serve {url: local path} from an offline bundle from now on."""
+    _bundle.update(files)
+
+
+def fetch(url, filename=None):
+    """Return a local path for url, downloading only if the cached copy is
+    missing or the server says it changed."""
+    start = trace.start_command()
+    if url in _bundle:
+        util.log_line(f"Serving {url} from bundle")
+        trace.record_download(url, start, 0, "bundle")
+        return _bundle[url]
+
+    cache_dir = get_cache_dir()
+    filename = filename or util.get_filename_from_url(url)
+
+    with _locked_index(cache_dir) as index:
+        entry = index.get(url)
+
+    headers = {}
+    if entry and _entry_path(cache_dir, entry):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    else:
+        entry = None
+
+    try:
+        new_entry, path = _download(url, headers, cache_dir, filename)
+    except (urllib.error.URLError, OSError) as e:
+        if entry is None:
+            raise
+        # Offline or server trouble: a stale copy beats no copy
+        util.log_line(f"Revalidation of {url} failed ({e}); using cached copy")
+        new_entry, path = None, None
+
+    with _locked_index(cache_dir) as index:
+        if new_entry is not None:
+            entry = new_entry
+            util.log_line(f"Downloaded {url} ({entry['size']} bytes)")
+        else:
+            entry = index.get(url, entry)
+            path = _entry_path(cache_dir, entry)
+
+        if path is None:
+            # Evicted underneath us; forget it and fetch it fresh
+            index.pop(url, None)
+        else:
+            if new_entry is None:
+                util.log_line(f"Serving {url} from download cache")
+            entry["used"] = time.time()
+            index[url] = entry
+            _evict(cache_dir, index, get_max_bytes(), keep=entry["sha256"])
+
+    if path is None:
+        return fetch(url, filename)
+    if new_entry is not None:
+        trace.record_download(url, start, new_entry["size"], "network")
+    else:
+        trace.record_download(url, start, 0, "cache")
+    return path
@@ -1,61 +1,255 @@
+import os
 import subprocess
+import sys
+import threading
 from pathlib import Path
 from datetime import datetime
+from types import SimpleNamespace
+from utils import logger
+from utils import logs
+from utils import privileged
+from utils import progress
+from utils import trace
 
+LOGFILE_NAME = "bootstrap.log"
 
-def run_cmd(cmd):
-    """A function for running commands and saving their output to logs"""
+# What run_cmd keeps of a command's output
+CAPTURE_NONE = "none"
+CAPTURE_TAIL = "tail"
+CAPTURE_FULL = "full"
+CAPTURE_TAIL_BYTES = 64 * 1024
+READ_SIZE = 64 * 1024
+
+_log_writer = None
+_logfile_path = None
+_logfile_lock = threading.Lock()
+_context = threading.local()
+
+
+def set_stage(name):
+    """Tag everything this thread prints and logs with a stage name."""
+    _context.stage = name
+
+
+def current_stage():
+    return getattr(_context, "stage", None)
+
+
+def _tag(text):
+    """Prefix each line with the current stage, if any."""
+    stage = current_stage()
+    if not stage:
+        return text
+    return "\n".join(f"[{stage}] {line}" if line else line for line in text.split("\n"))
+
+
+def _echo(data, lines, key):
+    """Tee child output to the terminal: the raw chunk data when no stage is
+    set, otherwise only the complete decoded lines, each tagged (a partial
+    line waits in run_cmd's buffer). In progress mode the chunk goes to
+    key's status line instead."""
+    if progress.enabled():
+        progress.output(key, data)
+        return
+    stream = getattr(sys.stdout, "buffer", None)
+    if current_stage() or stream is None:
+        if lines:
+            print(_tag("\n".join(lines)), flush=True)
+        return
+    stream.write(data)
+    stream.flush()
+
+
+def log_lines(lines):
+    """Log a batch of complete output lines as one write."""
+    stamp = f"[{datetime.now()}] "
+    stage = current_stage()
+    if stage:
+        stamp += f"[{stage}] "
+    get_log_writer().write("".join(f"{stamp}{line}\n" for line in lines))
+
+
+def _local_chunks(cmd, result):
+    """Run cmd as a child process and yield its output chunks. Fills in
+    result.exit_code and result.rusage once it exits."""
     process = subprocess.Popen(
         cmd,
         shell=False,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        text=True,
     )
+    fd = process.stdout.fileno()
+    while chunk := os.read(fd, READ_SIZE):
+        yield chunk
+    process.stdout.close()
+    # wait4 instead of wait so the trace gets the child's CPU time
+    _, status, result.rusage = os.wait4(process.pid, 0)
+    result.exit_code = os.waitstatus_to_exitcode(status)
 
-    output = []
-    for line in process.stdout:
-        print(line, end="")
-        log_line(line)
-        output.append(line)
 
-    process.stdout.close()
-    process.wait()
-    return process.returncode, "".join(output)
+def _helper_chunks(argv, result):
+    """Run argv through the privileged helper and yield its output chunks."""
+    request_id, responses = privileged.submit("run", argv=argv)
+    try:
+        while (message := responses.get())["type"] == "output":
+            yield privileged.output_chunk(message)
+    finally:
+        privileged.finish(request_id)
+    if message["error"]:
+        yield f"{message['error']}\n".encode()
+    result.exit_code = message["exit"]
 
 
-def get_logfile_path():
-    """Gets or makes the log file path on the system"""
+def run_cmd(cmd, capture=CAPTURE_TAIL, on_line=None):
+    """A function for running commands and saving their output to logs.
+
+    Output is read in large binary chunks and teed to the terminal and the
+    log as it arrives. capture decides what is kept and returned:
+    CAPTURE_NONE keeps nothing, CAPTURE_TAIL (the default) keeps the last
+    CAPTURE_TAIL_BYTES, CAPTURE_FULL keeps everything. on_line, if given, is
+    called with every decoded output line, so parsers don't need the full
+    text in memory.
+
+    sudo commands go through the privileged helper when it is running."""
+    start = trace.start_command()
+    result = SimpleNamespace(exit_code=-1, rusage=None)
+    helper_argv = privileged.privileged_argv(cmd)
+    if helper_argv:
+        chunks = _helper_chunks(helper_argv, result)
+    else:
+        chunks = _local_chunks(cmd, result)
+
+    key = current_stage() or " ".join(str(part) for part in cmd[:2])
+    kept = bytearray()
+    pending = b""
+    output_bytes = 0
+    for chunk in chunks:
+        output_bytes += len(chunk)
+
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        # Progress bars may never send a newline; don't let them pile up
+        if len(pending) > READ_SIZE:
+            lines.append(pending)
+            pending = b""
+        decoded = [line.decode(errors="replace").rstrip("\r") for line in lines]
+        _echo(chunk, decoded, key)
+        if decoded:
+            log_lines(decoded)
+            if on_line:
+                for line in decoded:
+                    on_line(line)
+
+        if capture == CAPTURE_FULL:
+            kept += chunk
+        elif capture == CAPTURE_TAIL:
+            kept += chunk
+            # Trim in bulk rather than on every chunk
+            if len(kept) > 2 * CAPTURE_TAIL_BYTES:
+                del kept[:-CAPTURE_TAIL_BYTES]
+
+    if pending:
+        line = pending.decode(errors="replace").rstrip("\r")
+        # The raw tee already wrote it; only a tagged echo still owes it
+        _echo(b"", [line], key)
+        log_lines([line])
+        if on_line:
+            on_line(line)
+
+    progress.done(key)
+    trace.record_command(
+        cmd, start, result.exit_code, output_bytes, result.rusage, current_stage()
+    )
+
+    if capture == CAPTURE_TAIL:
+        del kept[:-CAPTURE_TAIL_BYTES]
+    return result.exit_code, kept.decode(errors="replace")
+
+
+def query_cmd(cmd):
+    """Run a read-only query command quietly and return its exit code and
+    stdout. Used for bulk lookups whose output is parsed, not shown."""
+    start = trace.start_command()
+    try:
+        result = subprocess.run(
+            cmd,
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+    except FileNotFoundError:
+        trace.record_command(cmd, start, 127, 0, stage=current_stage())
+        return 127, ""
+    trace.record_command(
+        cmd,
+        start,
+        result.returncode,
+        len(result.stdout.encode()),
+        stage=current_stage(),
+    )
+    return result.returncode, result.stdout
+
+
+def get_log_dir():
+    """Gets or makes the log directory on the system"""
     log_base = Path.home() / ".local" / "var" / "log" / "pybootstrap"
     try:
         log_base.mkdir(parents=True, exist_ok=True)
     except Exception as e:
         print(f"Failed to create log directory: {e}")
-    return log_base / "bootstrap.log"
+    return log_base
+
+
+def get_logfile_path():
+    """This run's log file. The first call starts a new per-run log (see
+    utils/logs.py); LOGFILE_NAME stays a symlink to the newest one."""
+    global _logfile_path
+    with _logfile_lock:
+        if _logfile_path is None:
+            log_dir = get_log_dir()
+            try:
+                _logfile_path = logs.start_run(log_dir, LOGFILE_NAME)
+            except OSError as e:
+                print(f"Failed to start a run log: {e}")
+                _logfile_path = log_dir / LOGFILE_NAME
+        return _logfile_path
+
+
+def set_logfile_name(name):
+    """Switch the log file used by this process, e.g. for verify runs."""
+    global LOGFILE_NAME, _log_writer, _logfile_path
+    LOGFILE_NAME = name
+    _log_writer = None
+    _logfile_path = None
+
+
+def get_log_writer():
+    """Shared background writer for the current log file."""
+    global _log_writer
+    if _log_writer is None:
+        _log_writer = logger.get_writer(get_logfile_path())
+    return _log_writer
 
 
 def print_and_log(message):
     """Simply print message to terminal then log it"""
-    print(message)
+    progress.echo(_tag(str(message)))
     log_line(message)
 
 
 def log_line(message):
     """writes logs to the logfile with timestamps"""
-    logfile = get_logfile_path()
-
-    with open(logfile, "a") as log:
-        log.write(f"[{datetime.now()}] {message}\n")
+    get_log_writer().write(f"[{datetime.now()}] {_tag(str(message))}\n")
 
 
 def print_and_log_header(label):
     """Prints headers for sections and adds to the logfile"""
     line = "#" + "=" * (len(label) + 4)
-    block = f"{line}\n#  {label}  #\n{line}\n"
-    print(block)
-    logfile = get_logfile_path()
-    with open(logfile, "a") as log:
-        log.write(block + "\n")
+    block = _tag(f"{line}\n#  {label}  #\n{line}\n")
+    progress.echo(block)
+    get_log_writer().write(block + "\n")
 
 
 def get_os_version():
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from utils import installed
+from utils import target
+
+# Metadata freshness state. Remembers when each dnf repo's metadata was
+# last refreshed and what its definition looked like at the time, plus a
+# fingerprint of the flatpak remotes and apps at the last flatpak update.
+# Lets a second update in the same bootstrap refresh only the repos that
+# were added or changed since the first one, and skip flatpak entirely
+# when nothing changed.
+
+FLATPAK_REMOTE_CONFIGS = [
+    Path("/var/lib/flatpak/repo/config"),
+    Path.home() / ".local" / "share" / "flatpak" / "repo" / "config",
+]
+
+# Metadata older than this is refreshed even if the repo didn't change.
+# Matches the metadata_expire Fedora ships for its own repos.
+MAX_AGE = 6 * 60 * 60
+
+_lock = threading.Lock()
+
+
+def get_state_path():
+    """Gets or makes the freshness state location"""
+    state_dir = Path.home() / ".local" / "state" / "pybootstrap"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir / target.per_target("freshness.json")
+
+
+def _load():
+    try:
+        with get_state_path().open("r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"repos": {}, "flatpak": None}
+
+
+def _save(state):
+    path = get_state_path()
+    temp_path = path.with_suffix(".tmp")
+    with temp_path.open("w") as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_path, path)
+
+
+def _is_enabled(lines):
+    """A repo section is enabled unless it sets enabled to a false value,
+    the same default dnf uses."""
+    enabled = "1"
+    for line in lines:
+        key, _, value = line.partition("=")
+        if key.strip() == "enabled":
+            enabled = value.strip().lower()
+    return enabled not in ("0", "false", "no", "off")
+
+
+def repo_fingerprints():
+    """{repo id: hash of its section} for every enabled repo on the system.
+    Disabled repos are left out: refreshing one with --repo would enable it
+    for that command."""
+    sections = {}
+    try:
+        repo_files = sorted(target.reposdir().glob("*.repo"))
+    except OSError:
+        repo_files = []
+    for repo_file in repo_files:
+        try:
+            contents = repo_file.read_text()
+        except OSError:
+            continue
+        repo_id = None
+        for line in contents.splitlines():
+            line = line.strip()
+            if line.startswith("[") and line.endswith("]"):
+                repo_id = line[1:-1]
+                sections[repo_id] = []
+            elif repo_id and line and not line.startswith("#"):
+                sections[repo_id].append(line)
+    return {
+        repo_id: hashlib.sha256("\n".join(lines).encode()).hexdigest()
+        for repo_id, lines in sections.items()
+        if _is_enabled(lines)
+    }
+
+
+def stale_repos(fingerprints=None):
+    """Repo ids that are new, changed, or past MAX_AGE since their last
+    refresh."""
+    if fingerprints is None:
+        fingerprints = repo_fingerprints()
+    with _lock:
+        known = _load()["repos"]
+    now = time.time()
+    stale = []
+    for repo_id, digest in fingerprints.items():
+        entry = known.get(repo_id)
+        if (
+            entry is None
+            or entry["fingerprint"] != digest
+            or now - entry["refreshed"] > MAX_AGE
+        ):
+            stale.append(repo_id)
+    return stale
+
+
+def mark_repos_refreshed(repo_ids, fingerprints=None):
+    """Record that the given repos' metadata was just downloaded."""
+    if fingerprints is None:
+        fingerprints = repo_fingerprints()
+    now = time.time()
+    with _lock:
+        state = _load()
+        for repo_id in repo_ids:
+            if repo_id in fingerprints:
+                state["repos"][repo_id] = {
+                    "fingerprint": fingerprints[repo_id],
+                    "refreshed": now,
+                }
+        _save(state)
+
+
+def flatpak_fingerprint():
+    """Hash of the configured remotes and the installed apps."""
+    digest = hashlib.sha256()
+    configs = FLATPAK_REMOTE_CONFIGS
+    if not target.is_host():
+        configs = [target.flatpak_dir() / "repo" / "config"]
+    for config in configs:
+        try:
+            digest.update(config.read_bytes())
+        except OSError:
+            pass
+    for app in sorted(installed.flatpak_apps()):
+        digest.update(app.encode() + b"\n")
+    return digest.hexdigest()
+
+
+def flatpak_is_fresh(fingerprint=None):
+    """True if nothing changed since the last flatpak update and it's
+    recent enough to trust."""
+    if fingerprint is None:
+        fingerprint = flatpak_fingerprint()
+    with _lock:
+        last = _load()["flatpak"]
+    return (
+        last is not None
+        and last["fingerprint"] == fingerprint
+        and time.time() - last["updated"] <= MAX_AGE
+    )
+
+
+def mark_flatpak_updated():
+    """Record the flatpak state right after a successful update."""
+    installed.invalidate_flatpaks()
+    fingerprint = flatpak_fingerprint()
+    with _lock:
+        state = _load()
+        state["flatpak"] = {"fingerprint": fingerprint, "updated": time.time()}
+        _save(state)
@@ -0,0 +1,257 @@
+import json
+import sqlite3
+import statistics
+import time
+from contextlib import closing
+from pathlib import Path
+from utils import common as util
+from utils import target
+from utils import trace
+from utils.aliases import exit_messages
+
+# Run history. Every bootstrap, apply and verify run is recorded in one
+# SQLite database: its stages, the commands it ran, what it downloaded and,
+# for verify, the check results. `main.py history` reads it back to show
+# trends and flag stages that got slower than their recent median.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    started REAL NOT NULL,
+    seconds REAL NOT NULL,
+    status TEXT NOT NULL,
+    downloaded_bytes INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    seconds REAL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    stage TEXT,
+    argv TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    exit_code INTEGER NOT NULL,
+    exit_message TEXT
+);
+CREATE TABLE IF NOT EXISTS downloads (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    url TEXT NOT NULL,
+    source TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checks (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    description TEXT NOT NULL,
+    passed INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_by_name ON stages(name, run_id);
+"""
+
+# A stage regressed if it took this many times its rolling median...
+DEFAULT_THRESHOLD = 1.5
+# ...over this many earlier runs...
+MEDIAN_WINDOW = 5
+# ...and at least this much longer, so sub-second noise isn't flagged
+MIN_REGRESSION_SECONDS = 2.0
+
+
+def get_db_path():
+    """Gets or makes the history database location"""
+    state_dir = Path.home() / ".local" / "state" / "pybootstrap"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir / "history.sqlite"
+
+
+def connect():
+    connection = sqlite3.connect(get_db_path(), timeout=10)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def record_run(kind, started, status, stage_statuses=None, checks=()):
+    """Store a finished run. Stage and command timings and downloads come
+    from the trace; stage_statuses adds stages that didn't run (resumed,
+    skipped) and checks is verify's [(description, passed, seconds)].
+    Returns the run id."""
+    stage_statuses = dict(stage_statuses or {})
+    stage_spans = trace.events("stage")
+    command_spans = trace.events("command")
+    download_spans = trace.events("download")
+    downloaded = sum(
+        e["args"]["bytes"] for e in download_spans if e["args"]["source"] == "network"
+    )
+
+    with closing(connect()) as connection, connection:
+        run_id = connection.execute(
+            "INSERT INTO runs (kind, target, started, seconds, status, "
+            "downloaded_bytes) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                kind,
+                target.slug() or "host",
+                started,
+                time.time() - started,
+                status,
+                downloaded,
+            ),
+        ).lastrowid
+
+        timed = set()
+        for event in stage_spans:
+            timed.add(event["name"])
+            connection.execute(
+                "INSERT INTO stages VALUES (?, ?, ?, ?)",
+                (
+                    run_id,
+                    event["name"],
+                    stage_statuses.get(event["name"], "done"),
+                    event["dur"] / 1_000_000,
+                ),
+            )
+        connection.executemany(
+            "INSERT INTO stages VALUES (?, ?, ?, NULL)",
+            [
+                (run_id, name, stage_status)
+                for name, stage_status in stage_statuses.items()
+                if name not in timed
+            ],
+        )
+        connection.executemany(
+            "INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    run_id,
+                    e["args"].get("stage"),
+                    json.dumps(e["args"]["argv"]),
+                    e["dur"] / 1_000_000,
+                    e["args"]["exit_code"],
+                    exit_messages.get(e["args"]["exit_code"]),
+                )
+                for e in command_spans
+            ],
+        )
+        connection.executemany(
+            "INSERT INTO downloads VALUES (?, ?, ?, ?, ?)",
+            [
+                (
+                    run_id,
+                    e["args"]["url"],
+                    e["args"]["source"],
+                    e["args"]["bytes"],
+                    e["dur"] / 1_000_000,
+                )
+                for e in download_spans
+            ],
+        )
+        connection.executemany(
+            "INSERT INTO checks VALUES (?, ?, ?, ?)",
+            [
+                (run_id, description, int(passed), seconds)
+                for description, passed, seconds in checks
+            ],
+        )
+    return run_id
+
+
+def earlier_durations(connection, run_id, name, window=MEDIAN_WINDOW):
+    """How long stage name took in the window runs before run_id of the same
+    kind and target, newest first."""
+    return [
+        row[0]
+        for row in connection.execute(
+            "SELECT stages.seconds FROM stages JOIN runs ON runs.id = run_id "
+            "WHERE name = ? AND stages.status = 'done' "
+            "AND stages.seconds IS NOT NULL AND run_id < ? "
+            "AND (kind, target) = (SELECT kind, target FROM runs WHERE id = ?) "
+            "ORDER BY run_id DESC LIMIT ?",
+            (name, run_id, run_id, window),
+        )
+    ]
+
+
+def regressions(connection, run_id, threshold=DEFAULT_THRESHOLD):
+    """Stages of run_id that took more than threshold times their median
+    over the previous MEDIAN_WINDOW runs. Returns [(stage, seconds, median)]."""
+    flagged = []
+    latest = connection.execute(
+        "SELECT name, seconds FROM stages WHERE run_id = ? AND seconds IS NOT NULL",
+        (run_id,),
+    ).fetchall()
+    for name, seconds in latest:
+        earlier = earlier_durations(connection, run_id, name)
+        if not earlier:
+            continue
+        median = statistics.median(earlier)
+        if seconds > median * threshold and seconds - median >= MIN_REGRESSION_SECONDS:
+            flagged.append((name, seconds, median))
+    return flagged
+
+
+def show(limit=10, threshold=DEFAULT_THRESHOLD):
+    """Print recent runs and the latest run's stages against their median."""
+    if not get_db_path().exists():
+        print("No runs recorded yet.")
+        return
+    with closing(connect()) as connection:
+        runs = connection.execute(
+            "SELECT id, kind, target, started, seconds, status, downloaded_bytes "
+            "FROM runs ORDER BY id DESC LIMIT ?",
+            (limit,),
+        ).fetchall()
+        if not runs:
+            print("No runs recorded yet.")
+            return
+
+        print(
+            f"{'run':>5}  {'when':<16}  {'kind':<9}  {'target':<18}  "
+            f"{'took':>8}  {'MiB':>7}  status"
+        )
+        for run_id, kind, target_slug, started, seconds, status, downloaded in runs:
+            when = time.strftime("%Y-%m-%d %H:%M", time.localtime(started))
+            failed = connection.execute(
+                "SELECT COUNT(*) FROM checks WHERE run_id = ? AND passed = 0",
+                (run_id,),
+            ).fetchone()[0]
+            if failed:
+                status = f"{status}, {failed} checks failed"
+            print(
+                f"{run_id:>5}  {when:<16}  {kind:<9}  {target_slug[:18]:<18}  "
+                f"{seconds:>7.1f}s  {downloaded / (1024 * 1024):>7.1f}  {status}"
+            )
+
+        # Verify runs have no stages; show the newest run that does
+        latest = connection.execute(
+            "SELECT MAX(run_id) FROM stages WHERE seconds IS NOT NULL"
+        ).fetchone()[0]
+        if latest is None:
+            return
+        flagged = {
+            name: median
+            for name, _, median in regressions(connection, latest, threshold)
+        }
+        stages = connection.execute(
+            "SELECT name, status, seconds FROM stages WHERE run_id = ? "
+            "ORDER BY seconds DESC",
+            (latest,),
+        ).fetchall()
+        if stages:
+            print(f"\nStages of run {latest}:")
+        for name, status, seconds in stages:
+            took = f"{seconds:7.1f}s" if seconds is not None else f"{status:>8}"
+            earlier = earlier_durations(connection, latest, name)
+            trend = " ".join(f"{d:.1f}" for d in reversed(earlier))
+            line = f"  {name:<20} {took}  earlier: {trend or '-'}"
+            if name in flagged:
+                line += (
+                    f"  REGRESSED (median {flagged[name]:.1f}s over the last "
+                    f"{MEDIAN_WINDOW} runs)"
+                )
+            print(line)
+        if flagged:
+            util.log_line(f"Stage regressions in run {latest}: {', '.join(flagged)}")
@@ -0,0 +1,94 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from pathlib import Path
+
+# Minimal inotify binding over libc with ctypes, enough to watch a handful
+# of directories. Files are watched through their parent directory with a
+# name filter: tools replace files by renaming a temporary over them, which
+# would silently drop a watch on the file itself.
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+# Events were dropped; reported with wd -1
+IN_Q_OVERFLOW = 0x00004000
+IN_MASK_ADD = 0x20000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Something was written, appeared, disappeared or was replaced
+CHANGE_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ATTRIB
+)
+# Something appeared or disappeared, its contents don't matter
+ENTRY_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher:
+    """Tag-based watcher: add(path, tag) and poll() returns the set of tags
+    whose paths changed."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> [(name or None, mask, tag)]
+        self._watches = {}
+
+    def add(self, path, tag, mask=CHANGE_MASK, entry=False):
+        """Watch a directory, or a file through its directory. With entry,
+        a directory is also watched through its parent, for mask events on
+        the directory itself rather than its contents. Returns False if the
+        path (or its directory) doesn't exist."""
+        path = Path(path)
+        if path.is_dir() and not entry:
+            directory, name = path.resolve(), None
+        else:
+            directory, name = path.parent.resolve(), path.name
+        # Several paths can share a directory's watch; widen it, don't replace
+        wd = self._libc.inotify_add_watch(
+            self.fd, str(directory).encode(), mask | IN_MASK_ADD
+        )
+        if wd < 0:
+            return False
+        self._watches.setdefault(wd, []).append((name, mask, tag))
+        return True
+
+    def poll(self, timeout):
+        """Wait up to timeout seconds for changes. Returns the changed tags;
+        if the kernel's event queue overflowed that is every tag."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        tags = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return tags
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if wd == -1 and mask & IN_Q_OVERFLOW:
+                    # Lost events could have been for anything
+                    for watches in self._watches.values():
+                        tags.update(tag for _, _, tag in watches)
+                    continue
+                for wanted, wanted_mask, tag in self._watches.get(wd, []):
+                    if mask & wanted_mask and wanted in (None, name):
+                        tags.add(tag)
+
+    def close(self):
+        os.close(self.fd)
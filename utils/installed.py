@@ -0,0 +1,119 @@
+from pathlib import Path
+from utils import common as util
+from utils import target
+from utils.aliases import PKG
+
+# Snapshots of installed RPMs and Flatpak apps shared by every stage. Each
+# is rebuilt with one bulk query whenever its database changes on disk or
+# after pybootstrap runs a transaction itself. Paths and queries follow
+# the install target (see utils/target.py).
+
+RPMDB_FILES = [
+    Path("/usr/lib/sysimage/rpm/rpmdb.sqlite"),
+    Path("/usr/lib/sysimage/rpm/rpmdb.sqlite-wal"),
+    Path("/var/lib/rpm/rpmdb.sqlite"),
+    Path("/var/lib/rpm/rpmdb.sqlite-wal"),
+    Path("/var/lib/rpm/Packages"),
+]
+
+FLATPAK_APP_DIRS = [
+    Path("/var/lib/flatpak/app"),
+    Path.home() / ".local" / "share" / "flatpak" / "app",
+]
+
+_rpm_index = None
+_rpm_signature = None
+_flatpak_index = None
+_flatpak_signature = None
+
+
+def _signature(paths):
+    """Cheap fingerprint of a set of files or dirs: mtime and size of each."""
+    signature = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        signature.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def invalidate():
+    """Drop the RPM snapshot. Call after running a dnf/rpm transaction."""
+    global _rpm_index, _rpm_signature
+    _rpm_index = None
+    _rpm_signature = None
+
+
+def invalidate_flatpaks():
+    """Drop the Flatpak snapshot. Call after installing or removing apps."""
+    global _flatpak_index, _flatpak_signature
+    _flatpak_index = None
+    _flatpak_signature = None
+
+
+def rpm_packages():
+    """Return {name: version-release} for every installed RPM."""
+    global _rpm_index, _rpm_signature
+
+    signature = _signature([target.path(path) for path in RPMDB_FILES])
+    if _rpm_index is not None and signature == _rpm_signature:
+        return _rpm_index
+
+    query_format = "%{NAME}\t%{VERSION}-%{RELEASE}\n"
+    exit_code, output = util.query_cmd(
+        [PKG.r, *target.rpm_options(), "-qa", "--qf", query_format]
+    )
+    index = {}
+    if exit_code == 0:
+        for line in output.splitlines():
+            name, _, version = line.partition("\t")
+            if name:
+                index[name] = version
+
+    _rpm_index = index
+    _rpm_signature = signature
+    return index
+
+
+def is_installed(name):
+    """True if an RPM with this exact name is installed."""
+    return name in rpm_packages()
+
+
+def installed_version(name):
+    """Installed version-release of an RPM, or None."""
+    return rpm_packages().get(name)
+
+
+def flatpak_apps():
+    """Return the set of installed Flatpak app IDs (system and user)."""
+    global _flatpak_index, _flatpak_signature
+
+    if target.is_host():
+        app_dirs = FLATPAK_APP_DIRS
+    else:
+        app_dirs = [target.flatpak_dir() / "app"]
+    signature = _signature(app_dirs)
+    if _flatpak_index is not None and signature == _flatpak_signature:
+        return _flatpak_index
+
+    exit_code, output = util.query_cmd(
+        target.flatpak_cmd("list", "--app", "--columns=application", query=True)
+    )
+    index = set()
+    if exit_code == 0:
+        for line in output.splitlines():
+            app_id = line.strip()
+            if app_id and app_id != "Application ID":
+                index.add(app_id)
+
+    _flatpak_index = index
+    _flatpak_signature = signature
+    return index
+
+
+def is_flatpak_installed(app_id):
+    """True if the Flatpak app is installed in any installation."""
+    return app_id in flatpak_apps()
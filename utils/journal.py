@@ -0,0 +1,107 @@
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from utils import common as util
+from utils import target
+
+# Run journal for resumable bootstraps. Each completed stage or sub-step is
+# recorded with a fingerprint of its inputs (config files and the source of
+# the code that ran). If a run is interrupted, the next run resumes: steps
+# whose fingerprint still matches are skipped. Once a run finishes the
+# journal is closed and the next invocation starts from scratch.
+
+_lock = threading.Lock()
+_journal = None
+
+
+def get_journal_path():
+    """Gets or makes the journal location"""
+    state_dir = Path.home() / ".local" / "state" / "pybootstrap"
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir / target.per_target("journal.json")
+
+
+def _save():
+    path = get_journal_path()
+    temp_path = path.with_suffix(".tmp")
+    with temp_path.open("w") as file:
+        json.dump(_journal, file, indent=2)
+    os.replace(temp_path, path)
+
+
+def start_run(fresh=False):
+    """Open the journal, resuming an unfinished run unless fresh is set."""
+    global _journal
+    with _lock:
+        try:
+            with get_journal_path().open("r") as file:
+                previous = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            previous = None
+
+        if previous and not previous.get("complete") and not fresh:
+            _journal = previous
+            started = time.strftime(
+                "%Y-%m-%d %H:%M", time.localtime(previous["started"])
+            )
+            util.print_and_log(
+                f"Resuming unfinished run from {started} "
+                f"({len(previous['steps'])} steps already done)."
+            )
+        else:
+            _journal = {"started": time.time(), "complete": False, "steps": {}}
+        _save()
+
+
+def finish_run():
+    """Close the journal so the next run starts over."""
+    with _lock:
+        if _journal is None:
+            return
+        _journal["complete"] = True
+        _journal["finished"] = time.time()
+        _save()
+
+
+def fingerprint(*inputs):
+    """Hash a mix of file paths, functions (hashed by their module source)
+    and plain values into one fingerprint."""
+    digest = hashlib.sha256()
+    for item in inputs:
+        if callable(item):
+            item = Path(inspect.getsourcefile(item))
+        if isinstance(item, Path):
+            digest.update(str(item).encode())
+            try:
+                digest.update(item.read_bytes())
+            except OSError:
+                digest.update(b"<missing>")
+        else:
+            digest.update(repr(item).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def is_done(step, step_fingerprint):
+    """True if step completed in this run with the same fingerprint."""
+    with _lock:
+        if _journal is None:
+            return False
+        entry = _journal["steps"].get(step)
+        return entry is not None and entry["fingerprint"] == step_fingerprint
+
+
+def mark_done(step, step_fingerprint):
+    """Record that step completed."""
+    with _lock:
+        if _journal is None:
+            return
+        _journal["steps"][step] = {
+            "fingerprint": step_fingerprint,
+            "finished": time.time(),
+        }
+        _save()
@@ -0,0 +1,139 @@
+import atexit
+import os
+import queue
+import signal
+import threading
+import time
+
+# Background log writer. Each log file gets one long-lived handle owned by a
+# writer thread; callers just drop text on a queue. Output is flushed in
+# batches (by size or age) and always on exit, or on a fatal signal once
+# the entry point has called install_signal_handlers().
+
+FLUSH_BYTES = 64 * 1024
+FLUSH_INTERVAL = 0.5
+
+_writers = {}
+_writers_lock = threading.Lock()
+_previous_handlers = {}
+
+
+class LogWriter:
+    """Appends text to a single file from a background thread. The file is
+    opened here, so an unwritable path raises OSError to the caller."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8", errors="replace")
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name=f"log-writer-{path.name}", daemon=True
+        )
+        self._thread.start()
+
+    def write(self, text):
+        """Queue text for writing. Never blocks on disk."""
+        if not self._closed:
+            self._queue.put(text)
+
+    def flush(self, timeout=5):
+        """Block until everything queued so far is on disk."""
+        if self._closed or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def close(self, timeout=5):
+        """Flush and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        buffer = []
+        buffered = 0
+        last_flush = time.monotonic()
+
+        with self._file as log:
+            while True:
+                timeout = None
+                if buffer:
+                    timeout = max(0, FLUSH_INTERVAL - (time.monotonic() - last_flush))
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    item = ""
+
+                if isinstance(item, str) and item:
+                    buffer.append(item)
+                    buffered += len(item)
+
+                due = (
+                    item is None
+                    or isinstance(item, threading.Event)
+                    or buffered >= FLUSH_BYTES
+                    or time.monotonic() - last_flush >= FLUSH_INTERVAL
+                )
+                if due:
+                    if buffer:
+                        log.write("".join(buffer))
+                        log.flush()
+                        buffer.clear()
+                        buffered = 0
+                    last_flush = time.monotonic()
+
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is None:
+                    return
+
+
+def get_writer(path):
+    """Return the shared writer for path, starting it on first use. Raises
+    OSError if path can't be opened."""
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = LogWriter(path)
+            _writers[path] = writer
+            if len(_writers) == 1:
+                atexit.register(close_all)
+        return writer
+
+
+def flush_all():
+    for writer in list(_writers.values()):
+        writer.flush()
+
+
+def close_all():
+    for writer in list(_writers.values()):
+        writer.close()
+
+
+def _handle_signal(signum, frame):
+    """Flush logs, then let the signal do what it would have done."""
+    flush_all()
+    previous = _previous_handlers.get(signum)
+    if callable(previous):
+        previous(signum, frame)
+        return
+    if previous == signal.SIG_IGN:
+        return
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def install_signal_handlers():
+    """Flush every log on SIGINT, SIGTERM and SIGHUP. Signal handlers can
+    only be installed from the main thread, so entry points call this
+    before any work starts rather than leaving it to the first writer."""
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        if signum in _previous_handlers:
+            continue
+        _previous_handlers[signum] = signal.getsignal(signum)
+        signal.signal(signum, _handle_signal)
@@ -0,0 +1,177 @@
+import fcntl
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+# Per-run log files. Every run gets its own <kind>-<timestamp>.log (kind is
+# the log name without .log, e.g. bootstrap, bootstrap-verify) with files
+# belonging to the run (its trace) sharing the stem. <kind>.log is a symlink
+# to the newest run of that kind. index.json lists the runs; when a new run
+# starts, older runs are gzipped once idle and deleted by age and total size.
+# A run's process holds a shared flock on its log until it exits, so runs
+# that are still going (verify --watch, concurrent --root builds) are left
+# alone however old they are.
+
+COMPRESS_IDLE_SECONDS = 10 * 60
+MAX_AGE_DAYS = 30
+KEEP_RUNS = 5
+MAX_TOTAL_BYTES = 50 * 1024 * 1024
+
+# Logs of this process's runs, kept open to hold their locks
+_held = []
+
+
+@contextmanager
+def _locked_index(log_dir):
+    """Load index.json under a process lock, save it on exit."""
+    index_path = log_dir / "index.json"
+    with open(log_dir / "index.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with index_path.open("r") as file:
+                index = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {"runs": []}
+        yield index
+        temp_path = index_path.with_suffix(".tmp")
+        with temp_path.open("w") as file:
+            json.dump(index, file, indent=2)
+        os.replace(temp_path, index_path)
+
+
+def _run_files(log_dir, run):
+    return sorted(log_dir.glob(f"{run['name']}.*"))
+
+
+def _is_live(log_dir, run):
+    """True while the process that started run is still running."""
+    try:
+        log_file = open(log_dir / f"{run['name']}.log", "rb")
+    except OSError:
+        return False
+    with log_file:
+        try:
+            fcntl.flock(log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+def _size(path):
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def _adopt_legacy_log(log_dir, kind, index):
+    """Turn a pre-rotation, append-forever <kind>.log into an ordinary run."""
+    legacy = log_dir / f"{kind}.log"
+    if legacy.is_symlink() or not legacy.exists():
+        return
+    started = legacy.stat().st_mtime
+    name = f"{kind}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(started))}-legacy"
+    legacy.rename(log_dir / f"{name}.log")
+    index["runs"].append({"name": name, "kind": kind, "started": started})
+
+
+def start_run(log_dir, log_name):
+    """Register a new run and return its log path. Rotation of older runs
+    happens in the background."""
+    kind = log_name.removesuffix(".log")
+    now = time.time()
+    with _locked_index(log_dir) as index:
+        _adopt_legacy_log(log_dir, kind, index)
+        base = f"{kind}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}"
+        name, attempt = base, 1
+        while (log_dir / f"{name}.log").exists():
+            attempt += 1
+            name = f"{base}-{attempt}"
+        path = log_dir / f"{name}.log"
+        log_file = path.open("a")
+        fcntl.flock(log_file, fcntl.LOCK_SH)
+        _held.append(log_file)
+        index["runs"].append({"name": name, "kind": kind, "started": now})
+
+    latest = log_dir / log_name
+    temp_link = log_dir / f".{log_name}.{os.getpid()}"
+    try:
+        temp_link.unlink(missing_ok=True)
+        temp_link.symlink_to(path.name)
+        os.replace(temp_link, latest)
+    except OSError:
+        pass
+
+    threading.Thread(
+        target=rotate, args=(log_dir, name), name="log-rotate", daemon=True
+    ).start()
+    return path
+
+
+def _compress(path):
+    """gzip path next to itself, replacing it only once complete."""
+    temp_path = path.with_name(f".{path.name}.gz.tmp")
+    with open(path, "rb") as src, gzip.open(temp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    shutil.copystat(path, temp_path)
+    os.replace(temp_path, path.with_name(path.name + ".gz"))
+    path.unlink()
+
+
+def rotate(log_dir, current=None):
+    """Compress idle runs except the newest of each kind, then delete runs
+    past MAX_AGE_DAYS (keeping the newest KEEP_RUNS of each kind) and the
+    oldest runs while the directory is over MAX_TOTAL_BYTES. The current run
+    and runs whose process is still running are never touched."""
+    now = time.time()
+    with _locked_index(log_dir) as index:
+        runs = sorted(index["runs"], key=lambda run: run["started"])
+        # Runs whose files are all gone were removed by hand
+        runs = [run for run in runs if _run_files(log_dir, run)]
+
+        # rank 1 is the newest run of its kind
+        ranks = {}
+        per_kind = {}
+        for run in reversed(runs):
+            per_kind[run["kind"]] = per_kind.get(run["kind"], 0) + 1
+            ranks[run["name"]] = per_kind[run["kind"]]
+
+        live = {
+            run["name"]
+            for run in runs
+            if run["name"] == current or _is_live(log_dir, run)
+        }
+
+        for run in runs:
+            # The newest run of each kind stays readable through <kind>.log
+            if run["name"] in live or ranks[run["name"]] == 1:
+                continue
+            for path in _run_files(log_dir, run):
+                if path.suffix == ".gz":
+                    continue
+                try:
+                    if now - path.stat().st_mtime >= COMPRESS_IDLE_SECONDS:
+                        _compress(path)
+                except OSError:
+                    pass
+
+        total = sum(_size(path) for run in runs for path in _run_files(log_dir, run))
+        remaining = []
+        for run in runs:
+            newest = ranks[run["name"]] <= KEEP_RUNS
+            expired = now - run["started"] > MAX_AGE_DAYS * 86400 and not newest
+            oversized = total > MAX_TOTAL_BYTES and not newest
+            if run["name"] not in live and (expired or oversized):
+                for path in _run_files(log_dir, run):
+                    total -= _size(path)
+                    try:
+                        path.unlink()
+                    except OSError:
+                        pass
+                continue
+            remaining.append(run)
+        index["runs"] = remaining
@@ -0,0 +1,198 @@
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+
+# Moves directory trees. On one filesystem that's a single os.rename. Across
+# filesystems (e.g. ~/Videos on a separate media volume) the tree is copied
+# file by file in parallel, reflinked with FICLONE where the filesystem
+# allows it (btrfs subvolumes have their own st_dev but share extents),
+# every file is verified by hash, and only then is the source removed.
+# Finished files are kept, so an interrupted copy resumes where it stopped.
+# Only destinations this module created (they carry RESUME_MARKER naming
+# the source) are resumed; any other existing destination is refused.
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+COPY_WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+PART_SUFFIX = ".pybootstrap-part"
+RESUME_MARKER = ".pybootstrap-migrating"
+
+
+def same_device(src, dst):
+    """True if src can be renamed to dst, i.e. dst's parent is on src's
+    filesystem."""
+    try:
+        return os.stat(src).st_dev == os.stat(Path(dst).parent).st_dev
+    except OSError:
+        return False
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _is_copied(src_stat, dst):
+    """A finished copy has the source's size and mtime (copystat runs last)."""
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return False
+    return (
+        dst_stat.st_size == src_stat.st_size
+        and dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+    )
+
+
+def _copy_data(src_file, dst_file):
+    """Reflink if possible, plain copy otherwise. Returns True if reflinked."""
+    try:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return True
+    except OSError:
+        shutil.copyfileobj(src_file, dst_file, CHUNK_SIZE)
+        return False
+
+
+def _copy_file(src, dst):
+    """Copy one file unless an earlier run already did, then verify it.
+    Returns (bytes copied, reflinked, error)."""
+    src_stat = os.stat(src)
+    copied, reflinked = 0, False
+    if not _is_copied(src_stat, dst):
+        part = dst.with_name(dst.name + PART_SUFFIX)
+        with open(src, "rb") as src_file, open(part, "wb") as dst_file:
+            reflinked = _copy_data(src_file, dst_file)
+        shutil.copystat(src, part)
+        os.replace(part, dst)
+        copied = src_stat.st_size
+    if _file_hash(src) != _file_hash(dst):
+        return copied, reflinked, f"{dst} does not match {src}"
+    return copied, reflinked, None
+
+
+def _plan_copy(src, dst):
+    """Create dst's directories and list (src, dst) file pairs."""
+    files = []
+    errors = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = dst / Path(dirpath).relative_to(src)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        for name in dirnames + filenames:
+            src_path = Path(dirpath) / name
+            dst_path = target_dir / name
+            if src_path.is_symlink():
+                if not dst_path.is_symlink():
+                    os.symlink(os.readlink(src_path), dst_path)
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                if src_path.is_file():
+                    files.append((src_path, dst_path))
+                else:
+                    errors.append(f"{src_path}: not a regular file, not copied")
+    return files, errors
+
+
+def _copy_tree(src, dst, result):
+    files, result.errors = _plan_copy(src, dst)
+    result.files = len(files)
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as pool:
+        for copied, reflinked, error in pool.map(lambda pair: _copy_file(*pair), files):
+            result.bytes += copied
+            result.reflinked += reflinked
+            if error:
+                result.errors.append(error)
+
+    # Directory times last, copying into them changed them
+    for dirpath, _, _ in os.walk(src):
+        shutil.copystat(dirpath, dst / Path(dirpath).relative_to(src))
+
+    if not result.errors:
+        shutil.rmtree(src)
+        (dst / RESUME_MARKER).unlink()
+
+
+def move_tree(src, dst):
+    """Move directory src to dst (which must not be inside src). Returns a
+    SimpleNamespace with method ("rename", "copy" or "refused"), files,
+    bytes copied, reflinked file count, seconds and errors. The source is
+    only removed once every file is verified. An existing dst is refused
+    unless it is an interrupted copy of src."""
+    src, dst = Path(src), Path(dst)
+    result = SimpleNamespace(
+        method="rename", files=0, bytes=0, reflinked=0, seconds=0.0, errors=[]
+    )
+    start = time.perf_counter()
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    marker = dst / RESUME_MARKER
+    if dst.exists():
+        # Only an interrupted copy of this same source may be resumed
+        try:
+            resumable = marker.read_text() == str(src.resolve())
+        except OSError:
+            resumable = False
+        if not resumable:
+            result.method = "refused"
+            result.errors.append(f"{dst} already exists")
+            return result
+    elif same_device(src, dst):
+        try:
+            os.rename(src, dst)
+            result.seconds = time.perf_counter() - start
+            return result
+        except OSError:
+            pass
+
+    result.method = "copy"
+    try:
+        if not dst.exists():
+            dst.mkdir()
+            marker.write_text(str(src.resolve()))
+        _copy_tree(src, dst, result)
+    except OSError as e:
+        result.errors.append(str(e))
+    result.seconds = time.perf_counter() - start
+    return result
+
+
+def throughput(result):
+    """Human readable summary of a copy."""
+    megabytes = result.bytes / (1024 * 1024)
+    rate = megabytes / result.seconds if result.seconds else 0.0
+    summary = (
+        f"{result.files} files, {megabytes:.1f} MiB in {result.seconds:.1f}s "
+        f"({rate:.1f} MiB/s)"
+    )
+    if result.reflinked:
+        summary += f", {result.reflinked} reflinked"
+    return summary
+
+
+def write_text_atomic(path, text):
+    """Replace path's contents in one step: readers see the old file or the
+    new one, never a partial write."""
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        if path.exists():
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,236 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+# Privileged helper, started once through sudo by utils/privileged.py. It
+# reads one JSON request per line on stdin and answers on stdout, tagged
+# with the request id, so several requests can be in flight at once.
+#
+#   {"id": 1, "op": "write_file", "path": "/etc/x", "data": "...", "mode": 420}
+#   {"id": 2, "op": "move", "src": "/tmp/x", "dst": "/etc/x"}
+#   {"id": 3, "op": "run", "argv": ["dnf", "install", "-y", "foo"]}
+#   {"id": 4, "op": "kill", "target": 3}
+#
+# run streams {"id": 3, "type": "output", "data": "..."} messages, and every
+# request ends with {"id": n, "type": "done", "exit": 0, "error": null}.
+# Only the operations above are accepted, commands must be on
+# ALLOWED_COMMANDS with one of its subcommands and only ALLOWED_OPTIONS,
+# and files may only be written or moved under WRITE_ROOTS plus any
+# directories given on the command line (install roots). Commands still
+# running when the helper exits are killed.
+#
+# Runs as root, so it only uses the standard library and nothing from the
+# rest of the project.
+
+# command -> the subcommands (or mode options, for rpm) it may run
+ALLOWED_COMMANDS = {
+    "dnf": {"install", "upgrade", "makecache", "autoremove", "clean"},
+    "rpm": {"-U", "--import"},
+    "flatpak": {"install", "update", "uninstall", "remote-add"},
+    "systemctl": {"enable", "start", "status"},
+    "ufw": {"enable", "disable", "default", "limit", "status"},
+    "setfont": {"-C"},
+    "sysctl": {"--system"},
+}
+# Options each command may be given. Ones ending in "=" match as prefixes,
+# VALUE_OPTIONS take the next argument as their value.
+ALLOWED_OPTIONS = {
+    "dnf": {
+        "-y",
+        "--refresh",
+        "--repo=",
+        "--installroot=",
+        "--releasever=",
+        "--setopt=reposdir=",
+        "--setopt=cachedir=",
+        "--setopt=keepcache=",
+    },
+    "rpm": {"--root", "--replacepkgs"},
+    "flatpak": {"-y", "--noninteractive", "--if-not-exists", "--unused"},
+    "systemctl": {"--now", "--no-pager", "--root="},
+    "ufw": {"--force"},
+}
+VALUE_OPTIONS = {"--root"}
+WRITE_ROOTS = ["/etc/"]
+READ_SIZE = 64 * 1024
+KILL_GRACE_SECONDS = 5
+
+_write_lock = threading.Lock()
+_processes = {}
+
+
+def send(message):
+    line = json.dumps(message) + "\n"
+    with _write_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+
+def done(request_id, exit_code=0, error=None):
+    send({"id": request_id, "type": "done", "exit": exit_code, "error": error})
+
+
+def check_writable(path):
+    real = os.path.realpath(path)
+    if not real.startswith(tuple(WRITE_ROOTS)):
+        raise PermissionError(f"{path} is outside {', '.join(WRITE_ROOTS)}")
+    return real
+
+
+def write_file(path, data, mode=0o644):
+    """Write data next to path, then rename it into place."""
+    path = check_writable(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".pyb-")
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def move(src, dst):
+    shutil.move(check_writable(src), check_writable(dst))
+
+
+def _option_allowed(arg, options):
+    return arg in options or any(
+        option.endswith("=") and arg.startswith(option) for option in options
+    )
+
+
+def check_argv(argv):
+    """Raise PermissionError unless argv is an allow-listed command with one
+    of its subcommands and only its allowed options."""
+    if not argv or "/" in argv[0] or argv[0] not in ALLOWED_COMMANDS:
+        raise PermissionError(f"command not allowed: {argv[:1]}")
+    command = argv[0]
+    subcommands = ALLOWED_COMMANDS[command]
+    options = ALLOWED_OPTIONS.get(command, set())
+    subcommand = None
+    args = iter(argv[1:])
+    for arg in args:
+        if subcommand is None and arg in subcommands:
+            subcommand = arg
+        elif arg.startswith("-"):
+            if not _option_allowed(arg, options):
+                raise PermissionError(f"{command}: option not allowed: {arg}")
+            if arg in VALUE_OPTIONS:
+                next(args, None)
+        elif subcommand is None:
+            raise PermissionError(f"{command}: subcommand not allowed: {arg}")
+    if subcommand is None:
+        raise PermissionError(f"{command}: no allowed subcommand given")
+
+
+def run(request_id, argv):
+    """Run an allow-listed command, streaming its output back."""
+    check_argv(argv)
+    executable = shutil.which(argv[0])
+    if executable is None:
+        return done(request_id, 127, f"{argv[0]}: command not found")
+
+    process = subprocess.Popen(
+        [executable, *argv[1:]],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        start_new_session=True,
+    )
+    _processes[request_id] = process
+    try:
+        fd = process.stdout.fileno()
+        while chunk := os.read(fd, READ_SIZE):
+            # surrogateescape keeps non-UTF-8 bytes intact through JSON
+            data = chunk.decode("utf-8", "surrogateescape")
+            send({"id": request_id, "type": "output", "data": data})
+        process.stdout.close()
+        exit_code = process.wait()
+    finally:
+        _processes.pop(request_id, None)
+    done(request_id, exit_code if exit_code >= 0 else 128 - exit_code)
+
+
+def kill(target, sig=signal.SIGTERM):
+    process = _processes.get(target)
+    if process is not None:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+
+def kill_all(sig=signal.SIGTERM):
+    """Signal the process group of every running command."""
+    for target in list(_processes):
+        kill(target, sig)
+
+
+def _exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
+def handle(request):
+    request_id = request.get("id")
+    try:
+        match request.get("op"):
+            case "write_file":
+                mode = request.get("mode", 0o644)
+                write_file(request["path"], request["data"], mode)
+            case "move":
+                move(request["src"], request["dst"])
+            case "run":
+                return run(request_id, request["argv"])
+            case "kill":
+                kill(request["target"])
+            case op:
+                raise ValueError(f"unknown operation: {op}")
+    except Exception as e:
+        return done(request_id, 1, f"{type(e).__name__}: {e}")
+    done(request_id)
+
+
+def serve():
+    send({"id": None, "type": "ready", "pid": os.getpid()})
+    threads = []
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        # Commands can take minutes; don't hold up the other requests
+        thread = threading.Thread(target=handle, args=(request,), daemon=True)
+        thread.start()
+        threads.append(thread)
+    # stdin closed: the client is done or gone, so is anything still running
+    kill_all()
+    for thread in threads:
+        thread.join(KILL_GRACE_SECONDS)
+    kill_all(signal.SIGKILL)
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    if os.geteuid() != 0:
+        print("privhelper must run as root", file=sys.stderr)
+        sys.exit(1)
+    WRITE_ROOTS += [os.path.join(os.path.realpath(root), "") for root in sys.argv[1:]]
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, _exit_on_signal)
+    try:
+        serve()
+    finally:
+        # Children run in their own sessions; don't leave them behind
+        kill_all(signal.SIGKILL)
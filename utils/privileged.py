@@ -0,0 +1,210 @@
+import atexit
+import itertools
+import json
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from pathlib import Path
+from utils import common as util
+from utils import privhelper
+from utils.aliases import ESCALATE
+
+# Client for utils/privhelper.py. start() launches the helper once through
+# sudo; from then on privileged work goes over its pipe instead of paying
+# for a new sudo (PAM, policy, maybe a password prompt) per command.
+# util.run_cmd and aio.run send "sudo ..." commands here automatically when
+# the helper is running, and fall back to plain sudo when it isn't (e.g.
+# under the benchmark's fake sudo). write_files/move are the file
+# operations, with the same fallback.
+
+HELPER_PATH = Path(__file__).with_name("privhelper.py")
+
+_helper = None
+_send_lock = threading.Lock()
+_pending = {}
+_pending_lock = threading.Lock()
+_ids = itertools.count(1)
+
+
+def active():
+    return _helper is not None and _helper.poll() is None
+
+
+def start(write_roots=()):
+    """Start the helper through sudo. write_roots are extra directories it
+    may write under. Returns True if it came up."""
+    global _helper
+    if active():
+        return True
+    try:
+        helper = subprocess.Popen(
+            [ESCALATE, sys.executable, str(HELPER_PATH), *map(str, write_roots)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+    except OSError:
+        return False
+
+    ready = helper.stdout.readline()
+    try:
+        ready = json.loads(ready)
+    except json.JSONDecodeError:
+        ready = {}
+    if ready.get("type") != "ready":
+        helper.kill()
+        helper.wait()
+        return False
+
+    _helper = helper
+    threading.Thread(target=_read_responses, args=(helper,), daemon=True).start()
+    atexit.register(stop)
+    return True
+
+
+def stop():
+    """Close the pipe; the helper kills anything still running and exits."""
+    global _helper
+    helper, _helper = _helper, None
+    if helper is None:
+        return
+    try:
+        helper.stdin.close()
+    except OSError:
+        pass
+    helper.wait()
+
+
+def _read_responses(helper):
+    """Route every response to the queue of the request it answers."""
+    for line in helper.stdout:
+        try:
+            message = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        with _pending_lock:
+            responses = _pending.get(message.get("id"))
+        if responses is not None:
+            responses.put(message)
+    # Helper gone: fail whatever is still waiting
+    with _pending_lock:
+        waiting = list(_pending.items())
+    for request_id, responses in waiting:
+        responses.put(
+            {"id": request_id, "type": "done", "exit": 1, "error": "helper exited"}
+        )
+
+
+def submit(op, responses=None, **fields):
+    """Send a request. Returns its id and the queue its responses land on.
+    responses can be anything with a put() method, e.g. a bridge to an
+    asyncio queue."""
+    request_id = next(_ids)
+    if responses is None:
+        responses = queue.Queue()
+    with _pending_lock:
+        _pending[request_id] = responses
+    line = json.dumps({"id": request_id, "op": op, **fields}) + "\n"
+    try:
+        with _send_lock:
+            _helper.stdin.write(line)
+            _helper.stdin.flush()
+    except (OSError, AttributeError):
+        error = "helper not running"
+        responses.put({"id": request_id, "type": "done", "exit": 1, "error": error})
+    return request_id, responses
+
+
+def finish(request_id):
+    with _pending_lock:
+        _pending.pop(request_id, None)
+
+
+def _wait(request_id, responses):
+    """Block until a non-streaming request is done."""
+    try:
+        while (message := responses.get())["type"] != "done":
+            pass
+    finally:
+        finish(request_id)
+    return message
+
+
+def output_chunk(message):
+    """Raw bytes of an output message."""
+    return message["data"].encode("utf-8", "surrogateescape")
+
+
+def kill(request_id):
+    """Ask the helper to stop a running command."""
+    if active():
+        kill_id, _ = submit("kill", target=request_id)
+        finish(kill_id)
+
+
+def write_files(files, mode=0o644):
+    """Atomically write {path: text} into root-owned locations. Returns a
+    list of error messages, empty on success."""
+    errors = []
+    if active():
+        requests = [
+            submit("write_file", path=str(path), data=data, mode=mode)
+            for path, data in files.items()
+        ]
+        for request in requests:
+            message = _wait(*request)
+            if message["exit"] != 0:
+                errors.append(message["error"])
+        return errors
+
+    # Fallback: stage under the final names, one sudo install per directory
+    by_dir = defaultdict(dict)
+    for path, data in files.items():
+        by_dir[Path(path).parent][Path(path).name] = data
+    for directory, named in by_dir.items():
+        with tempfile.TemporaryDirectory(prefix="pybootstrap-") as staging:
+            staged = []
+            for name, data in named.items():
+                staged_path = Path(staging) / name
+                staged_path.write_text(data)
+                staged.append(str(staged_path))
+            exit_code, output = util.run_cmd(
+                [ESCALATE, "install", "-D", "-m", f"{mode:o}", "-t", str(directory)]
+                + staged
+            )
+            if exit_code != 0:
+                errors.append(output.strip() or f"install exited with {exit_code}")
+    return errors
+
+
+def write_file(path, data, mode=0o644):
+    return write_files({path: data}, mode)
+
+
+def move(src, dst):
+    """Move src to dst, both in root-owned locations. Returns a list of
+    error messages, empty on success, like write_files."""
+    if active():
+        message = _wait(*submit("move", src=str(src), dst=str(dst)))
+        return [message["error"]] if message["exit"] != 0 else []
+
+    exit_code, output = util.run_cmd([ESCALATE, "mv", str(src), str(dst)])
+    if exit_code == 0:
+        return []
+    return [output.strip() or f"mv exited with {exit_code}"]
+
+
+def privileged_argv(cmd):
+    """The command to hand to the helper, or None if cmd isn't `sudo` plus
+    a command the helper allows or the helper isn't running."""
+    if not active() or not cmd or cmd[0] != ESCALATE or len(cmd) < 2:
+        return None
+    argv = [str(part) for part in cmd[1:]]
+    try:
+        privhelper.check_argv(argv)
+    except PermissionError:
+        return None
+    return argv
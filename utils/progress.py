@@ -0,0 +1,109 @@
+import atexit
+import re
+import shutil
+import sys
+import threading
+import time
+
+# Compact terminal display for child output. Instead of echoing every line
+# (and every carriage-return redraw) that dnf, flatpak and curl produce, each
+# running stage or command gets one status line showing its latest output,
+# redrawn at most every REFRESH_INTERVAL. Messages from print_and_log still
+# print normally above the status block. The log gets the full output
+# either way. Only used on a terminal, and `--verbose` turns it off.
+
+REFRESH_INTERVAL = 0.1
+MAX_STATUS_LINES = 8
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+
+_enabled = False
+_lock = threading.Lock()
+_status = {}
+_drawn = 0
+_last_render = 0.0
+
+
+def configure(verbose=False):
+    """Use status lines when stdout is a terminal, unless verbose."""
+    global _enabled
+    _enabled = not verbose and sys.stdout.isatty()
+    if _enabled:
+        atexit.register(clear)
+
+
+def enabled():
+    return _enabled
+
+
+def _latest_text(data):
+    """The last visible piece of a chunk of output."""
+    text = ANSI_ESCAPE.sub("", data.decode(errors="replace"))
+    for piece in reversed(re.split(r"[\r\n]", text)):
+        piece = piece.strip()
+        if piece:
+            return piece
+    return None
+
+
+def _render():
+    """Redraw the status block in place. Caller holds _lock."""
+    global _drawn, _last_render
+    width = shutil.get_terminal_size().columns
+    lines = [f"[{key}] {text}"[: width - 1] for key, text in _status.items()]
+    lines = lines[:MAX_STATUS_LINES]
+    # Back to the top of the old block, then clear to the end of the screen
+    out = f"\x1b[{_drawn}F" if _drawn else ""
+    out += "\x1b[J" + "".join(f"{line}\n" for line in lines)
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    _drawn = len(lines)
+    _last_render = time.monotonic()
+
+
+def output(key, data):
+    """Show the latest text from a chunk of key's output."""
+    if not _enabled:
+        return
+    text = _latest_text(data)
+    if text is None:
+        return
+    with _lock:
+        _status[key] = text
+        if time.monotonic() - _last_render >= REFRESH_INTERVAL:
+            _render()
+
+
+def done(key):
+    """Drop key's status line."""
+    with _lock:
+        if _status.pop(key, None) is not None:
+            _render()
+
+
+def echo(text):
+    """Print text above the status block."""
+    if not _enabled:
+        print(text)
+        return
+    global _drawn
+    with _lock:
+        if _drawn:
+            sys.stdout.write(f"\x1b[{_drawn}F\x1b[J")
+            _drawn = 0
+        sys.stdout.write(f"{text}\n")
+        if _status:
+            _render()
+        else:
+            sys.stdout.flush()
+
+
+def clear():
+    """Remove the status block, e.g. before exiting."""
+    global _drawn
+    with _lock:
+        _status.clear()
+        if _drawn:
+            sys.stdout.write(f"\x1b[{_drawn}F\x1b[J")
+            sys.stdout.flush()
+            _drawn = 0
@@ -0,0 +1,198 @@
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from utils import common as util
+from utils import journal
+from utils import trace
+
+# Dependency-aware stage scheduler. Stages declare what they depend on and
+# which shared resources they hold while running; anything whose
+# dependencies are done and whose resources are free runs concurrently.
+# Completed stages are recorded in the run journal so an interrupted run
+# can resume where it stopped.
+
+# How many stages may hold each resource at once. Unlisted resources are
+# exclusive.
+RESOURCE_LIMITS = {
+    "dnf-lock": 1,
+    "flatpak": 1,
+    "network": 3,
+    "home": 1,
+}
+
+
+def stage(name, func, deps=(), resources=(), inputs=()):
+    """Declare a bootstrap stage. inputs are extra files (e.g. config) whose
+    contents decide whether a journaled stage must run again."""
+    return SimpleNamespace(
+        name=name,
+        func=func,
+        deps=tuple(deps),
+        resources=tuple(resources),
+        inputs=tuple(Path(i) for i in inputs),
+        fingerprint=None,
+        status="pending",
+        start=None,
+        end=None,
+        error=None,
+    )
+
+
+def _check_graph(stages):
+    """Reject unknown dependencies and cycles before anything runs."""
+    by_name = {s.name: s for s in stages}
+    for s in stages:
+        for dep in s.deps:
+            if dep not in by_name:
+                raise ValueError(f"Stage {s.name} depends on unknown stage {dep}")
+
+    visiting, done = set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle through stage {name}")
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+
+    for s in stages:
+        visit(s.name)
+    return by_name
+
+
+def _resources_free(s, in_use):
+    return all(in_use.get(r, 0) < RESOURCE_LIMITS.get(r, 1) for r in s.resources)
+
+
+def run_stages(stages):
+    """Run stages as early as their dependencies and resources allow.
+    Stages report failure by raising; a stage that raises is logged, not
+    journaled, and its dependents are skipped."""
+    by_name = _check_graph(stages)
+    in_use = {}
+    running = set()
+    condition = threading.Condition()
+    run_start = time.monotonic()
+
+    def worker(s):
+        util.set_stage(s.name)
+        try:
+            with trace.span(s.name, "stage", resources=list(s.resources)):
+                s.func()
+            status = "done"
+            journal.mark_done(s.name, s.fingerprint)
+        except Exception as e:
+            s.error = e
+            status = "failed"
+            util.print_and_log(f"Stage {s.name} failed: {e}")
+        finally:
+            util.set_stage(None)
+        with condition:
+            s.end = time.monotonic() - run_start
+            s.status = status
+            running.discard(s.name)
+            for r in s.resources:
+                in_use[r] -= 1
+            condition.notify_all()
+
+    with condition:
+        while True:
+            pending = [s for s in stages if s.status == "pending"]
+            if not pending and not running:
+                break
+
+            progressed = False
+            for s in pending:
+                dep_states = [by_name[dep].status for dep in s.deps]
+                if any(state in ("failed", "skipped") for state in dep_states):
+                    s.status = "skipped"
+                    util.print_and_log(f"Skipping stage {s.name}: a dependency failed")
+                    progressed = True
+                    continue
+                if not all(state in ("done", "resumed") for state in dep_states):
+                    continue
+
+                if s.fingerprint is None:
+                    s.fingerprint = journal.fingerprint(s.func, *s.inputs)
+                if journal.is_done(s.name, s.fingerprint):
+                    s.status = "resumed"
+                    util.print_and_log(f"Stage {s.name} already completed, skipping.")
+                    progressed = True
+                    continue
+
+                if _resources_free(s, in_use):
+                    for r in s.resources:
+                        in_use[r] = in_use.get(r, 0) + 1
+                    s.status = "running"
+                    s.start = time.monotonic() - run_start
+                    running.add(s.name)
+                    threading.Thread(
+                        target=worker, args=(s,), name=f"stage-{s.name}"
+                    ).start()
+
+            if not progressed:
+                condition.wait()
+
+    return stages
+
+
+def _blockers(s, stages, by_name):
+    """Stages s had to wait for: its dependencies, plus the stages holding a
+    resource that was saturated when s became ready, up to when s started."""
+    blockers = [by_name[d] for d in s.deps if by_name[d].end is not None]
+    ready = max((b.end for b in blockers), default=0.0)
+    for r in s.resources:
+        holders = [
+            other
+            for other in stages
+            if other is not s and other.end is not None and r in other.resources
+        ]
+        held = sum(1 for other in holders if other.start <= ready < other.end)
+        if held < RESOURCE_LIMITS.get(r, 1):
+            continue
+        blockers += [o for o in holders if ready < o.end <= s.start + 0.01]
+    return blockers
+
+
+def critical_path(stages):
+    """Walk back from the last stage to finish through whatever it waited
+    on longest. That chain bounds the total run time."""
+    by_name = {s.name: s for s in stages}
+    finished = [s for s in stages if s.end is not None]
+    if not finished:
+        return []
+
+    path = [max(finished, key=lambda s: s.end)]
+    while True:
+        blockers = _blockers(path[-1], stages, by_name)
+        if not blockers:
+            break
+        path.append(max(blockers, key=lambda s: s.end))
+    path.reverse()
+    return path
+
+
+def report(stages):
+    """Log per-stage timings and the critical path."""
+    util.print_and_log_header("Stage Timings")
+    for s in sorted(stages, key=lambda s: (s.start is None, s.start or 0)):
+        if s.status == "resumed":
+            util.print_and_log(f"{s.name:<16} resumed  (done in an earlier run)")
+            continue
+        if s.start is None:
+            util.print_and_log(f"{s.name:<16} {s.status}")
+            continue
+        util.print_and_log(
+            f"{s.name:<16} {s.status:<8} start {s.start:7.1f}s  "
+            f"took {s.end - s.start:7.1f}s"
+        )
+
+    path = critical_path(stages)
+    if path:
+        chain = " -> ".join(f"{s.name} ({s.end - s.start:.1f}s)" for s in path)
+        util.print_and_log(f"Critical path: {chain}")
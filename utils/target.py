@@ -0,0 +1,173 @@
+import getpass
+import hashlib
+import os
+from pathlib import Path
+from utils import common as util
+from utils.aliases import ESCALATE, PKG
+
+# Install target. By default pybootstrap sets up the running host. With
+# `main.py --root <dir>` it builds a machine image in <dir> instead: dnf
+# and rpm get --installroot/--root, flatpak installs into <dir>'s
+# /var/lib/flatpak, files are written under <dir> and the home layout goes
+# to <dir>/home/<user>. Steps that only make sense on a live host (firewall,
+# sysctl --system, setfont, ...) are skipped.
+#
+# Several roots can be built at once, each in its own process. They share
+# one dnf package cache (SHARED_DNF_CACHE, with keepcache on) and the
+# download cache in utils/cache.py.
+
+SHARED_DNF_CACHE = Path("/var/cache/pybootstrap/dnf")
+
+_root = None
+_releasever = None
+# Offline package sources from a bundle (see scripts/bundle.py)
+_offline_reposdir = None
+_sideload_repo = None
+
+
+def set_root(path, releasever=None):
+    """Target an install root instead of the host."""
+    global _root, _releasever
+    _root = Path(path).resolve()
+    _releasever = str(releasever) if releasever else None
+
+
+def root():
+    """The install root, or None when targeting the host."""
+    return _root
+
+
+def is_host():
+    return _root is None
+
+
+def slug():
+    """Short unique name for the target, used to keep per-target state
+    files (journal, log, freshness) apart. None for the host."""
+    if _root is None:
+        return None
+    digest = hashlib.sha256(str(_root).encode()).hexdigest()[:8]
+    return f"{_root.name}-{digest}"
+
+
+def per_target(filename):
+    """filename for the host, filename with the target's slug for a root,
+    e.g. journal.json -> journal-img1-1a2b3c4d.json."""
+    if _root is None:
+        return filename
+    stem, dot, suffix = filename.partition(".")
+    return f"{stem}-{slug()}{dot}{suffix}"
+
+
+def releasever():
+    """Fedora release being installed: the host's unless overridden."""
+    return _releasever or util.get_os_version()
+
+
+def path(host_path):
+    """Where an absolute system path lives in the target."""
+    host_path = Path(host_path)
+    if _root is None:
+        return host_path
+    return _root / host_path.relative_to("/")
+
+
+def home():
+    """Home directory in the target."""
+    if _root is None:
+        return Path.home()
+    return _root / "home" / getpass.getuser()
+
+
+def prepare():
+    """Create the root and the user's home inside it, owned by the user so
+    the home and font stages don't need sudo. Returns True on success."""
+    exit_code, _ = util.run_cmd(
+        [
+            ESCALATE,
+            "install",
+            "-d",
+            "-o",
+            str(os.getuid()),
+            "-g",
+            str(os.getgid()),
+            "-m",
+            "0700",
+            str(home()),
+        ]
+    )
+    return exit_code == 0
+
+
+def use_offline_sources(reposdir, sideload_repo):
+    """Take packages only from reposdir's repos and flatpaks from a local
+    sideload repo, instead of the network."""
+    global _offline_reposdir, _sideload_repo
+    _offline_reposdir = Path(reposdir)
+    _sideload_repo = Path(sideload_repo)
+
+
+def is_offline():
+    return _offline_reposdir is not None
+
+
+def reposdir():
+    """The directory whose repo files dnf uses for the target."""
+    if _offline_reposdir is not None:
+        return _offline_reposdir
+    return path("/etc/yum.repos.d")
+
+
+def dnf_options():
+    """Extra dnf options for the target. A root uses its own repo files;
+    until it has any (the first install brings fedora-repos) the host's
+    are used to bootstrap it. Offline, only the bundle's repo is used."""
+    options = []
+    if _offline_reposdir is not None:
+        options.append(f"--setopt=reposdir={_offline_reposdir}")
+    if _root is None:
+        return options
+    if _offline_reposdir is None:
+        if any(reposdir().glob("*.repo")):
+            options.append(f"--setopt=reposdir={reposdir()}")
+        else:
+            options.append("--setopt=reposdir=/etc/yum.repos.d")
+    return [
+        f"--installroot={_root}",
+        f"--releasever={releasever()}",
+        *options,
+        f"--setopt=cachedir={SHARED_DNF_CACHE / releasever()}",
+        "--setopt=keepcache=True",
+    ]
+
+
+def rpm_options():
+    """Extra rpm options for the target."""
+    if _root is None:
+        return []
+    return ["--root", str(_root)]
+
+
+def flatpak_dir():
+    """The target's flatpak installation."""
+    return path("/var/lib/flatpak")
+
+
+def flatpak_cmd(subcommand, *args, query=False):
+    """A flatpak command for the target. On the host it's plain flatpak;
+    for a root it's a --user installation pointed at the root's
+    /var/lib/flatpak, run through sudo unless it only reads. Offline,
+    installs and updates pull from the bundle's sideload repo."""
+    if _sideload_repo is not None and subcommand in ("install", "update"):
+        args = (f"--sideload-repo={_sideload_repo}", *args)
+    if _root is None:
+        return [PKG.f, subcommand, *args]
+    cmd = [
+        "env",
+        f"FLATPAK_USER_DIR={flatpak_dir()}",
+        PKG.f,
+        subcommand,
+        "--user",
+        *args,
+    ]
+    return cmd if query else [ESCALATE, *cmd]
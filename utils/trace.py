@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Lightweight tracing for stages and commands. Every span is kept in memory
+# and can be written out in Chrome Trace Event format, which loads directly
+# in chrome://tracing or https://ui.perfetto.dev.
+
+_lock = threading.Lock()
+_events = []
+_thread_names = {}
+_origin = time.perf_counter()
+
+
+def _now_us():
+    return (time.perf_counter() - _origin) * 1_000_000
+
+
+def _add(name, category, start_us, end_us, args):
+    thread = threading.current_thread()
+    tid = threading.get_native_id()
+    with _lock:
+        _thread_names[tid] = thread.name
+        _events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round(start_us, 1),
+                "dur": round(end_us - start_us, 1),
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": args,
+            }
+        )
+
+
+@contextmanager
+def span(name, category="stage", **args):
+    """Time the enclosed block as one trace event."""
+    start = _now_us()
+    try:
+        yield args
+    finally:
+        _add(name, category, start, _now_us(), args)
+
+
+def start_command():
+    """Timestamp to hand back to record_command when the command ends."""
+    return _now_us()
+
+
+def record_command(cmd, start_us, exit_code, output_bytes, rusage=None, stage=None):
+    """Record a finished child process. rusage is what os.wait4 returned."""
+    args = {
+        "argv": [str(part) for part in cmd],
+        "exit_code": exit_code,
+        "output_bytes": output_bytes,
+    }
+    if stage:
+        args["stage"] = stage
+    if rusage is not None:
+        args["user_cpu_s"] = round(rusage.ru_utime, 3)
+        args["system_cpu_s"] = round(rusage.ru_stime, 3)
+        args["max_rss_kb"] = rusage.ru_maxrss
+    name = " ".join(str(part) for part in cmd[:3])
+    _add(name, "command", start_us, _now_us(), args)
+
+
+def record_download(url, start_us, size, source):
+    """Record a finished cache.fetch. source is "network", "cache" or
+    "bundle"; only network bytes were actually downloaded."""
+    args = {"url": url, "bytes": size, "source": source}
+    _add(url.rsplit("/", 1)[-1], "download", start_us, _now_us(), args)
+
+
+def events(category=None):
+    """Snapshot of recorded events, optionally of one category."""
+    with _lock:
+        return [e for e in _events if category is None or e["cat"] == category]
+
+
+def write_trace(path):
+    """Write everything recorded so far as Chrome Trace Event JSON."""
+    with _lock:
+        trace_events = list(_events)
+        names = dict(_thread_names)
+    for tid, name in names.items():
+        trace_events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+        )
+    with open(path, "w") as file:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, file)
+    return path
+
+
+def summary(limit=10):
+    """Lines for an end-of-run table of the slowest stages and commands."""
+    lines = []
+    sections = (("stage", "Slowest stages"), ("command", "Slowest commands"))
+    for category, title in sections:
+        slowest = sorted(events(category), key=lambda e: e["dur"], reverse=True)
+        if not slowest:
+            continue
+        lines.append(f"{title}:")
+        for event in slowest[:limit]:
+            seconds = event["dur"] / 1_000_000
+            detail = ""
+            if category == "command":
+                cpu = event["args"].get("user_cpu_s", 0) + event["args"].get(
+                    "system_cpu_s", 0
+                )
+                detail = (
+                    f"  exit {event['args']['exit_code']:>3}"
+                    f"  cpu {cpu:6.1f}s"
+                    f"  out {event['args']['output_bytes']:>9}B"
+                )
+            line = f"  {seconds:8.1f}s  {event['name'][:40]:<40}{detail}"
+            lines.append(line.rstrip())
+    return lines